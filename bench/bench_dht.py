@@ -0,0 +1,148 @@
+"""
+DHT lookup and put/get on simulated network, requests are answered in memory
+usage: python3 bench/bench_dht.py --nodes 5000 --degree 8 --lookups 500 --values 200
+"""
+from p2p_python.dht import DHT, node_id
+from p2p_python.tool.store import DiskStore
+from statistics import mean, median
+from time import time
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import tempfile
+
+
+class SimNetwork(object):
+
+    def __init__(self, num, dead_ratio, tmp):
+        self.nodes = dict()  # {host_port: DHT}
+        self.dead = set()
+        for i in range(num):
+            host_port = ("10.{}.{}.{}".format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff), 2000)
+            self.nodes[host_port] = DHT(
+                node_id(f"Sim:{i}"), self.rpc_of(host_port), self.find_value_rpc_of(host_port),
+                self.store_rpc_of(host_port), store=DiskStore(os.path.join(tmp, str(i))))
+        self.dead.update(random.sample(list(self.nodes), int(num * dead_ratio)))
+
+    def rpc_of(self, my_host_port):
+        async def rpc(host_port, target):
+            if host_port in self.dead:
+                raise ConnectionRefusedError(f"dead node {host_port}")
+            remote = self.nodes[host_port]
+            remote.table.add(self.nodes[my_host_port].my_id, my_host_port)  # remote learns requester
+            return remote.find_closest(target)
+        return rpc
+
+    def find_value_rpc_of(self, my_host_port):
+        async def rpc(host_port, target):
+            if host_port in self.dead:
+                raise ConnectionRefusedError(f"dead node {host_port}")
+            return self.nodes[host_port].handle_find_value(target)
+        return rpc
+
+    def store_rpc_of(self, my_host_port):
+        async def rpc(host_port, target, value, ttl):
+            if host_port in self.dead:
+                raise ConnectionRefusedError(f"dead node {host_port}")
+            return await self.nodes[host_port].handle_store(target, value, ttl)
+        return rpc
+
+    def connect_random(self, degree):
+        """random connections and neers like stabilizer feeds by GET_NEARS"""
+        host_ports = list(self.nodes)
+        links = {host_port: random.sample(host_ports, degree) for host_port in host_ports}
+        for host_port, connected in links.items():
+            dht = self.nodes[host_port]
+            for neer in connected:
+                dht.table.add(self.nodes[neer].my_id, neer)
+                for second in links[neer]:
+                    dht.table.add(self.nodes[second].my_id, second)
+
+
+async def bench(args, tmp):
+    network = SimNetwork(args.nodes, args.dead, tmp)
+    network.connect_random(args.degree)
+
+    # join, lookup own id to fill near buckets
+    start = time()
+    for dht in network.nodes.values():
+        await dht.lookup(dht.my_id)
+    join_sec = time() - start
+
+    # random lookups between alive nodes
+    alive = [host_port for host_port in network.nodes if host_port not in network.dead]
+    hops = list()
+    rpcs = list()
+    found = 0
+    start = time()
+    for _ in range(args.lookups):
+        src, dst = random.sample(alive, 2)
+        dht = network.nodes[src]
+        target = network.nodes[dst].my_id
+        before = dht.rpc_count
+        contacts, hop = await dht.lookup(target)
+        hops.append(hop)
+        rpcs.append(dht.rpc_count - before)
+        if any(contact_id == target for contact_id, _ in contacts):
+            found += 1
+    lookup_sec = time() - start
+
+    # put from a node and get from another node
+    put_rpcs = list()
+    get_rpcs = list()
+    replicas = list()
+    got = 0
+    for i in range(args.values):
+        src, dst = random.sample(alive, 2)
+        dht = network.nodes[src]
+        before = dht.rpc_count
+        replicas.append(await dht.put(f"key{i}", {'value': i}))
+        put_rpcs.append(dht.rpc_count - before)
+        dht = network.nodes[dst]
+        before = dht.rpc_count
+        if await dht.get(f"key{i}") == {'value': i}:
+            got += 1
+        get_rpcs.append(dht.rpc_count - before)
+
+    tables = [len(dht.table) for dht in network.nodes.values()]
+    return {
+        'nodes': args.nodes,
+        'dead_ratio': args.dead,
+        'log2_nodes': round(math.log2(args.nodes), 1),
+        'join_sec': round(join_sec, 2),
+        'lookups': args.lookups,
+        'found_ratio': round(found / args.lookups, 4),
+        'hops_mean': round(mean(hops), 2),
+        'hops_max': max(hops),
+        'rpc_mean': round(mean(rpcs), 2),
+        'rpc_median': median(rpcs),
+        'table_mean': round(mean(tables), 1),
+        'lookup_ms': round(lookup_sec / args.lookups * 1000, 2),
+        'values': args.values,
+        'get_ratio': round(got / args.values, 4) if args.values else None,
+        'put_rpc_mean': round(mean(put_rpcs), 2) if args.values else None,
+        'get_rpc_mean': round(mean(get_rpcs), 2) if args.values else None,
+        'replicas_mean': round(mean(replicas), 2) if args.values else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nodes', type=int, default=5000)
+    parser.add_argument('--degree', type=int, default=8, help="connections per node")
+    parser.add_argument('--lookups', type=int, default=500)
+    parser.add_argument('--values', type=int, default=200, help="number of put/get")
+    parser.add_argument('--dead', type=float, default=0.0, help="ratio of dead nodes")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        result = asyncio.get_event_loop().run_until_complete(bench(args, tmp))
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
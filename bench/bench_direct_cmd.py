@@ -0,0 +1,88 @@
+"""
+DIRECT_CMD throughput, single call vs send_direct_cmd_many
+usage: python3 bench/bench_direct_cmd.py --calls 2000 --batch 100
+"""
+from multiprocessing import Process
+from time import time
+import argparse
+import asyncio
+import json
+import logging
+
+NETWORK_VER = 97531
+SERVER_PORT = 2010
+CLIENT_PORT = 2011
+
+
+class DirectCmd(object):
+
+    @staticmethod
+    def echo(user, data):
+        return data
+
+
+def run_server():
+    from p2p_python.utils import setup_p2p_params
+    from p2p_python.server import Peer2Peer
+    setup_p2p_params(network_ver=NETWORK_VER, p2p_port=SERVER_PORT, p2p_accept=True, sub_dir='bench')
+    p2p = Peer2Peer(f_local=True)
+    p2p.event.setup_events_from_class(DirectCmd)
+    p2p.setup(f_stabilize=False)
+    asyncio.get_event_loop().run_forever()
+
+
+async def bench(p2p, calls, batch):
+    # wait for server
+    for _ in range(20):
+        if await p2p.core.create_connection('127.0.0.1', SERVER_PORT):
+            break
+        await asyncio.sleep(0.5)
+    while len(p2p.core.user) == 0:
+        await asyncio.sleep(0.1)
+
+    # single call
+    start = time()
+    for i in range(calls):
+        await p2p.send_direct_cmd(DirectCmd.echo, i)
+    single = time() - start
+
+    # batch call
+    start = time()
+    for i in range(0, calls, batch):
+        await p2p.send_direct_cmd_many([(DirectCmd.echo, n) for n in range(i, min(calls, i + batch))])
+    many = time() - start
+
+    return {
+        'calls': calls,
+        'batch': batch,
+        'single_calls_per_sec': round(calls / single, 1),
+        'many_calls_per_sec': round(calls / many, 1),
+        'speedup': round(single / many, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    server = Process(target=run_server, daemon=True)
+    server.start()
+
+    from p2p_python.utils import setup_p2p_params, setup_logger
+    from p2p_python.server import Peer2Peer
+    setup_logger(logging.WARNING)
+    setup_p2p_params(network_ver=NETWORK_VER, p2p_port=CLIENT_PORT, sub_dir='bench')
+    p2p = Peer2Peer(f_local=True)
+    p2p.setup(f_stabilize=False)
+    try:
+        result = asyncio.get_event_loop().run_until_complete(bench(p2p, args.calls, args.batch))
+        print(json.dumps(result))
+    finally:
+        p2p.close()
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+import time of the library in fresh interpreters, compared with a git revision
+optional modules loaded by the import are listed to check lazy loading
+usage: python3 bench/bench_import.py --runs 20 --baseline HEAD~1 > result.json
+"""
+from statistics import median
+import subprocess
+import tempfile
+import argparse
+import json
+import math
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OPTIONAL_MODULES = (
+    'requests', 'xmltodict', 'urllib.request', 'socks', 'ecdsa', 'multiprocessing', 'statistics',
+    'Cryptodome', 'expiringdict',
+)
+CODE = """
+import sys, json
+from time import perf_counter
+start = perf_counter()
+import {module}
+sec = perf_counter() - start
+print(json.dumps({{'sec': sec, 'loaded': [name for name in {optional!r} if name in sys.modules]}}))
+"""
+
+
+def measure(path, module, runs) -> dict:
+    """median and p90 milliseconds of `import module` with the tree on path"""
+    env = dict(os.environ, PYTHONPATH=path)
+    code = CODE.format(module=module, optional=OPTIONAL_MODULES)
+    subprocess.run([sys.executable, '-c', code], env=env, check=True, stdout=subprocess.DEVNULL)  # compile pyc
+    times = list()
+    loaded = list()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], env=env, check=True, stdout=subprocess.PIPE).stdout
+        result = json.loads(output.decode().splitlines()[-1])
+        times.append(result['sec'] * 1000)
+        loaded = result['loaded']
+    times.sort()
+    return {
+        'median_ms': round(median(times), 2),
+        'p90_ms': round(times[max(0, math.ceil(0.9 * len(times)) - 1)], 2),
+        'loaded': loaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--module', default='p2p_python.server')
+    parser.add_argument('--baseline', default=None, help="git revision to compare, ex. HEAD~1")
+    args = parser.parse_args()
+
+    result = {
+        'module': args.module,
+        'runs': args.runs,
+        'floor': measure(ROOT, 'asyncio', args.runs),  # stdlib cost every node pays
+        'current': measure(ROOT, args.module, args.runs),
+    }
+    if args.baseline:
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = subprocess.run(
+                ['git', 'archive', args.baseline, 'p2p_python'], cwd=ROOT, check=True, stdout=subprocess.PIPE).stdout
+            subprocess.run(['tar', '-x', '-C', tmp], input=archive, check=True)
+            result['baseline'] = dict(revision=args.baseline, **measure(tmp, args.module, args.runs))
+        result['saved_ms'] = round(result['baseline']['median_ms'] - result['current']['median_ms'], 2)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
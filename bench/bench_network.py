@@ -0,0 +1,244 @@
+"""
+multi-node benchmark on localhost, each node runs in a process and is driven by commands
+handshake rate, send_command latency, direct-cmd throughput, broadcast coverage and size, memory per connection
+usage: python3 bench/bench_network.py --nodes 8 --degree 3 --pings 300 --broadcasts 50 > result.json
+"""
+from multiprocessing import Process, Pipe
+from time import time, sleep
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+
+NETWORK_VER = 97532
+BASE_PORT = 2100
+
+
+class DirectCmd(object):
+
+    @staticmethod
+    def echo(user, data):
+        return data
+
+
+def percentiles(values, ratios=(0.5, 0.9, 0.99)) -> dict:
+    """nearest-rank percentiles in milliseconds"""
+    values = sorted(values)
+    if len(values) == 0:
+        return dict()
+    return {f"p{int(ratio * 100)}": round(values[max(0, math.ceil(ratio * len(values)) - 1)] * 1000, 3)
+            for ratio in ratios}
+
+
+def to_ms(sec):
+    """milliseconds, None if not measured or never reached"""
+    return None if sec is None or math.isinf(sec) else round(sec * 1000, 3)
+
+
+def memory_rss() -> int:
+    """resident memory bytes of this process"""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak on non linux
+
+
+def run_node(index, conn):
+    from p2p_python.utils import setup_p2p_params
+    from p2p_python.server import Peer2Peer, Peer2PeerCmd
+    from p2p_python.core import generate_keypair
+    generate_keypair()  # load lazy imported ecdsa before measuring memory
+    setup_p2p_params(network_ver=NETWORK_VER, p2p_port=BASE_PORT + index, p2p_accept=True, sub_dir='bench')
+    loop = asyncio.get_event_loop()
+    p2p = Peer2Peer(listen=100, f_local=True)
+    p2p.broadcast_check = lambda user, data: True
+    p2p.tracer.sample_rate = 1.0
+    p2p.event.setup_events_from_class(DirectCmd)
+    p2p.setup(f_stabilize=False)
+
+    async def connect(ports):
+        before = memory_rss()
+        start = time()
+        results = await asyncio.gather(*(p2p.core.create_connection('127.0.0.1', port) for port in ports))
+        return {'success': sum(1 for result in results if result), 'sec': time() - start, 'rss_before': before}
+
+    async def ping(count):
+        latencies = list()
+        for _ in range(count):
+            start = time()
+            await p2p.send_command(Peer2PeerCmd.PING_PONG, data=start)
+            latencies.append(time() - start)
+        return latencies
+
+    async def direct(calls, batch):
+        start = time()
+        for i in range(calls):
+            await p2p.send_direct_cmd(DirectCmd.echo, i)
+        single = time() - start
+        start = time()
+        for i in range(0, calls, batch):
+            await p2p.send_direct_cmd_many([(DirectCmd.echo, n) for n in range(i, min(calls, i + batch))])
+        return {'single_sec': single, 'many_sec': time() - start}
+
+    async def broadcast(count, size):
+        latencies = list()
+        for i in range(count):
+            start = time()
+            await p2p.send_command(Peer2PeerCmd.BROADCAST, data=os.urandom(size))
+            latencies.append(time() - start)
+        return latencies
+
+    async def serve():
+        while True:
+            cmd, args = await loop.run_in_executor(None, conn.recv)
+            if cmd == 'connect':
+                result = await connect(*args)
+            elif cmd == 'wait_users':
+                while len(p2p.core.user) < args[0]:
+                    await asyncio.sleep(0.05)
+                result = len(p2p.core.user)
+            elif cmd == 'status':
+                result = {
+                    'users': len(p2p.core.user),
+                    'rss': memory_rss(),
+                    'up': p2p.core.traffic.total[0],
+                    'down': p2p.core.traffic.total[2],
+                }
+            elif cmd == 'ping':
+                result = await ping(*args)
+            elif cmd == 'direct':
+                result = await direct(*args)
+            elif cmd == 'broadcast':
+                result = await broadcast(*args)
+            elif cmd == 'traces':
+                result = dict(p2p.tracer.traces)
+            elif cmd == 'close':
+                break
+            else:
+                result = None
+            conn.send(result)
+        p2p.close()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    loop.run_until_complete(serve())
+    conn.send(None)
+
+
+class Cluster(object):
+
+    def __init__(self, num):
+        self.conns = list()
+        self.processes = list()
+        for index in range(num):
+            parent, child = Pipe()
+            process = Process(target=run_node, args=(index, child), daemon=True)
+            process.start()
+            self.conns.append(parent)
+            self.processes.append(process)
+
+    def call(self, index, cmd, *args):
+        self.conns[index].send((cmd, args))
+        return self.conns[index].recv()
+
+    def call_all(self, cmd, *args_list):
+        """same command to nodes in parallel, args for each node"""
+        for conn, args in zip(self.conns, args_list):
+            conn.send((cmd, args))
+        return [conn.recv() for conn in self.conns]
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(('close', ()))
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(5.0)
+            if process.is_alive():
+                process.terminate()
+
+
+def bench(args, cluster: Cluster) -> dict:
+    from p2p_python.tool.trace import TraceCollector
+    num = args.nodes
+    cluster.call_all('status', *[()] * num)  # wait for all nodes start
+
+    # connect each node to random earlier nodes
+    links = [random.sample(range(index), min(index, args.degree)) for index in range(num)]
+    start = time()
+    connected = cluster.call_all('connect', *[([BASE_PORT + peer for peer in peers],) for peers in links])
+    handshake_sec = time() - start
+    handshakes = sum(result['success'] for result in connected)
+    degrees = [len(links[index]) + sum(index in peers for peers in links) for index in range(num)]
+    cluster.call_all('wait_users', *[(degree,) for degree in degrees])
+    status = cluster.call_all('status', *[()] * num)
+    rss_delta = sum(item['rss'] - result['rss_before'] for item, result in zip(status, connected))
+
+    # request/response latency and direct-cmd from node 0
+    latencies = cluster.call(0, 'ping', args.pings)
+    direct = cluster.call(0, 'direct', args.calls, args.batch)
+
+    # broadcast from node 0
+    before = sum(item['up'] for item in cluster.call_all('status', *[()] * num))
+    broadcast_latencies = cluster.call(0, 'broadcast', args.broadcasts, args.size)
+    sleep(args.settle)  # relays still running after first ACK
+    after = sum(item['up'] for item in cluster.call_all('status', *[()] * num))
+    collector = TraceCollector()
+    for traces in cluster.call_all('traces', *[()] * num):
+        collector.add_traces(traces)
+    coverage = collector.report(nodes=num)
+
+    return {
+        'nodes': num,
+        'degree': args.degree,
+        'connections': handshakes,
+        'handshake_per_sec': round(handshakes / handshake_sec, 1),
+        'memory_per_connection_kb': round(rss_delta / max(1, 2 * handshakes) / 1024, 1),
+        'rss_mean_mb': round(sum(item['rss'] for item in status) / num / 1024 / 1024, 1),
+        'ping': dict(count=args.pings, **percentiles(latencies)),
+        'direct_cmd': {
+            'calls': args.calls,
+            'batch': args.batch,
+            'single_calls_per_sec': round(args.calls / direct['single_sec'], 1),
+            'many_calls_per_sec': round(args.calls / direct['many_sec'], 1),
+        },
+        'broadcast': dict(
+            count=args.broadcasts,
+            size=args.size,
+            bytes_per_broadcast=round((after - before) / max(1, args.broadcasts)),
+            coverage_p50_ms=to_ms(coverage['coverage_p50']),
+            coverage_p99_ms=to_ms(coverage['coverage_p99']),
+            hops_max=coverage['hops_max'],
+            ack=percentiles(broadcast_latencies),
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nodes', type=int, default=8)
+    parser.add_argument('--degree', type=int, default=3, help="connections made by each node")
+    parser.add_argument('--pings', type=int, default=300)
+    parser.add_argument('--calls', type=int, default=1000, help="direct-cmd calls")
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--broadcasts', type=int, default=50)
+    parser.add_argument('--size', type=int, default=256, help="broadcast data bytes")
+    parser.add_argument('--settle', type=float, default=1.0, help="wait for broadcast relays")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    assert 2 <= args.nodes
+    random.seed(args.seed)
+    cluster = Cluster(args.nodes)
+    try:
+        print(json.dumps(bench(args, cluster)))
+    finally:
+        cluster.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+peer store startup time with many stored peers
+usage: python3 bench/bench_peer_store.py --peers 100000
+"""
+from p2p_python.tool.utils import PeerData
+from p2p_python.serializer import dump
+from time import time
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+
+
+def header(i, now):
+    return {
+        'name': f"Bench:{i}",
+        'client_ver': '3.0.5',
+        'network_ver': 12345,
+        'my_host_name': None,
+        'p2p_accept': True,
+        'p2p_udp_accept': True,
+        'p2p_port': 2000 + i % 60000,
+        'start_time': now,
+        'last_seen': now,
+    }
+
+
+def host_port(i):
+    return "10.{}.{}.{}".format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff), 2000 + i % 60000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--peers', type=int, default=100000)
+    parser.add_argument('--duplicate', type=int, default=3, help="records per peer in legacy file")
+    args = parser.parse_args()
+    now = int(time())
+    loop = asyncio.get_event_loop()
+    result = {'peers': args.peers}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # legacy append-only file, each peer is appended many times by stabilizer
+        path = os.path.join(tmp, 'peer.dat')
+        with open(path, mode='bw') as fp:
+            for _ in range(args.duplicate):
+                for i in range(args.peers):
+                    dump((host_port(i), header(i, now)), fp)
+        result['legacy_file_size'] = os.path.getsize(path)
+        start = time()
+        peers = PeerData(path)
+        result['legacy_load_sec'] = round(time() - start, 3)
+
+        # compaction to snapshot
+        start = time()
+        loop.run_until_complete(peers.flush())
+        result['compaction_sec'] = round(time() - start, 3)
+        peers.close()
+        result['snapshot_file_size'] = os.path.getsize(path)
+
+        # load from snapshot
+        start = time()
+        peers = PeerData(path)
+        result['snapshot_load_sec'] = round(time() - start, 3)
+        assert len(peers) == args.peers
+        peers.close()
+
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+many Peer2Peer nodes in one process on simulated network and virtual clock
+topology made by auto_stabilize_network and broadcast coverage
+usage: python3 bench/bench_sim.py --nodes 300 --degree 3 --stabilize 300 --broadcasts 20
+"""
+import asyncio
+from p2p_python.sim import VirtualClockLoop, SimNetwork
+asyncio.set_event_loop(VirtualClockLoop())  # before other modules bind the loop
+
+from p2p_python.utils import create_p2p_params
+from p2p_python.server import Peer2Peer, Peer2PeerCmd
+from statistics import mean, median
+from time import time
+import argparse
+import json
+import logging
+import math
+import random
+import tempfile
+
+NETWORK_VER = 97533
+P2P_PORT = 2000
+
+
+def coverage(start, arrivals, nodes) -> list:
+    """sorted virtual seconds until each node received, unreached nodes are infinite"""
+    delays = sorted(arrival - start for arrival in arrivals)
+    return delays + [float('inf')] * (nodes - len(delays))
+
+
+def percentile(values, ratio):
+    return values[max(0, math.ceil(ratio * len(values)) - 1)]
+
+
+def components(nodes) -> int:
+    """number of connected components of the connection graph"""
+    links = {p2p.core.transport.host: {user.get_host_port()[0] for user in p2p.core.user} for p2p in nodes}
+    unvisited = set(links)
+    count = 0
+    while unvisited:
+        count += 1
+        stack = [unvisited.pop()]
+        while stack:
+            for host in links[stack.pop()]:
+                if host in unvisited:
+                    unvisited.remove(host)
+                    stack.append(host)
+    return count
+
+
+async def bench(args, nodes, network: SimNetwork, arrivals: dict):
+    loop = asyncio.get_event_loop()
+
+    # bootstrap, all nodes connect to random earlier nodes at once
+    await asyncio.gather(*(
+        p2p.core.create_connection(peer.core.transport.host, P2P_PORT)
+        for index, p2p in enumerate(nodes)
+        for peer in random.sample(nodes[:index], min(index, args.degree))))
+    bootstrap_sec = loop.time()
+
+    # stabilizer works on virtual time
+    await asyncio.sleep(args.stabilize)
+    connections = [len(p2p.core.user) for p2p in nodes]
+
+    # broadcast from random nodes, tracer uses wall clock so arrivals are recorded on virtual clock
+    starts = dict()
+    for _ in range(args.broadcasts):
+        p2p = random.choice(nodes)
+        data = random.getrandbits(64)
+        starts[data] = loop.time()
+        arrivals[data] = [loop.time()]  # origin
+        try:
+            await p2p.send_command(Peer2PeerCmd.BROADCAST, data=data)
+        except Exception as e:
+            logging.debug(f"broadcast failed {e}")
+        await asyncio.sleep(args.interval)
+    await asyncio.sleep(args.settle)
+    delays = [coverage(starts[data], arrivals[data], len(nodes)) for data in starts]
+    p50 = [percentile(delay, 0.5) for delay in delays]
+    p99 = [percentile(delay, 0.99) for delay in delays]
+    reached = [sum(not math.isinf(x) for x in delay) / len(nodes) for delay in delays]
+
+    return {
+        'nodes': len(nodes),
+        'latency': args.latency,
+        'loss': args.loss,
+        'bootstrap_sec': round(bootstrap_sec, 2),
+        'connections_mean': round(mean(connections), 2),
+        'connections_min': min(connections),
+        'connections_max': max(connections),
+        'components': components(nodes),
+        'broadcasts': args.broadcasts,
+        'coverage_p50': round(median(p50), 3),  # inf if not reached
+        'coverage_p99': round(median(p99), 3),
+        'reached_min': round(min(reached), 4),
+        'network': network.counter,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nodes', type=int, default=300)
+    parser.add_argument('--degree', type=int, default=3, help="bootstrap connections of each node")
+    parser.add_argument('--listen', type=int, default=15, help="backlog of each node")
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--bandwidth', type=float, default=0, help="uplink bytes/s, 0 is unlimited")
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--stabilize', type=float, default=300.0, help="virtual seconds of stabilizer")
+    parser.add_argument('--broadcasts', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=1.0, help="virtual seconds between broadcasts")
+    parser.add_argument('--settle', type=float, default=10.0, help="virtual seconds after broadcasts")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.ERROR)
+
+    loop = asyncio.get_event_loop()
+    network = SimNetwork(latency=args.latency, bandwidth=args.bandwidth, loss=args.loss, seed=args.seed)
+    nodes = list()
+    arrivals = dict()  # {data: [virtual time,..]}
+
+    def broadcast_check(user, data):
+        arrivals.setdefault(data, list()).append(loop.time())
+        return True
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for index in range(args.nodes):
+            config = create_p2p_params(
+                NETWORK_VER, P2P_PORT, p2p_accept=True, p2p_udp_accept=True, sub_dir=str(index), root_dir=tmp)
+            transport = network.create_transport()
+            config.LOCAL_IP, config.GLOBAL_IPV4, config.GLOBAL_IPV6 = transport.host, '', ''  # no discovery
+            p2p = Peer2Peer(listen=args.listen, config=config, transport=transport)
+            p2p.broadcast_check = broadcast_check
+            p2p.setup()
+            nodes.append(p2p)
+        start = time()
+        result = loop.run_until_complete(bench(args, nodes, network, arrivals))
+        result['wall_sec'] = round(time() - start, 2)
+        for p2p in nodes:
+            p2p.close()
+        loop.run_until_complete(asyncio.sleep(1.0))
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
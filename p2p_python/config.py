@@ -15,6 +15,39 @@ class V:
     # setting
     TOR_CONNECTION = None  # proxy (host, port)
     MY_HOST_NAME = None  # optional: example.com
+    LOCAL_IP = None  # optional: skip discovery of my address
+    GLOBAL_IPV4 = None
+    GLOBAL_IPV6 = None
+    REQUEST_BACKLOG = 5000  # requests waiting for running ones, new requests are dropped if full
+
+
+class Config(object):
+    """per node setting with the same names as `V`, many nodes can run in a process"""
+    __slots__ = (
+        "DATA_PATH",
+        "CLIENT_VER",
+        "SERVER_NAME",
+        "NETWORK_VER",
+        "P2P_PORT",
+        "P2P_ACCEPT",
+        "P2P_UDP_ACCEPT",
+        "TOR_CONNECTION",
+        "MY_HOST_NAME",
+        "LOCAL_IP",
+        "GLOBAL_IPV4",
+        "GLOBAL_IPV6",
+        "REQUEST_BACKLOG",
+    )
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.pop(name, None))
+        if self.REQUEST_BACKLOG is None:
+            self.REQUEST_BACKLOG = V.REQUEST_BACKLOG
+        assert len(kwargs) == 0, f"unknown setting {list(kwargs)}"
+
+    def __repr__(self):
+        return f"<Config {self.SERVER_NAME} {self.NETWORK_VER} {self.P2P_PORT}>"
 
 
 class Debug:
@@ -29,6 +62,7 @@ class PeerToPeerError(Exception):
 
 __all__ = [
     "V",
+    "Config",
     "Debug",
     "PeerToPeerError",
 ]
@@ -1,14 +1,15 @@
-from p2p_python.config import V, Debug, PeerToPeerError
+from p2p_python.config import V, Config, Debug, PeerToPeerError
 from p2p_python.user import UserHeader, User
 from p2p_python.serializer import dumps
 from p2p_python.tool.traffic import Traffic
-from p2p_python.tool.utils import AESCipher
-from ecdsa.keys import SigningKey, VerifyingKey
-from ecdsa.curves import NIST256p
-from typing import Optional, Dict, List
+from p2p_python.tool.utils import AESCipher, ChangeLog
+from p2p_python.tool.metrics import BoundMetric
+from p2p_python.tool.timing import StageTimer
+from p2p_python.transport import Transport, TcpTransport, BUFFER_SIZE
+from typing import TYPE_CHECKING, Optional, Dict, List, Set
 from logging import getLogger
 from binascii import a2b_hex
-from time import time
+from time import time, perf_counter
 from io import BytesIO
 from hashlib import sha256
 from expiringdict import ExpiringDict
@@ -17,31 +18,26 @@ import asyncio
 import json
 import random
 import socket
-import socks
 import zlib
 
+if TYPE_CHECKING:
+    from ecdsa.keys import SigningKey
 
 # socket direction
 INBOUND = 'inbound'
 OUTBOUND = 'outbound'
+ACCEPT_SIGNAL_SIZE = 32  # IV and one block of encrypted b'accept'
 
 log = getLogger(__name__)
 loop = asyncio.get_event_loop()
-tcp_servers: List[asyncio.AbstractServer] = list()
-udp_servers: List[socket.socket] = list()
-ban_address = list()  # deny connection address
-BUFFER_SIZE = 8192
-socket2name = {
-    socket.AF_INET: "ipv4",
-    socket.AF_INET6: "ipv6",
-    socket.AF_UNSPEC: "ipv4/6",
-}
+ban_address = list()  # deny connection address, shared by nodes of the default config `V`
 
 
 class Core(object):
 
-    def __init__(self, host=None, listen=15):
-        assert V.DATA_PATH is not None, 'Setup p2p params before CoreClass init.'
+    def __init__(self, host=None, listen=15, transport: Optional[Transport] = None, config: Optional[Config] = None):
+        self.config = config or V  # node setting
+        assert self.config.DATA_PATH is not None, 'Setup p2p params before CoreClass init.'
         assert host is None or host == 'localhost'
         # status params
         self.f_stop = False
@@ -51,25 +47,35 @@ class Core(object):
         self.start_time = int(time())
         self.number = 0
         self.user: List[User] = list()
+        self.user_changes = ChangeLog()  # connection or user header changed
+        self.user_event = asyncio.Event()  # set when connection opened or closed
+        # request only connections (DHT), not used for broadcast, peer list and stabilizer
+        self.temporary: Set[User] = set()
         self.user_lock = asyncio.Lock()
         self.host = host  # local=>'localhost', 'global'=>None
         self.core_que = asyncio.Queue()
         self.backlog = listen
+        self.ban_address = ban_address if self.config is V else list()  # deny connection address
+        self.transport = transport or TcpTransport()  # SimTransport on simulation
         self.traffic = Traffic()
         self.ping_status: Dict[int, asyncio.Event] = ExpiringDict(max_len=5000, max_age_seconds=900)
+        # metrics, no-op if disabled, labeled by node name to distinguish nodes in a process
+        self.metrics_labels = {'node': self.config.SERVER_NAME}
+        self.handshake_time = BoundMetric(
+            'histogram', 'p2p_handshake_seconds', 'connection handshake time', ('direction',), self.metrics_labels)
+        self.timing = StageTimer(self.metrics_labels)  # sampled pipeline stages, disabled by default
+
+    @property
+    def user_version(self):
+        return self.user_changes.version
 
     def close(self):
         if not self.f_running:
             raise Exception('Core is not running')
         self.traffic.close()
-        for user in self.user.copy():
+        for user in self.user.copy() + list(self.temporary):
             self.remove_connection(user, 'manual closing')
-        for sock in tcp_servers:
-            sock.close()
-            asyncio.ensure_future(sock.wait_closed())
-        for sock in udp_servers:
-            loop.remove_reader(sock.fileno())
-            sock.close()
+        self.transport.close()
         self.f_stop = True
 
     async def ping(self, user: User, f_udp=False):
@@ -96,67 +102,41 @@ class Core(object):
     def start(self, s_family=socket.AF_UNSPEC):
         assert s_family in (socket.AF_INET, socket.AF_INET6, socket.AF_UNSPEC)
         # setup TCP/UDP socket server
-        setup_all_socket_server(core=self, s_family=s_family)
-        # listen socket ipv4/ipv6
-        log.info(f"setup socket server "
-                 f"tcp{len(tcp_servers)}={V.P2P_ACCEPT} udp{len(udp_servers)}={V.P2P_UDP_ACCEPT}")
+        self.transport.start(self, s_family)
         self.f_running = True
 
     def get_my_user_header(self):
         """return my UserHeader format dict"""
         return {
-            'name': V.SERVER_NAME,
-            'client_ver': V.CLIENT_VER,
-            'network_ver': V.NETWORK_VER,
-            'my_host_name': V.MY_HOST_NAME,
-            'p2p_accept': V.P2P_ACCEPT,
-            'p2p_udp_accept': V.P2P_UDP_ACCEPT,
-            'p2p_port': V.P2P_PORT,
+            'name': self.config.SERVER_NAME,
+            'client_ver': self.config.CLIENT_VER,
+            'network_ver': self.config.NETWORK_VER,
+            'my_host_name': self.config.MY_HOST_NAME,
+            'p2p_accept': self.config.P2P_ACCEPT,
+            'p2p_udp_accept': self.config.P2P_UDP_ACCEPT,
+            'p2p_port': self.config.P2P_PORT,
             'start_time': self.start_time,
             'last_seen': int(time()),
         }
 
     async def create_connection(self, host, port) -> bool:
         """create connection without exception"""
+        return await self._connect(host, port, False) is not None
+
+    async def create_temporary_connection(self, host, port) -> Optional[User]:
+        """create request only connection without exception, the peer accepts it as temporary too"""
+        return await self._connect(host, port, True)
+
+    async def _connect(self, host, port, f_temporary) -> Optional[User]:
         if self.f_stop:
-            return False
-        # get connection list
-        future: asyncio.Future = loop.run_in_executor(
-            None, socket.getaddrinfo, host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+            return None
+        start = time()
         try:
-            await asyncio.wait_for(future, 10.0)
-            address_infos = future.result()
-        except (asyncio.TimeoutError, socket.gaierror):
-            return False
-        # try to connect one by one
-        for af, socktype, proto, canonname, host_port in address_infos:
-            if host_port[0] in ban_address:
-                return False  # baned address
-            try:
-                if V.TOR_CONNECTION:
-                    if af != socket.AF_INET:
-                        continue
-                    sock = socks.socksocket()
-                    sock.setproxy(socks.PROXY_TYPE_SOCKS5, V.TOR_CONNECTION[0], V.TOR_CONNECTION[1])
-                else:
-                    sock = socket.socket(af, socktype, proto)
-                future: asyncio.Future = loop.run_in_executor(
-                    None, sock.connect, host_port)
-                await asyncio.wait_for(future, 10.0)
-                future.result()  # raised exception of socket
-                sock.setblocking(False)
-                reader, writer = await asyncio.open_connection(sock=sock, loop=loop)
-                break
-            except asyncio.TimeoutError:
-                continue  # try to connect but do not reach
-            except ConnectionRefusedError:
-                continue  # try to connect closed socket
-            except OSError as e:
-                log.debug(f"socket creation error by {str(e)}")
-                continue
-        else:
-            # create no connection
-            return False
+            reader, writer, host_port = await self.transport.open_connection(
+                host, port, self.ban_address, self.config.TOR_CONNECTION)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.debug(f"failed to connect {host}:{port} by {e}")
+            return None
         log.debug(f"success create connection to {host_port}")
 
         try:
@@ -169,7 +149,10 @@ class Core(object):
                 raise PeerToPeerError('timeout on first plain msg receive')
 
             # 2. send my header
-            send = json.dumps(self.get_my_user_header()).encode()
+            header = self.get_my_user_header()
+            if f_temporary:
+                header['temporary'] = True
+            send = json.dumps(header).encode()
             writer.write(send)
             await writer.drain()
             self.traffic.put_traffic_up(send)
@@ -209,9 +192,9 @@ class Core(object):
             new_user = User(user_header, self.number, reader, writer, host_port, aeskey, OUTBOUND)
 
             # 7. check header
-            if new_user.header.network_ver != V.NETWORK_VER:
+            if new_user.header.network_ver != self.config.NETWORK_VER:
                 raise PeerToPeerError('Don\'t same network version [{}!={}]'.format(
-                    new_user.header.network_ver, V.NETWORK_VER))
+                    new_user.header.network_ver, self.config.NETWORK_VER))
             self.number += 1
 
             # 8. send accept signal
@@ -220,11 +203,21 @@ class Core(object):
             self.traffic.put_traffic_up(encrypted)
 
             # 9. accept connection
+            self.handshake_time.labels(OUTBOUND).observe(time() - start)
+            if f_temporary:
+                log.debug(f"established temporary connection to {new_user.header.name} {new_user.get_host_port()}")
+                self.temporary.add(new_user)
+                asyncio.ensure_future(self.receive_loop(new_user))
+                return new_user
             log.info(f"established connection as client to {new_user.header.name} {new_user.get_host_port()}")
             asyncio.ensure_future(self.receive_loop(new_user))
             # server port's reachable check
             asyncio.ensure_future(self.check_reachable(new_user))
-            return True
+            return new_user
+        except asyncio.CancelledError:
+            log.debug(f"cancelled connection to {host_port}")
+            writer.close()
+            raise
         except PeerToPeerError as e:
             msg = "peer2peer error, {} ({})".format(e, host)
         except ConnectionRefusedError as e:
@@ -239,14 +232,20 @@ class Core(object):
         log.debug(msg)
         if not writer.transport.is_closing():
             writer.close()
-        return False
+        return None
 
     def remove_connection(self, user: User, reason: str) -> bool:
         if user is None:
             return False
         user.close()
-        if user in self.user:
+        if user in self.temporary:
+            self.temporary.discard(user)
+            log.debug(f"remove temporary connection of {user} by '{reason}'")
+            return True
+        elif user in self.user:
             self.user.remove(user)
+            self.user_changes.bump(user.get_host_port())
+            self.user_event.set()
             if 0 < user.score:
                 log.info(f"remove connection of {user} by '{reason}'")
             else:
@@ -258,42 +257,51 @@ class Core(object):
     async def send_msg_body(self, msg_body, user: Optional[User] = None, allow_udp=False, f_pro_force=False):
         assert isinstance(msg_body, bytes), 'msg_body is bytes'
 
-        # check user existence
-        if len(self.user) == 0:
-            raise PeerToPeerError('there is no user connection')
         # select random user
         if user is None:
+            if len(self.user) == 0:
+                raise PeerToPeerError('there is no user connection')
             user = random.choice(self.user)
 
         # send message
         if allow_udp and f_pro_force:
-            loop.run_in_executor(None, self.send_udp_body, msg_body, user)
+            self.send_udp_body(msg_body, user)
         elif allow_udp and user.header.p2p_udp_accept and len(msg_body) < 1400:
-            loop.run_in_executor(None, self.send_udp_body, msg_body, user)
+            self.send_udp_body(msg_body, user)
         else:
+            sampled = self.timing.enabled and self.timing.sample()
+            if sampled:
+                lap_time = perf_counter()
             msg_body = zlib.compress(msg_body)
+            if sampled:
+                lap_time = self.timing.lap('send_compress', lap_time)
             msg_body = AESCipher.encrypt(key=user.aeskey, raw=msg_body)
+            if sampled:
+                lap_time = self.timing.lap('send_encrypt', lap_time)
             msg_len = len(msg_body).to_bytes(4, 'big')
             send_data = msg_len + msg_body
             await user.send(send_data)
-            self.traffic.put_traffic_up(send_data)
+            if sampled:
+                self.timing.lap('send_write', lap_time)
+            self.traffic.put_traffic_up(send_data, user)
         return user
 
     def send_udp_body(self, msg_body, user):
         """send UDP message"""
-        name_len = len(V.SERVER_NAME.encode()).to_bytes(1, 'big')
+        name = self.config.SERVER_NAME.encode()
         msg_body = AESCipher.encrypt(key=user.aeskey, raw=msg_body)
-        send_data = name_len + V.SERVER_NAME.encode() + msg_body
-        host_port = user.get_host_port()
-        sock_family = socket.AF_INET if len(host_port) == 2 else socket.AF_INET6
-        # warning: may block this closure, use run_in_executor
-        with socket.socket(sock_family, socket.SOCK_DGRAM) as sock:
-            sock.sendto(send_data, host_port)
-        self.traffic.put_traffic_up(send_data)
+        send_data = len(name).to_bytes(1, 'big') + name + msg_body
+        self.transport.send_datagram(send_data, user.get_host_port())
+        self.traffic.put_traffic_up(send_data, user)
+
+    def datagram_received(self, data, addr):
+        """UDP message from transport"""
+        asyncio.ensure_future(udp_server_handle(data, addr, self))
 
     async def initial_connection_check(self, reader: StreamReader, writer: StreamWriter):
         host_port = writer.get_extra_info('peername')
         new_user: Optional[User] = None
+        start = time()
         try:
             # 1. send plain message
             writer.write(b'hello')
@@ -305,6 +313,7 @@ class Core(object):
                 if len(received) == 0:
                     raise PeerToPeerError('empty msg receive')
                 header = json.loads(received.decode())
+                f_temporary = bool(header.pop('temporary', False))
             except asyncio.TimeoutError:
                 raise PeerToPeerError('timeout on other\'s header receive')
             except json.JSONDecodeError:
@@ -314,7 +323,7 @@ class Core(object):
             user_header = UserHeader(**header)
             new_user = User(user_header, self.number, reader, writer, host_port, AESCipher.create_key(), INBOUND)
             self.number += 1
-            if new_user.header.name == V.SERVER_NAME:
+            if new_user.header.name == self.config.SERVER_NAME:
                 raise ConnectionAbortedError('Same origin connection')
 
             # 4. send my public key
@@ -345,17 +354,25 @@ class Core(object):
             await new_user.send(encrypted)
             self.traffic.put_traffic_up(encrypted)
 
-            # 7. receive accept signal
+            # 7. receive accept signal, exact size because first message may follow soon
             try:
-                encrypted = await new_user.recv()
+                encrypted = await asyncio.wait_for(reader.readexactly(ACCEPT_SIGNAL_SIZE), 5.0)
                 self.traffic.put_traffic_down(encrypted)
             except asyncio.TimeoutError:
                 raise PeerToPeerError('timeout on accept signal receive')
+            except asyncio.IncompleteReadError:
+                raise ConnectionAbortedError('closed on accept signal receive')
             receive = AESCipher.decrypt(new_user.aeskey, encrypted)
             if receive != b'accept':
                 raise PeerToPeerError(f"Not accept signal! {receive}")
 
             # 8. accept connection
+            self.handshake_time.labels(INBOUND).observe(time() - start)
+            if f_temporary:
+                log.debug(f"established temporary connection from {new_user.header.name} {new_user.get_host_port()}")
+                self.temporary.add(new_user)
+                asyncio.ensure_future(self.receive_loop(new_user))
+                return
             log.info(f"established connection as server from {new_user.header.name} {new_user.get_host_port()}")
             asyncio.ensure_future(self.receive_loop(new_user))
             # server port's reachable check
@@ -387,31 +404,41 @@ class Core(object):
                 pass
 
     async def receive_loop(self, user: User):
-        # Accept connection
-        for check_user in self.user.copy():
-            if check_user.header.name != user.header.name:
-                continue
-            elif await self.ping(check_user):
-                error = f"same origin found and ping success, remove new connection"
-                self.remove_connection(user, error)
-                return
-            else:
-                error = f"same origin found but ping failed, remove old connection"
-                self.remove_connection(check_user, error)
-        self.user.append(user)
-        log.info(f"check success and go into loop {user}")
+        # Accept connection, temporary one is already in self.temporary and not a user
+        if user not in self.temporary:
+            for check_user in self.user.copy():
+                if check_user.header.name != user.header.name:
+                    continue
+                elif await self.ping(check_user):
+                    error = f"same origin found and ping success, remove new connection"
+                    self.remove_connection(user, error)
+                    return
+                else:
+                    error = f"same origin found but ping failed, remove old connection"
+                    self.remove_connection(check_user, error)
+            self.user.append(user)
+            self.user_changes.bump(user.get_host_port())
+            self.user_event.set()
+            log.info(f"check success and go into loop {user}")
 
         bio = BytesIO()  # Warning: don't use initial_bytes, same duplicate ID used?
         bio_length = 0
         msg_length = 0
         f_raise_timeout = False
         error = None
+        timing = self.timing
         while not self.f_stop:
             try:
-                get_msg = await user.recv()
-                if len(get_msg) == 0:
-                    error = "Fall in loop, socket closed."
-                    break
+                if 0 < msg_length <= bio_length:
+                    get_msg = b''  # next message is received with previous one
+                else:
+                    get_msg = await user.recv()
+                    if len(get_msg) == 0:
+                        error = "Fall in loop, socket closed."
+                        break
+                sampled = timing.enabled and timing.sample()
+                if sampled:
+                    lap_time = perf_counter()
 
                 # check message params init
                 bio_length += bio.write(get_msg)
@@ -454,9 +481,15 @@ class Core(object):
                     continue
 
                 # continue to process msg_body
-                self.traffic.put_traffic_down(msg_body)
+                if sampled:
+                    lap_time = timing.lap('recv_framing', lap_time)
+                self.traffic.put_traffic_down(msg_body, user)
                 msg_body = AESCipher.decrypt(key=user.aeskey, enc=msg_body)
+                if sampled:
+                    lap_time = timing.lap('recv_decrypt', lap_time)
                 msg_body = zlib.decompress(msg_body)
+                if sampled:
+                    timing.lap('recv_decompress', lap_time)
                 if msg_body.startswith(b'Ping:'):
                     uuid_bytes = msg_body.split(b':')[1]
                     log.debug(f"receive Ping from {user.header.name}")
@@ -500,21 +533,11 @@ class Core(object):
                     return
                 await asyncio.sleep(1.0)
             # try to check TCP
-            f_tcp = True
             host_port = new_user.get_host_port()
-            af = socket.AF_INET if len(host_port) == 2 else socket.AF_INET6
-            sock = socket.socket(af, socket.SOCK_STREAM)
-            sock.settimeout(3.0)
             try:
-                future: asyncio.Future = loop.run_in_executor(
-                    None, sock.connect_ex, host_port)
-                await asyncio.wait_for(future, 10.0)
-                result = future.result()
-                if result != 0:
-                    f_tcp = False
+                f_tcp = await asyncio.wait_for(self.transport.is_reachable(*host_port[:2]), 10.0)
             except (OSError, asyncio.TimeoutError):
                 f_tcp = False
-            loop.run_in_executor(None, sock.close)
             # try to check UDP
             f_udp = await self.ping(user=new_user, f_udp=True)
             f_changed = False
@@ -528,6 +551,7 @@ class Core(object):
                 new_user.header.p2p_udp_accept = f_udp
                 f_changed = True
             if f_changed:
+                self.user_changes.bump(host_port)
                 log.debug(f"{new_user} Change socket status tcp={f_tcp} udp={f_udp}")
         except Exception:
             log.error("check_reachable exception", exc_info=True)
@@ -544,6 +568,9 @@ class Core(object):
             new_user = self.host_port2user(host_port)
             if new_user:
                 new_user.neers = user.neers
+                new_user.neers_epoch = user.neers_epoch
+                new_user.neers_version = user.neers_version
+                new_user.neers_full_time = user.neers_full_time
                 new_user.score = user.score
                 new_user.warn = user.warn
             return True
@@ -564,17 +591,21 @@ class Core(object):
         return None
 
 
-"""ECDH functions
+"""ECDH functions, ecdsa is imported on first handshake
 """
 
 
-def generate_shared_key(sk, vk_str) -> bytes:
+def generate_shared_key(sk: 'SigningKey', vk_str) -> bytes:
+    from ecdsa.keys import VerifyingKey
+    from ecdsa.curves import NIST256p
     vk = VerifyingKey.from_string(a2b_hex(vk_str), NIST256p)
     point = sk.privkey.secret_multiplier * vk.pubkey.point
     return sha256(point.x().to_bytes(32, 'big')).digest()
 
 
-def generate_keypair() -> (SigningKey, str):
+def generate_keypair() -> ('SigningKey', str):
+    from ecdsa.keys import SigningKey
+    from ecdsa.curves import NIST256p
     sk = SigningKey.generate(NIST256p)
     vk = sk.get_verifying_key()
     return sk, vk.to_string().hex()
@@ -592,7 +623,7 @@ async def udp_server_handle(msg, addr, core: Core):
         user = core.name2user(msg_name.decode())
         if user is None:
             return
-        core.traffic.put_traffic_down(msg_body)
+        core.traffic.put_traffic_down(msg_body, user)
         msg_body = AESCipher.decrypt(key=user.aeskey, enc=msg_body)
         if msg_body.startswith(b'Ping:'):
             log.info(f"get udp ping from {user}")
@@ -609,66 +640,6 @@ async def udp_server_handle(msg, addr, core: Core):
         log.debug("UDP handle exception", exc_info=Debug.P_PRINT_EXCEPTION)
 
 
-def create_tcp_server(core: Core, family, host_port):
-    assert family == socket.AF_INET or family == socket.AF_INET6
-    coroutine = asyncio.start_server(
-        core.initial_connection_check, host_port[0], host_port[1],
-        family=family, backlog=core.backlog, loop=loop)
-    abstract_server = loop.run_until_complete(coroutine)
-    for sock in abstract_server.sockets:
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    return abstract_server
-
-
-def create_udp_server(core: Core, family, host_port):
-    assert family == socket.AF_INET or family == socket.AF_INET6
-    sock = socket.socket(family, socket.SOCK_DGRAM, 0)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.setblocking(False)
-    sock.bind(host_port)
-    fd = sock.fileno()
-
-    def listen():
-        try:
-            data, addr = sock.recvfrom(BUFFER_SIZE)
-            asyncio.ensure_future(udp_server_handle(data, addr, core))
-        except (BlockingIOError, InterruptedError):
-            pass
-        except Exception:
-            log.warning("UDP server exception", exc_info=True)
-    # UDP server is not stream
-    loop.add_reader(fd, listen)
-    return sock
-
-
-def setup_all_socket_server(core: Core, s_family):
-    # create new TCP socket server
-    log.info(f"try to setup server socket {core.host}:{V.P2P_PORT}")
-    if V.P2P_ACCEPT:
-        V.P2P_ACCEPT = False
-        for res in socket.getaddrinfo(core.host, V.P2P_PORT, s_family, socket.SOCK_STREAM, 0, socket.AI_PASSIVE):
-            af, sock_type, proto, canon_name, sa = res
-            try:
-                sock = create_tcp_server(core, af, sa)
-                log.debug(f"success tcp server creation af={socket2name.get(af)}")
-                tcp_servers.append(sock)
-                V.P2P_ACCEPT = True
-            except Exception:
-                log.debug("create tcp server exception", exc_info=True)
-    # create new UDP socket server
-    if V.P2P_UDP_ACCEPT:
-        V.P2P_UDP_ACCEPT = False
-        for res in socket.getaddrinfo(core.host, V.P2P_PORT, s_family, socket.SOCK_DGRAM, 0, socket.AI_PASSIVE):
-            af, sock_type, proto, canon_name, sa = res
-            try:
-                sock = create_udp_server(core, af, sa)
-                log.debug(f"success udp server creation af={socket2name.get(af)}")
-                udp_servers.append(sock)
-                V.P2P_UDP_ACCEPT = True
-            except Exception:
-                log.debug("create udp server exception", exc_info=True)
-
-
 __all__ = [
     "INBOUND",
     "OUTBOUND",
@@ -0,0 +1,367 @@
+from p2p_python.config import PeerToPeerError
+from p2p_python.serializer import dumps, loads
+from p2p_python.tool.store import TTLCache, DiskStore
+from logging import getLogger
+from typing import Dict, List, Tuple, Callable, Awaitable, Optional, Iterable
+from collections import OrderedDict, deque
+from hashlib import sha256
+from time import time
+import asyncio
+import heapq
+
+log = getLogger(__name__)
+
+ID_BITS = 160
+ID_BYTES = ID_BITS // 8
+K = 20  # bucket size and lookup result size
+ALPHA = 3  # parallel requests on lookup
+RPC_TIMEOUT = 10.0
+DEFAULT_TTL = 3600 * 24  # value lifetime
+MAX_TTL = 3600 * 24 * 7
+CACHE_TTL = 3600.0  # remote value cache
+REPUBLISH_MIN = 60.0  # do not republish soon expiring value
+
+# contact is (node_id, host_port)
+Contact = Tuple[int, tuple]
+
+
+def node_id(name: str) -> int:
+    """node id from server name or key"""
+    if isinstance(name, str):
+        name = name.encode()
+    return int.from_bytes(sha256(name).digest()[:ID_BYTES], 'big')
+
+
+def id2bytes(i: int) -> bytes:
+    return i.to_bytes(ID_BYTES, 'big')
+
+
+def bytes2id(b: bytes) -> int:
+    assert len(b) == ID_BYTES, 'wrong node id length'
+    return int.from_bytes(b, 'big')
+
+
+class RoutingTable(object):
+    """
+    k-buckets, bucket `i` has nodes which distance is [2^i, 2^(i+1))
+    old live contacts are kept, new contacts wait in replacement cache
+    """
+
+    def __init__(self, my_id: int, k=K):
+        self.my_id = my_id
+        self.k = k
+        self.buckets: List[OrderedDict] = [OrderedDict() for _ in range(ID_BITS)]  # [{node_id: host_port},..]
+        self.replacements: List[deque] = [deque(maxlen=k) for _ in range(ID_BITS)]  # [[contact,..],..]
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def __contains__(self, node_id):
+        return node_id in self.buckets[self.bucket_index(node_id)]
+
+    def bucket_index(self, node_id: int) -> int:
+        distance = self.my_id ^ node_id
+        assert 0 < distance, 'my node id'
+        return distance.bit_length() - 1
+
+    def add(self, node_id: int, host_port: tuple) -> bool:
+        """add or refresh contact, return True if in the table"""
+        if node_id == self.my_id:
+            return False
+        index = self.bucket_index(node_id)
+        bucket = self.buckets[index]
+        if node_id in bucket:
+            bucket[node_id] = tuple(host_port)
+            bucket.move_to_end(node_id)
+            return True
+        elif len(bucket) < self.k:
+            bucket[node_id] = tuple(host_port)
+            return True
+        else:
+            # bucket is full, keep old contact
+            replacement = self.replacements[index]
+            if (node_id, tuple(host_port)) not in replacement:
+                replacement.append((node_id, tuple(host_port)))
+            return False
+
+    def remove(self, node_id: int):
+        """remove dead contact and fill by replacement"""
+        if node_id == self.my_id:
+            return
+        index = self.bucket_index(node_id)
+        bucket = self.buckets[index]
+        if bucket.pop(node_id, None) is not None:
+            replacement = self.replacements[index]
+            while 0 < len(replacement) and len(bucket) < self.k:
+                new_id, host_port = replacement.pop()
+                if new_id not in bucket:
+                    bucket[new_id] = host_port
+
+    def get(self, node_id: int) -> Optional[tuple]:
+        if node_id == self.my_id:
+            return None
+        return self.buckets[self.bucket_index(node_id)].get(node_id)
+
+    def closest(self, target: int, num=None, exclude: Iterable[int] = ()) -> List[Contact]:
+        """contacts sorted by distance to the target"""
+        exclude = set(exclude)
+        contacts = ((node_id, host_port) for bucket in self.buckets
+                    for node_id, host_port in bucket.items() if node_id not in exclude)
+        return heapq.nsmallest(num or self.k, contacts, key=lambda x: x[0] ^ target)
+
+    def getinfo(self):
+        return {
+            'node_id': id2bytes(self.my_id).hex(),
+            'contacts': len(self),
+            'buckets': sum(1 for bucket in self.buckets if 0 < len(bucket)),
+            'replacements': sum(len(replacement) for replacement in self.replacements),
+        }
+
+
+class DHT(object):
+    """
+    kademlia style routed lookup and key-value store
+    params:
+        my_id: (int) my node id
+        rpc: (coroutine function) `rpc(host_port, target) -> [(node_id, host_port),..]`
+            ask the node for contacts close to the target, raise exception on failure
+        find_value_rpc: (coroutine function) `find_value_rpc(host_port, target) -> {'value', 'ttl'} or contacts`
+        store_rpc: (coroutine function) `store_rpc(host_port, target, value, ttl) -> bool`
+        store: (DiskStore) local values, required by put/get
+        k: (int) bucket size, lookup result size and number of replicas
+        alpha: (int) parallel requests on lookup
+    """
+
+    def __init__(self, my_id: int, rpc: Callable[[tuple, int], Awaitable[List[Contact]]],
+                 find_value_rpc=None, store_rpc=None, store: Optional[DiskStore] = None,
+                 k=K, alpha=ALPHA, timeout=RPC_TIMEOUT, cache_len=1000):
+        self.my_id = my_id
+        self.table = RoutingTable(my_id, k)
+        self.rpc = rpc
+        self.find_value_rpc = find_value_rpc
+        self.store_rpc = store_rpc
+        self.store = store
+        self.cache = TTLCache(cache_len)  # {node_id: value}
+        self.k = k
+        self.alpha = alpha
+        self.timeout = timeout
+        self.lookup_count = 0
+        self.rpc_count = 0
+        self.rpc_failure = 0
+        self.last_lookup = 0.0
+        self._republish: List[tuple] = list()  # [(time, node_id),..] heap of origin values
+
+    def getinfo(self):
+        info = self.table.getinfo()
+        info.update({
+            'lookup': self.lookup_count,
+            'rpc': self.rpc_count,
+            'rpc_failure': self.rpc_failure,
+            'last_lookup': self.last_lookup,
+            'cache': len(self.cache),
+            'store': self.store.getinfo() if self.store else None,
+        })
+        return info
+
+    def add_contacts(self, contacts: Iterable[Contact]):
+        for node_id, host_port in contacts:
+            self.table.add(node_id, host_port)
+
+    def find_closest(self, target: int, num=None) -> List[Contact]:
+        """answer of FIND_NODE request, only local routing table"""
+        return self.table.closest(target, num)
+
+    async def lookup(self, target: int) -> Tuple[List[Contact], int]:
+        """
+        iterative FIND_NODE lookup, ask `alpha` closest unqueried nodes at once
+        return ([(node_id, host_port),..] k closest live contacts, number of hops)
+        """
+        contacts, hops, _ = await self._iterative_lookup(target, False)
+        return contacts, hops
+
+    async def _iterative_lookup(self, target: int, f_value: bool) -> Tuple[List[Contact], int, Optional[dict]]:
+        self.lookup_count += 1
+        self.last_lookup = time()
+        candidates: Dict[int, tuple] = dict(self.table.closest(target))
+        queried = set()
+        alive = set()
+        hops = 0
+        found = None
+        while found is None:
+            # k closest candidates, stop if all of them are asked
+            closest = heapq.nsmallest(self.k, candidates.keys(), key=lambda x: x ^ target)
+            asking = [node_id for node_id in closest if node_id not in queried][:self.alpha]
+            if len(asking) == 0:
+                break
+            hops += 1
+            queried.update(asking)
+            results = await asyncio.gather(
+                *(self._ask(candidates[node_id], target, f_value) for node_id in asking), return_exceptions=True)
+            for asked_id, result in zip(asking, results):
+                if isinstance(result, BaseException):
+                    # dead or unreachable contact
+                    self.rpc_failure += 1
+                    self.table.remove(asked_id)
+                    del candidates[asked_id]
+                    continue
+                alive.add(asked_id)
+                self.table.add(asked_id, candidates[asked_id])
+                if isinstance(result, dict):
+                    found = result  # FIND_VALUE hit
+                    continue
+                for node_id, host_port in result:
+                    if node_id != self.my_id and node_id not in candidates:
+                        candidates[node_id] = host_port
+                        self.table.add(node_id, host_port)
+            if not f_value and target in alive:
+                break  # found the node itself
+        closest = heapq.nsmallest(self.k, alive, key=lambda x: x ^ target)
+        return [(node_id, candidates[node_id]) for node_id in closest], hops, found
+
+    async def join(self) -> int:
+        """lookup my id once connected, nodes close to me learn me, return number of them"""
+        contacts, _ = await self.lookup(self.my_id)
+        return len(contacts)
+
+    async def find_node(self, target: int) -> Optional[tuple]:
+        """host_port of the node, None if not found"""
+        host_port = self.table.get(target)
+        if host_port is not None:
+            return host_port
+        contacts, _ = await self.lookup(target)
+        for node_id, host_port in contacts:
+            if node_id == target:
+                return host_port
+        return None
+
+    async def put(self, key, value, ttl=DEFAULT_TTL) -> int:
+        """store the value to k closest nodes and republish until expired, return number of replicas"""
+        assert self.store is not None and self.store_rpc is not None, 'DHT store is not setup'
+        ttl = min(ttl, MAX_TTL)
+        target = node_id(key)
+        if not await self._save(target, value, time() + ttl, f_origin=True):
+            raise PeerToPeerError('local DHT store is full')
+        self._schedule_republish(target, ttl)
+        return await self._replicate(target, value, ttl)
+
+    async def get(self, key):
+        """find the value by FIND_VALUE lookup, None if not found"""
+        assert self.store is not None and self.find_value_rpc is not None, 'DHT store is not setup'
+        target = node_id(key)
+        local = self.get_local(target)
+        if local is not None:
+            return local[0]
+        _, _, found = await self._iterative_lookup(target, True)
+        if found is None:
+            return None
+        self.cache.put(target, found['value'], min(float(found['ttl']), CACHE_TTL))
+        return found['value']
+
+    def get_local(self, target: int) -> Optional[tuple]:
+        """(value, ttl) from cache or disk"""
+        if target in self.cache:
+            return self.cache.get(target), self.cache.ttl(target)
+        item = self.store.get(id2bytes(target).hex()) if self.store else None
+        if item is None:
+            return None
+        data, expire, _ = item
+        value, ttl = loads(data), expire - time()
+        self.cache.put(target, value, min(ttl, CACHE_TTL))
+        return value, ttl
+
+    async def handle_store(self, target: int, value, ttl) -> bool:
+        """answer of STORE request, my own value is not overwritten"""
+        if self.store is None or not 0 < ttl:
+            return False
+        return await self._save(target, value, time() + min(ttl, MAX_TTL), f_origin=False)
+
+    def handle_find_value(self, target: int):
+        """answer of FIND_VALUE request, {'value', 'ttl'} or closest contacts"""
+        local = self.get_local(target)
+        if local is not None:
+            return {'value': local[0], 'ttl': int(local[1])}
+        return self.find_closest(target)
+
+    async def republish(self) -> int:
+        """republish own values which are due, return number of republished"""
+        count = 0
+        while 0 < len(self._republish) and self._republish[0][0] <= time():
+            _, target = heapq.heappop(self._republish)
+            item = self.store.get(id2bytes(target).hex())
+            if item is None or not item[2]:
+                continue  # expired or overwritten
+            data, expire, _ = item
+            ttl = expire - time()
+            if ttl < REPUBLISH_MIN:
+                continue
+            try:
+                await self._replicate(target, loads(data), ttl)
+                count += 1
+            except Exception:
+                log.debug("DHT republish exception", exc_info=True)
+            self._schedule_republish(target, ttl)
+        return count
+
+    async def republish_loop(self):
+        """republish own values, run until cancelled"""
+        if self.store is None:
+            return
+        for name in self.store.origin_names():
+            item = self.store.index[name]
+            self._schedule_republish(bytes2id(bytes.fromhex(name)), item[0] - time(), f_soon=True)
+        while True:
+            next_time = self._republish[0][0] if self._republish else time() + 60.0
+            await asyncio.sleep(min(60.0, max(1.0, next_time - time())))
+            if await self.republish():
+                log.debug(f"DHT republished, wait {len(self._republish)} values")
+            self.store.cleanup()
+
+    async def _save(self, target: int, value, expire: float, f_origin: bool) -> bool:
+        name = id2bytes(target).hex()
+        old = self.store.index.get(name)
+        if old and old[2] and not f_origin and time() < old[0]:
+            return False  # others' STORE must not hijack my value
+        self.cache.pop(target)
+        return await self.store.put_async(name, dumps(value), expire, f_origin)
+
+    def _schedule_republish(self, target: int, ttl: float, f_soon=False):
+        if REPUBLISH_MIN <= ttl:
+            delay = REPUBLISH_MIN if f_soon else max(REPUBLISH_MIN, ttl / 2)
+            heapq.heappush(self._republish, (time() + delay, target))
+
+    async def _replicate(self, target: int, value, ttl) -> int:
+        contacts, _ = await self.lookup(target)
+        results = await asyncio.gather(
+            *(self._store(host_port, target, value, ttl) for _, host_port in contacts), return_exceptions=True)
+        return sum(1 for result in results if result is True)
+
+    async def _store(self, host_port, target, value, ttl) -> bool:
+        self.rpc_count += 1
+        return await asyncio.wait_for(self.store_rpc(host_port, target, value, int(ttl)), self.timeout)
+
+    async def _ask(self, host_port, target, f_value=False):
+        self.rpc_count += 1
+        if f_value:
+            result = await asyncio.wait_for(self.find_value_rpc(host_port, target), self.timeout)
+            if isinstance(result, dict):
+                if 'value' not in result or 'ttl' not in result:
+                    raise PeerToPeerError(f"unexpected FIND_VALUE response {result}")
+                return result
+        else:
+            result = await asyncio.wait_for(self.rpc(host_port, target), self.timeout)
+        if not isinstance(result, (list, tuple)):
+            raise PeerToPeerError(f"unexpected FIND_NODE response {result}")
+        return result
+
+
+__all__ = [
+    "ID_BITS",
+    "K",
+    "ALPHA",
+    "DEFAULT_TTL",
+    "node_id",
+    "id2bytes",
+    "bytes2id",
+    "RoutingTable",
+    "DHT",
+]
@@ -9,6 +9,18 @@ def dumps(obj, default=None):
     return msgpack.packb(obj, use_bin_type=True, default=default)
 
 
+def dumps_with_packed(obj: dict, packed: dict, default=None):
+    """dump dict with values already packed, {key: packed bytes}"""
+    packer = msgpack.Packer(use_bin_type=True, default=default)
+    items = [(key, value) for key, value in obj.items() if key not in packed]
+    b = packer.pack_map_header(len(items) + len(packed))
+    for key, value in items:
+        b += packer.pack(key) + packer.pack(value)
+    for key, value in packed.items():
+        b += packer.pack(key) + value
+    return b
+
+
 def load(fp, object_hook=None):
     return msgpack.unpack(fp, object_hook=object_hook, encoding='utf8')
 
@@ -24,6 +36,7 @@ def stream_unpacker(fp, object_hook=None):
 __all__ = [
     "dump",
     "dumps",
+    "dumps_with_packed",
     "load",
     "loads",
     "stream_unpacker",
@@ -1,14 +1,25 @@
 from p2p_python.tool.utils import *
-from p2p_python.tool.upnpc import *
-from p2p_python.config import V, Debug, PeerToPeerError
-from p2p_python.core import Core, ban_address
-from p2p_python.utils import is_reachable
-from p2p_python.user import User
+from p2p_python.tool.plumtree import PlumTree
+from p2p_python.tool.bloom import RotatingBloomFilter
+from p2p_python.tool.score import ScoreIndex, weighted_order
+from p2p_python.tool.dialer import Dialer
+from p2p_python.tool.store import DiskStore
+from p2p_python.tool.traffic import UP, DOWN
+from p2p_python.tool.trace import BroadcastTracer
+from p2p_python.tool.discovery import AddressDiscovery
+from p2p_python.tool.metrics import BoundMetric, Registry, register_instance, unregister_instance
+from p2p_python.dht import DHT, node_id, id2bytes, bytes2id
+from p2p_python.config import V, Config, Debug, PeerToPeerError
+from p2p_python.core import Core, INBOUND, OUTBOUND
+from p2p_python.transport import Transport
+from p2p_python.user import UserHeader, User
 from p2p_python.serializer import *
 from expiringdict import ExpiringDict
-from time import time
+from time import time, perf_counter
 from logging import getLogger
 from typing import Dict, List, Set, Optional
+from concurrent.futures import Executor
+from collections import deque
 import asyncio
 import os.path
 import random
@@ -17,19 +28,24 @@ import socket
 
 log = getLogger(__name__)
 loop = asyncio.get_event_loop()
-loop_futures: List[asyncio.Future] = list()
-LOCAL_IP = get_localhost_ip()
-GLOBAL_IPV4 = get_global_ip()
-GLOBAL_IPV6 = get_global_ip_ipv6()
+# my addresses, None until discovered by nodes of the default config `V`
+# not exported by `import *`, read `p2p.discovery.addresses` instead
+LOCAL_IP: Optional[str] = None
+GLOBAL_IPV4: Optional[str] = None
+GLOBAL_IPV6: Optional[str] = None
 STICKY_LIMIT = 2
+JOIN_CANDIDATES = 8  # random pick weighted by score and quality from top score peers
+REMOVE_CANDIDATES = 3
 TIMEOUT = 10.0
+STABILIZE_DEBOUNCE = 1.0  # gather burst of connection changes
+RESPONSE_CACHE_AGE = 30.0  # refresh last_seen of cached peer list
 
 # Constant type
 T_REQUEST = 'request'
 T_RESPONSE = 'response'
 T_ACK = 'ack'
 
-# stabilize objects
+# stabilize objects, shared by nodes of the default config `V`
 user_score: Dict[tuple, int] = dict()
 sticky_peers: Set[tuple] = set()
 ignore_peers = set()
@@ -43,12 +59,27 @@ class Peer2PeerCmd:
     GET_NEARS = 'get-nears'  # ピアリストを取得
     CHECK_REACHABLE = 'check-reachable'  # 外部からServerに到達できるかチェック
     DIRECT_CMD = 'direct-cmd'  # 隣接ノードに直接CMDを打つ
+    # broadcast tree control (Plumtree)
+    IHAVE = 'ihave'  # 受信済みbroadcastのuuidを通知
+    GRAFT = 'graft'  # 未受信broadcastを要求しtreeに接続
+    PRUNE = 'prune'  # 重複したlinkをtreeから外す
+    # routed lookup (DHT)
+    FIND_NODE = 'find-node'  # 目的のnode idに近いノードを取得
+    FIND_VALUE = 'find-value'  # 値を取得、無ければkeyに近いノードを取得
+    STORE = 'store'  # 値を保存
+
+
+# commands accepted from temporary connection of DHT lookup
+TEMPORARY_CMDS = (Peer2PeerCmd.FIND_NODE, Peer2PeerCmd.FIND_VALUE, Peer2PeerCmd.STORE)
 
 
 class Peer2Peer(object):
 
-    def __init__(self, listen=15, f_local=False, default_hook=None, object_hook=None):
-        assert V.DATA_PATH is not None, 'Setup p2p params before PeerClientClass init.'
+    def __init__(self, listen=15, f_local=False, f_plumtree=False, f_ack_aggregate=False,
+                 default_hook=None, object_hook=None, transport: Optional[Transport] = None,
+                 config: Optional[Config] = None, seen_capacity=100000, seen_error_rate=1e-6):
+        self.config = config or V  # node setting, `V` is the process default
+        assert self.config.DATA_PATH is not None, 'Setup p2p params before PeerClientClass init.'
 
         # object control params
         self.f_stop = False
@@ -56,35 +87,124 @@ class Peer2Peer(object):
         self.f_running = False
 
         # co-objects
-        self.core = Core(host='localhost' if f_local else None, listen=listen)
-        self.peers = PeerData(os.path.join(V.DATA_PATH, 'peer.dat'))  # {(host, port): header,..}
+        self.core = Core(host='localhost' if f_local else None, listen=listen, transport=transport, config=config)
+        self.peers = PeerData(os.path.join(self.config.DATA_PATH, 'peer.dat'))  # {(host, port): header,..}
         self.event = EventIgnition()  # DirectCmdを受け付ける窓口
+        self.dialer = Dialer(self.core.create_connection, concurrency=4)  # parallel connect by stabilizer
+        self.dht = DHT(  # routing table fed by stabilizer
+            node_id(self.config.SERVER_NAME), self._find_node_rpc, self._find_value_rpc, self._store_rpc,
+            store=DiskStore(os.path.join(self.config.DATA_PATH, 'dht')))
+        self.temporary_users: Dict[tuple, list] = dict()  # {host_port: [future of user, requests]} core.temporary
+
+        # stabilize objects, nodes of the default config `V` share module level ones
+        if self.config is V:
+            self.user_score, self.sticky_peers, self.ignore_peers = user_score, sticky_peers, ignore_peers
+        else:
+            self.user_score: Dict[tuple, int] = dict()
+            self.sticky_peers: Set[tuple] = set()
+            self.ignore_peers: Set[tuple] = set()
+
+        # my addresses, discovered in background on setup and cached in data dir
+        self.discovery = AddressDiscovery(
+            path=os.path.join(self.config.DATA_PATH, 'address.json'),
+            overrides={
+                'local_ip': self.config.LOCAL_IP,
+                'global_ipv4': self.config.GLOBAL_IPV4,
+                'global_ipv6': self.config.GLOBAL_IPV6,
+            })
+        if self.config is V:
+            self.discovery.add_callback(_update_my_address)
 
         # data status control
-        self.broadcast_status: Dict[int, asyncio.Future] = ExpiringDict(max_len=5000, max_age_seconds=90)
+        self.broadcast_status: Dict[int, asyncio.Future] = dict()  # only checking now
+        # seen broadcast uuid, capacity is keys per filter and grows if more broadcasts come in 45s
+        self.broadcast_seen = RotatingBloomFilter(capacity=seen_capacity, error_rate=seen_error_rate, max_age=90.0)
+        # rejected broadcast uuid, exact so a false positive of seen filter does not turn ACK into NACK
+        self.broadcast_rejected: Dict[int, bool] = ExpiringDict(max_len=10000, max_age_seconds=90)
         self.result_futures: Dict[int, asyncio.Future] = ExpiringDict(max_len=5000, max_age_seconds=90)
 
+        # broadcast tree, eager push along tree and lazy push to others if enabled
+        self.f_plumtree = f_plumtree
+        self.plumtree = PlumTree()
+
+        # broadcast propagation trace, set `tracer.sample_rate` to enable
+        self.tracer = BroadcastTracer()
+
+        # broadcast ACK, send only one ACK per link with number of ACKs received from downstream
+        # a relay waits until every downstream link sent its ACK (empty one for duplicate) or ack_wait,
+        # ACKs arriving after the flush are dropped
+        self.f_ack_aggregate = f_ack_aggregate
+        self.ack_wait = 3.0
+        self.ack_aggregate: Dict[int, list] = ExpiringDict(
+            max_len=5000, max_age_seconds=90)  # {uuid: [count, links waiting, timer handle]}
+        self.ack_upstream: Dict[int, User] = ExpiringDict(max_len=5000, max_age_seconds=90)  # {uuid: upstream}
+        self.ack_unsent: Dict[int, int] = ExpiringDict(max_len=5000, max_age_seconds=90)  # {uuid: count}
+        self.ack_replied: Dict[int, Set[int]] = ExpiringDict(
+            max_len=5000, max_age_seconds=90)  # {uuid: {user number,..}} links already got an ACK
+        self.ack_counter: Dict[int, list] = ExpiringDict(max_len=5000, max_age_seconds=90)  # {uuid: [need, got]}
+
+        # batch broadcast check, used instead of broadcast_check if `broadcast_check_batch` is set
+        self.batch_window = 0.05  # collect broadcasts in the window
+        self.batch_max = 100  # check immediately if collect enough
+        self.batch_executor: Optional[Executor] = None  # ex. ProcessPoolExecutor
+        self._batch_items: List[tuple] = list()  # [(user, data, future),..]
+        self._batch_handle: Optional[asyncio.TimerHandle] = None
+
+        # packed peer list response {cmd: (version, time, packed data)}
+        self.response_cache: Dict[str, tuple] = dict()
+
+        # request processing, limit running type_request tasks and queue others
+        self.request_limit = 200
+        self.request_running = 0
+        self.request_backlog = deque()  # [(user, item, push_time),..] up to config.REQUEST_BACKLOG
+        self.request_dropped = 0  # new requests dropped because backlog is full
+
         # recode traffic if f_debug true
         if Debug.F_RECODE_TRAFFIC:
-            self.core.traffic.recode_dir = V.DATA_PATH
+            self.core.traffic.recode_dir = self.config.DATA_PATH
 
         # serializer/deserializer hook
         self.default_hook = default_hook
         self.object_hook = object_hook
 
+        # inner loop and stabilizer, cancelled on close
+        self.futures: List[asyncio.Future] = list()
+
+        # metrics, no-op until enabled by `enable_metrics()`
+        self.metrics_labels = self.core.metrics_labels
+        self.command_time = BoundMetric(
+            'histogram', 'p2p_command_seconds', 'send_command response time', ('cmd',), self.metrics_labels)
+        self.command_timeout = BoundMetric(
+            'counter', 'p2p_command_timeout_total', 'send_command timeout', ('cmd',), self.metrics_labels)
+        register_instance(self.metrics_labels, self._setup_collectors)
+
     def close(self):
         self.f_stop = True
+        for future in self.futures:
+            future.cancel()
         self.core.close()
+        self.event.close()
+        self.peers.close()
+        unregister_instance(self.metrics_labels)
 
     def setup(self, s_family=socket.AF_UNSPEC, f_stabilize=True):
         async def inner_loop():
             log.info("start P2P inner loop")
+            timing = self.core.timing
             while not self.f_stop:
                 try:
-                    user, msg_body, push_time = await asyncio.wait_for(self.core.core_que.get(), 1.0)
+                    user, msg_body, push_time = await self.core.core_que.get()
+                    sampled = timing.enabled and timing.sample()
+                    if sampled:
+                        timing.record('queue_wait', max(0.0, time() - push_time))
+                        lap_time = perf_counter()
                     item = loads(b=msg_body, object_hook=self.object_hook)
-                except asyncio.TimeoutError:
-                    continue
+                    if sampled:
+                        lap_time = timing.lap('decode', lap_time)
+                    if isinstance(item, dict):
+                        self.core.traffic.put_command(item.get('cmd'), DOWN, len(msg_body))
+                except asyncio.CancelledError:
+                    break
                 except Exception:
                     log.debug(f"core que getting exception", exc_info=True)
                     continue
@@ -96,8 +216,11 @@ class Peer2Peer(object):
                     if not isinstance(item, dict):
                         log.debug("unrecognized message receive")
                     elif item['type'] == T_REQUEST:
-                        # process request asynchronously
-                        asyncio.ensure_future(self.type_request(user, item, push_time))
+                        if user in self.core.temporary and item['cmd'] not in TEMPORARY_CMDS:
+                            log.debug(f"ignore {item['cmd']} from temporary connection {user}")
+                        else:
+                            # process request asynchronously
+                            self._start_request(user, item, push_time)
                     elif item['type'] == T_RESPONSE:
                         await self.type_response(user, item)
                         user.header.update_last_seen()
@@ -105,9 +228,12 @@ class Peer2Peer(object):
                         await self.type_ack(user, item)
                     else:
                         log.debug(f"unknown type={item['type']}")
+                    if sampled:
+                        timing.lap('dispatch', lap_time)
                 except asyncio.TimeoutError:
                     log.warning(f"timeout on broadcast and cancel task")
-                    broadcast_task = None
+                except asyncio.CancelledError:
+                    break
                 except Exception:
                     log.debug(f"core que processing exception of {user}", exc_info=True)
             self.f_finish = True
@@ -116,13 +242,36 @@ class Peer2Peer(object):
 
         assert not loop.is_running(), "setup before event loop start!"
         self.core.start(s_family=s_family)
+        self.futures.append(self.discovery.start())
+        self.futures.append(self.peers.start())
         if f_stabilize:
-            loop_futures.append(asyncio.ensure_future(auto_stabilize_network(self)))
+            self.futures.append(asyncio.ensure_future(auto_stabilize_network(self)))
+        self.futures.append(asyncio.ensure_future(self.dht.republish_loop()))
         # Processing
-        loop_futures.append(asyncio.ensure_future(inner_loop()))
-        log.info(f"start user, name={V.SERVER_NAME} port={V.P2P_PORT}")
+        self.futures.append(asyncio.ensure_future(inner_loop()))
+        log.info(f"start user, name={self.config.SERVER_NAME} port={self.config.P2P_PORT}")
         self.f_running = True
 
+    def _start_request(self, user: User, item: dict, push_time: float):
+        if self.request_running < self.request_limit:
+            self.request_running += 1
+            future = asyncio.ensure_future(self.type_request(user, item, push_time))
+            future.add_done_callback(self._finish_request)
+        elif len(self.request_backlog) < self.config.REQUEST_BACKLOG:
+            self.request_backlog.append((user, item, push_time))
+        else:
+            # queued ones are answered soon, so the new one is dropped
+            self.request_dropped += 1
+            log.warning(f"request backlog is full, drop {item['cmd']} request from {user} "
+                        f"dropped={self.request_dropped}")
+
+    def _finish_request(self, future: asyncio.Future):
+        self.request_running -= 1
+        if not future.cancelled() and future.exception() is not None:
+            log.debug("type_request exception", exc_info=future.exception())
+        if 0 < len(self.request_backlog) and not self.f_stop:
+            self._start_request(*self.request_backlog.popleft())
+
     async def type_request(self, user: User, item: dict, push_time: float):
         temperate = {
             'type': T_RESPONSE,
@@ -137,6 +286,10 @@ class Peer2Peer(object):
         ack_list: List[User] = list()
         ack_status: Optional[bool] = None
         allow_udp = False
+        packed: Optional[dict] = None  # {key: packed bytes} of temperate
+        sampled = self.core.timing.enabled and self.core.timing.sample()
+        if sampled:
+            lap_time = perf_counter()
 
         if item['cmd'] == Peer2PeerCmd.PING_PONG:
             temperate['data'] = {
@@ -146,41 +299,70 @@ class Peer2Peer(object):
             allows.append(user)
 
         elif item['cmd'] == Peer2PeerCmd.BROADCAST:
-            if item['uuid'] in self.broadcast_status:
+            if self.f_ack_aggregate and self.is_known_broadcast(item['uuid']):
+                # duplicate receipt generate an empty ACK, retry of upstream gets undelivered ACKs
+                self.duplicate_broadcast(user)
+                if not self._retry_aggregated_ack(item['uuid'], item['cmd'], user):
+                    self._send_aggregated_ack(item['uuid'], item['cmd'], user, 0)
+
+            elif item['uuid'] in self.broadcast_status:
                 # already get broadcast data, only send ACK
+                self.duplicate_broadcast(user)
                 future = self.broadcast_status[item['uuid']]
                 # send ACK after broadcast_check finish
-                await asyncio.wait_for(future, TIMEOUT)
+                await asyncio.wait_for(asyncio.shield(future), TIMEOUT)
                 ack_status = future.result()
                 ack_list.append(user)
 
+            elif item['uuid'] in self.broadcast_seen:
+                # already checked broadcast data, only send ACK
+                self.duplicate_broadcast(user)
+                ack_status = item['uuid'] not in self.broadcast_rejected
+                ack_list.append(user)
+
             elif item['uuid'] in self.result_futures:
                 # I'm broadcaster, get from ack
+                self.duplicate_broadcast(user)
                 ack_status = True
                 ack_list.append(user)
             else:
                 # set future
                 future = asyncio.Future()
                 self.broadcast_status[item['uuid']] = future
-                # try to check broadcast data
-                if asyncio.iscoroutinefunction(self.broadcast_check):
-                    broadcast_result = await asyncio.wait_for(
-                        self.broadcast_check(user, item['data']), TIMEOUT)
-                else:
-                    broadcast_result = self.broadcast_check(user, item['data'])
-                # set broadcast result
-                future.set_result(broadcast_result)
+                broadcast_result = False
+                try:
+                    # try to check broadcast data
+                    broadcast_result = await self.check_broadcast(user, item['data'])
+                finally:
+                    # set broadcast result
+                    self.broadcast_seen.add(item['uuid'])
+                    if not broadcast_result:
+                        self.broadcast_rejected[item['uuid']] = True
+                    del self.broadcast_status[item['uuid']]
+                    future.set_result(broadcast_result)
+                self.plumtree.counter['receive'] += 1
                 # prepare response
                 if broadcast_result:
                     user.score += 1
                     # send ACK
-                    ack_status = True
-                    ack_list.append(user)
-                    # broadcast to all
-                    allows = self.core.user.copy()
+                    if self.f_ack_aggregate:
+                        # own ACK, waits for relayed links below
+                        self.ack_upstream[item['uuid']] = user
+                        self.ack_aggregate[item['uuid']] = [1, 0, None]
+                    else:
+                        ack_status = True
+                        ack_list.append(user)
+                    # broadcast to all (or eager peers of tree)
+                    self.plumtree.graft(user)
+                    allows = await self.lazy_push_broadcast(item['uuid'], item['data'], sender=user)
                     denys.append(user)
                     temperate['type'] = T_REQUEST
                     temperate['data'] = item['data']
+                    if item.get('trace'):
+                        trace = self.tracer.relay(
+                            item['uuid'], item['trace'], self.config.SERVER_NAME, push_time)
+                        if trace:
+                            temperate['trace'] = trace
                     allow_udp = True
                 else:
                     user.warn += 1
@@ -188,14 +370,13 @@ class Peer2Peer(object):
                     ack_status = False
                     ack_list.append(user)
 
-        elif item['cmd'] == Peer2PeerCmd.GET_PEER_INFO:
-            # [[(host,port), header],..]
-            temperate['data'] = [(host_port, header.getinfo()) for host_port, header in self.peers.copy().items()]
-            allows.append(user)
-
-        elif item['cmd'] == Peer2PeerCmd.GET_NEARS:
-            # [[(host,port), header],..]
-            temperate['data'] = [(user.get_host_port(), user.header.getinfo()) for user in self.core.user]
+        elif item['cmd'] in (Peer2PeerCmd.GET_PEER_INFO, Peer2PeerCmd.GET_NEARS):
+            if isinstance(item['data'], dict):
+                # delta from {'epoch': int, 'version': int}
+                packed = {'data': self.get_packed_peer_list_delta(item['cmd'], item['data'])}
+            else:
+                # [[(host,port), header],..]
+                packed = {'data': self.get_packed_peer_list(item['cmd'])}
             allows.append(user)
 
         elif item['cmd'] == Peer2PeerCmd.CHECK_REACHABLE:
@@ -205,23 +386,75 @@ class Peer2Peer(object):
                 port = user.header.p2p_port
             try:
                 temperate['data'] = await asyncio.wait_for(
-                    is_reachable(host=user.host_port[0], port=port), TIMEOUT)
+                    self.core.transport.is_reachable(user.host_port[0], port), TIMEOUT)
             except Exception:
                 temperate['data'] = False
             allows.append(user)
 
+        elif item['cmd'] == Peer2PeerCmd.FIND_NODE:
+            # node id => [(node id, host_port),..] close to the id
+            self.add_dht_contact(user.header, user.get_host_port())
+            contacts = self.dht.find_closest(bytes2id(item['data']))
+            temperate['data'] = [(id2bytes(contact_id), host_port) for contact_id, host_port in contacts]
+            allows.append(user)
+
+        elif item['cmd'] == Peer2PeerCmd.FIND_VALUE:
+            # key id => {'value': value, 'ttl': int} or [(node id, host_port),..] close to the key
+            self.add_dht_contact(user.header, user.get_host_port())
+            result = self.dht.handle_find_value(bytes2id(item['data']))
+            if isinstance(result, dict):
+                temperate['data'] = result
+            else:
+                temperate['data'] = [(id2bytes(contact_id), host_port) for contact_id, host_port in result]
+            allows.append(user)
+
+        elif item['cmd'] == Peer2PeerCmd.STORE:
+            # {'key': key id, 'value': value, 'ttl': int} => bool
+            self.add_dht_contact(user.header, user.get_host_port())
+            data = item['data']
+            temperate['data'] = await self.dht.handle_store(bytes2id(data['key']), data['value'], int(data['ttl']))
+            allows.append(user)
+
+        elif item['cmd'] == Peer2PeerCmd.IHAVE:
+            # [uuid,..] announced by lazy peer
+            for uuid in item['data']:
+                if not self.is_known_broadcast(uuid):
+                    self.plumtree.announce(uuid, user, self._missing_broadcast_timeout)
+
+        elif item['cmd'] == Peer2PeerCmd.GRAFT:
+            # [uuid,..] requested by peer which miss them
+            self.plumtree.graft(user)
+            for uuid in item['data']:
+                if uuid in self.plumtree.cache:
+                    await self._send_control(Peer2PeerCmd.BROADCAST, self.plumtree.cache[uuid],
+                                             [user], uuid=uuid, trace=self.tracer.traces.get(uuid))
+
+        elif item['cmd'] == Peer2PeerCmd.PRUNE:
+            self.plumtree.prune(user)
+
         elif item['cmd'] == Peer2PeerCmd.DIRECT_CMD:
             data = item['data']
-            if self.event.have_event(data['cmd']):
+            if 'many' in data:
+                # [(cmd, data),..] => [(True, result) or (False, error),..]
+                allows.append(user)
+                # each cmd has own timeout, requester tells shorter one to get results before it gives up
+                timeout = min(TIMEOUT, float(data.get('timeout') or TIMEOUT))
+                temperate['data'] = await self.event.ignition_many(user, data['many'], timeout)
+            elif self.event.have_event(data['cmd']):
                 allows.append(user)
                 temperate['data'] = await asyncio.wait_for(
                     self.event.ignition(user, data['cmd'], data['data']), TIMEOUT)
         else:
             log.debug(f"not found request cmd '{item['cmd']}'")
+        if sampled:
+            self.core.timing.lap('handler', lap_time)
 
         # send message
         temperate['time'] = time()
-        send_count = await self._send_many_users(item=temperate, allows=allows, denys=denys, allow_udp=allow_udp)
+        send_count = await self._send_many_users(
+            item=temperate, allows=allows, denys=denys, allow_udp=allow_udp, packed=packed)
+        if item['uuid'] in self.ack_aggregate and temperate['type'] == T_REQUEST:
+            self._wait_aggregated_ack(item['uuid'], item['cmd'], send_count)
         # send ack
         ack_count = 0
         if len(ack_list) > 0:
@@ -252,30 +485,248 @@ class Peer2Peer(object):
 
     async def type_ack(self, user: User, item: dict):
         # cmd = item['cmd']
-        ack_status = bool(item['data'])
+        ack_num = int(item['data'] or 0)  # bool or number of aggregated ACKs
         uuid = item['uuid']
 
         if uuid in self.result_futures:
             future = self.result_futures[uuid]
-            if ack_status and not future.done():
-                future.set_result((user, ack_status))
+            if 0 < ack_num and not future.done():
+                counter = self.ack_counter.get(uuid)
+                if counter is not None:
+                    counter[1] += ack_num
+                if counter is None or counter[0] <= counter[1]:
+                    future.set_result((user, True))
+        elif uuid in self.ack_aggregate:
+            # downstream link finished, send upstream when all links finished
+            waiting = self.ack_aggregate[uuid]
+            waiting[0] += ack_num
+            waiting[1] -= 1
+            if waiting[1] <= 0 and waiting[2] is not None:
+                self._flush_aggregated_ack(uuid, item['cmd'])
+        elif uuid in self.ack_upstream:
+            log.debug(f"uuid={uuid} drop downstream ACK after flush")
+
+    def _wait_aggregated_ack(self, uuid, cmd, send_count):
+        """broadcast relayed to send_count links, wait for their ACKs until ack_wait"""
+        waiting = self.ack_aggregate[uuid]
+        waiting[1] += send_count
+        if waiting[1] <= 0:
+            self._flush_aggregated_ack(uuid, cmd)
+        else:
+            waiting[2] = loop.call_later(self.ack_wait, self._flush_aggregated_ack, uuid, cmd)
+
+    def _retry_aggregated_ack(self, uuid, cmd, user: User) -> bool:
+        """upstream sent the broadcast again, ACKs not delivered are sent by the new link"""
+        upstream = self.ack_upstream.get(uuid)
+        if upstream is None or upstream.header.name != user.header.name:
+            return False
+        self.ack_upstream[uuid] = user
+        count = self.ack_unsent.pop(uuid, 0)
+        if 0 < count:
+            self._send_aggregated_ack(uuid, cmd, user, count)
+        return True
+
+    def _flush_aggregated_ack(self, uuid, cmd):
+        """send own and downstream ACKs to upstream"""
+        waiting = self.ack_aggregate.pop(uuid, None)
+        user = self.ack_upstream.get(uuid)
+        if waiting is None or user is None:
+            return
+        if waiting[2] is not None:
+            waiting[2].cancel()
+        if user not in self.core.user:
+            # keep for retry of upstream, it may come by a new connection
+            self.ack_unsent[uuid] = waiting[0]
+            return
+        self._send_aggregated_ack(uuid, cmd, user, waiting[0])
+
+    def _send_aggregated_ack(self, uuid, cmd, user: User, count):
+        """at most one ACK per broadcast per link"""
+        replied = self.ack_replied.get(uuid)
+        if replied is None:
+            replied = self.ack_replied[uuid] = set()
+        elif user.number in replied:
+            return
+        replied.add(user.number)
+        item = {
+            'type': T_ACK,
+            'cmd': cmd,
+            'data': count,
+            'time': time(),
+            'uuid': uuid,
+        }
+        asyncio.ensure_future(self._send_many_users(item=item, allows=[user], denys=[]))
+
+    async def check_broadcast(self, user: User, data) -> bool:
+        """check by broadcast_check or wait for batch check"""
+        if self.broadcast_check_batch is None:
+            if asyncio.iscoroutinefunction(self.broadcast_check):
+                return await asyncio.wait_for(self.broadcast_check(user, data), TIMEOUT)
+            else:
+                return self.broadcast_check(user, data)
+        # collect and check in a batch
+        future = asyncio.Future()
+        self._batch_items.append((user, data, future))
+        if self.batch_max <= len(self._batch_items):
+            self._flush_batch_check()
+        elif self._batch_handle is None:
+            self._batch_handle = loop.call_later(self.batch_window, self._flush_batch_check)
+        return await asyncio.wait_for(asyncio.shield(future), TIMEOUT)
+
+    def _flush_batch_check(self):
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._batch_handle = None
+        items, self._batch_items = self._batch_items, list()
+        if 0 < len(items):
+            asyncio.ensure_future(self._batch_check(items))
+
+    async def _batch_check(self, items: List[tuple]):
+        args = [(user.get_host_port(), data) for user, data, _future in items]
+        try:
+            fnc = self.broadcast_check_batch
+            if self.batch_executor is not None:
+                results = await loop.run_in_executor(self.batch_executor, fnc, args)
+            elif asyncio.iscoroutinefunction(fnc):
+                results = await asyncio.wait_for(fnc(args), TIMEOUT)
+            else:
+                results = fnc(args)
+            if len(results) != len(items):
+                raise PeerToPeerError(f"batch check return {len(results)} results for {len(items)} items")
+        except Exception:
+            log.warning("broadcast_check_batch exception", exc_info=True)
+            results = [False] * len(items)
+        # resolve in order
+        for (_user, _data, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(bool(result))
+
+    def is_known_broadcast(self, uuid) -> bool:
+        """already received or sent the broadcast"""
+        return uuid in self.broadcast_status or uuid in self.broadcast_seen or uuid in self.result_futures
+
+    def duplicate_broadcast(self, user: User):
+        """duplicate broadcast received, remove the link from tree"""
+        self.plumtree.counter['duplicate'] += 1
+        if self.f_plumtree and user not in self.plumtree.lazy:
+            self.plumtree.prune(user)
+            self.plumtree.counter['prune'] += 1
+            asyncio.ensure_future(self._send_control(Peer2PeerCmd.PRUNE, None, [user]))
+
+    async def lazy_push_broadcast(self, uuid, data, sender: Optional[User] = None) -> List[User]:
+        """send IHAVE to lazy peers and return eager peers to push full message"""
+        users = [user for user in self.core.user if user is not sender]
+        if not self.f_plumtree:
+            self.plumtree.counter['eager'] += len(users)
+            return users
+        self.plumtree.receive(uuid, data)
+        eager, lazy = self.plumtree.split(users)
+        if 0 < len(lazy):
+            await self._send_control(Peer2PeerCmd.IHAVE, [uuid], lazy)
+        self.plumtree.counter['eager'] += len(eager)
+        self.plumtree.counter['lazy'] += len(lazy)
+        return eager
 
-    async def _send_many_users(self, item, allows: List[User], denys: List[User], allow_udp=False) -> int:
+    def _missing_broadcast_timeout(self, uuid):
+        """announced broadcast does not reach by eager push, pull from announcer"""
+        if self.is_known_broadcast(uuid):
+            return
+        # skip announcers already disconnected
+        user = self.plumtree.next_announcer(uuid, self._missing_broadcast_timeout)
+        while user is not None and user not in self.core.user:
+            user = self.plumtree.next_announcer(uuid, self._missing_broadcast_timeout)
+        if user is None:
+            return
+        self.plumtree.graft(user)
+        self.plumtree.counter['graft'] += 1
+        asyncio.ensure_future(self._send_control(Peer2PeerCmd.GRAFT, [uuid], [user]))
+
+    async def _send_control(self, cmd, data, users: List[User], uuid=None, trace=None) -> int:
+        """send a request which expect no response"""
+        item = {
+            'type': T_REQUEST,
+            'cmd': cmd,
+            'data': data,
+            'time': time(),
+            'uuid': uuid or random.randint(10, 0xffffffff),
+        }
+        if trace:
+            item['trace'] = trace
+        return await self._send_many_users(item=item, allows=users, denys=[], allow_udp=True)
+
+    def get_packed_peer_list(self, cmd) -> bytes:
+        """packed [[(host,port), header],..] cached until peer list changed"""
+        if cmd == Peer2PeerCmd.GET_PEER_INFO:
+            version = self.peers.version
+        else:
+            version = self.core.user_version
+        cache = self.response_cache.get(cmd)
+        if cache and cache[0] == version and time() - cache[1] < RESPONSE_CACHE_AGE:
+            return cache[2]
+        if cmd == Peer2PeerCmd.GET_PEER_INFO:
+            data = [(host_port, header.getinfo()) for host_port, header in self.peers.copy().items()]
+        else:
+            data = [(user.get_host_port(), user.header.getinfo()) for user in self.core.user]
+        packed_data = dumps(obj=data, default=self.default_hook)
+        self.response_cache[cmd] = (version, time(), packed_data)
+        return packed_data
+
+    def get_packed_peer_list_delta(self, cmd, data: dict) -> bytes:
+        """packed changes of peer list after requester's version, full list if too old"""
+        if cmd == Peer2PeerCmd.GET_PEER_INFO:
+            changes = self.peers.changes
+        else:
+            changes = self.core.user_changes
+        delta = {
+            'epoch': changes.epoch,
+            'version': changes.version,
+            'full': False,
+            'items': list(),  # [[(host,port), header],..] added or changed
+            'removed': list(),  # [(host,port),..]
+        }
+        keys = changes.since(data.get('epoch'), data.get('version'))
+        if keys is None:
+            delta['full'] = True
+            return dumps_with_packed(obj=delta, packed={'items': self.get_packed_peer_list(cmd)})
+        for host_port in keys:
+            if cmd == Peer2PeerCmd.GET_PEER_INFO:
+                header = self.peers.get(host_port)
+            else:
+                user = self.core.host_port2user(host_port)
+                header = user.header if user else None
+            if header is None:
+                delta['removed'].append(host_port)
+            else:
+                delta['items'].append((host_port, header.getinfo()))
+        return dumps(obj=delta, default=self.default_hook)
+
+    async def _send_many_users(self, item, allows: List[User], denys: List[User], allow_udp=False,
+                               packed: Optional[dict] = None) -> int:
         """send to many user and return how many send"""
-        msg_body = dumps(obj=item, default=self.default_hook)
+        if packed:
+            msg_body = dumps_with_packed(obj=item, packed=packed, default=self.default_hook)
+        else:
+            msg_body = dumps(obj=item, default=self.default_hook)
         count = 0
         for user in allows:
             if user not in denys:
                 try:
                     await self.core.send_msg_body(msg_body=msg_body, user=user, allow_udp=allow_udp)
+                    self.core.traffic.put_command(item.get('cmd'), UP, len(msg_body))
                     count += 1
                 except Exception as e:
                     user.warn += 1
                     log.debug(f"failed send msg to {user} by {str(e)}")
         return count
 
-    async def send_command(self, cmd, data=None, user=None, timeout=10.0, retry=2) -> (User, dict):
-        assert 0.0 < timeout and 0 < retry
+    async def send_command(self, cmd, data=None, user=None, timeout=10.0, retry=2, ack_num=1) -> (User, dict):
+        """
+        send command and wait for response
+        params:
+            retry: (int) send again if no response, an only try waits for whole timeout
+            ack_num: (int) broadcast only, wait for the number of ACKs (counted aggregated ACKs)
+        """
+        assert 0.0 < timeout and 0 < retry and 0 < ack_num
 
         if self.f_stop:
             raise PeerToPeerError('already p2p-python closed')
@@ -292,15 +743,17 @@ class Peer2Peer(object):
         f_udp = False
 
         # 2. Setup allows to send nodes
-        if len(self.core.user) == 0:
+        if len(self.core.user) == 0 and user not in self.core.temporary:
             raise PeerToPeerError('no client connection found')
         elif cmd == Peer2PeerCmd.BROADCAST:
-            allows = self.core.user.copy()
+            allows = await self.lazy_push_broadcast(uuid, data)
             f_udp = True
+            if self.tracer.sample():
+                temperate['trace'] = self.tracer.start(uuid, self.config.SERVER_NAME)
         elif user is None:
             user = random.choice(self.core.user)
             allows = [user]
-        elif user in self.core.user:
+        elif user in self.core.user or user in self.core.temporary:
             allows = [user]
         else:
             raise PeerToPeerError("Not found user in list")
@@ -309,9 +762,13 @@ class Peer2Peer(object):
         start = time()
         future = asyncio.Future()
         self.result_futures[uuid] = future
+        if cmd == Peer2PeerCmd.BROADCAST and 1 < ack_num:
+            self.ack_counter[uuid] = [ack_num, 0]
 
         # get best timeout
-        if user is None:
+        if retry == 1:
+            best_timeout = timeout
+        elif user is None:
             # broadcast-cmd
             best_timeout = timeout / retry
         else:
@@ -351,8 +808,8 @@ class Peer2Peer(object):
         else:
             f_timeout = True
 
-        # 6. timeout
-        if f_timeout and user:
+        # 6. timeout, temporary connection is closed by the requester
+        if f_timeout and user and user not in self.core.temporary:
             if user.closed or not await self.core.ping(user):
                 # already closed or ping failed -> reconnect
                 await self.core.try_reconnect(user, reason="ping failed on send_command")
@@ -361,11 +818,36 @@ class Peer2Peer(object):
 
         # 7. return result
         if future.done():
+            self.command_time.labels(cmd).observe(time() - start)
             return future.result()
         else:
             future.cancel()
+            self.command_timeout.labels(cmd).inc()
             raise asyncio.TimeoutError("timeout cmd")
 
+    def _setup_collectors(self, registry: Registry):
+        """values read on scrape, labeled by node name to distinguish nodes in a process"""
+        core = self.core
+        traffic = core.traffic
+
+        def collector(name, documentation, kind, fnc):
+            registry.collector(name, documentation, kind, fnc, labels=self.metrics_labels)
+        collector('p2p_connections', 'number of connections', 'gauge', lambda: [
+            ({'direction': direction}, sum(1 for user in core.user if user.direction == direction))
+            for direction in (INBOUND, OUTBOUND)])
+        collector('p2p_known_peers', 'number of peers in peer list', 'gauge', lambda: len(self.peers))
+        collector('p2p_core_queue_depth', 'received messages waiting', 'gauge', core.core_que.qsize)
+        collector('p2p_request_running', 'running requests', 'gauge', lambda: self.request_running)
+        collector('p2p_request_backlog', 'requests waiting', 'gauge', lambda: len(self.request_backlog))
+        collector('p2p_request_dropped_total', 'requests dropped by full backlog', 'counter',
+                  lambda: self.request_dropped)
+        collector('p2p_broadcast_duplicate_total', 'duplicate broadcast received', 'counter',
+                  lambda: self.plumtree.counter['duplicate'])
+        collector('p2p_bytes_total', 'traffic bytes', 'counter', lambda: [
+            ({'direction': UP}, traffic.total[0]), ({'direction': DOWN}, traffic.total[2])])
+        collector('p2p_messages_total', 'traffic messages', 'counter', lambda: [
+            ({'direction': UP}, traffic.total[1]), ({'direction': DOWN}, traffic.total[3])])
+
     async def send_direct_cmd(self, cmd, data, user=None) -> (User, dict):
         if len(self.core.user) == 0:
             raise PeerToPeerError('not found peers')
@@ -379,11 +861,157 @@ class Peer2Peer(object):
             log.warning(f"do not match sender and receiver {user} != {receive_user}")
         return user, item
 
+    async def send_direct_cmd_many(self, items, user=None, timeout=5.0) -> (User, list):
+        """
+        send many DirectCmd in one request
+        items: [(cmd, data),..]
+        timeout: each cmd, timeout item is replaced and others are returned without resending all
+        return: results in the same order, failed item is replaced with PeerToPeerError
+        """
+        if len(self.core.user) == 0:
+            raise PeerToPeerError('not found peers')
+        send_items = list()
+        for cmd, data in items:
+            if callable(cmd):
+                cmd = cmd.__name__
+            assert isinstance(cmd, str)
+            send_items.append((cmd, data))
+        user = user if user else random.choice(self.core.user)
+        send_data = {'many': send_items, 'timeout': timeout}
+        receive_user, results = await self.send_command(
+            Peer2PeerCmd.DIRECT_CMD, send_data, user, timeout=timeout + 5.0, retry=1)
+        if user != receive_user:
+            log.warning(f"do not match sender and receiver {user} != {receive_user}")
+        if not isinstance(results, list) or len(results) != len(send_items):
+            raise PeerToPeerError(f"unexpected response of direct cmd many {results}")
+        return user, [result if success else PeerToPeerError(result) for success, result in results]
+
+    def add_dht_contact(self, header: UserHeader, host_port):
+        """add a peer to DHT routing table if it accepts connection"""
+        if header.p2p_accept:
+            self.dht.table.add(node_id(header.name), tuple(host_port))
+
+    async def find_node(self, target) -> Optional[tuple]:
+        """
+        find host_port of a node by DHT lookup
+        target: node id (int or bytes) or server name (str)
+        """
+        if isinstance(target, str):
+            target = node_id(target)
+        elif isinstance(target, bytes):
+            target = bytes2id(target)
+        return await self.dht.find_node(target)
+
+    async def _find_node_rpc(self, host_port, target: int) -> list:
+        contacts = await self._dht_request(host_port, Peer2PeerCmd.FIND_NODE, id2bytes(target))
+        return [(bytes2id(contact_id), tuple(host_port)) for contact_id, host_port in contacts]
+
+    async def _find_value_rpc(self, host_port, target: int):
+        result = await self._dht_request(host_port, Peer2PeerCmd.FIND_VALUE, id2bytes(target))
+        if isinstance(result, dict):
+            return result
+        return [(bytes2id(contact_id), tuple(host_port)) for contact_id, host_port in result]
+
+    async def _store_rpc(self, host_port, target: int, value, ttl: int) -> bool:
+        data = {'key': id2bytes(target), 'value': value, 'ttl': ttl}
+        return await self._dht_request(host_port, Peer2PeerCmd.STORE, data) is True
+
+    async def _dht_request(self, host_port, cmd, data):
+        host_port = tuple(host_port)
+        user = self.core.host_port2user(host_port)
+        f_temporary = user is None or host_port in self.temporary_users
+        if f_temporary:
+            user = await self._connect_temporary(host_port)
+        try:
+            _, result = await self.send_command(cmd, data, user, timeout=5.0, retry=1)
+            return result
+        finally:
+            if f_temporary:
+                self._release_temporary(host_port)
+
+    async def _connect_temporary(self, host_port) -> User:
+        """connect to a peer not connected, shared by parallel requests and closed by the last one"""
+        temporary = self.temporary_users.get(host_port)
+        if temporary is None:
+            temporary = self.temporary_users[host_port] = [asyncio.ensure_future(self._open_temporary(host_port)), 0]
+        temporary[1] += 1
+        try:
+            return await asyncio.shield(temporary[0])
+        except BaseException:
+            self._release_temporary(host_port)
+            raise
+
+    async def _open_temporary(self, host_port) -> User:
+        user = await self.core.create_temporary_connection(host_port[0], host_port[1])
+        if user is None:
+            raise PeerToPeerError(f"failed to connect {host_port}")
+        return user
+
+    def _release_temporary(self, host_port):
+        temporary = self.temporary_users.get(host_port)
+        if temporary is None:
+            return
+        temporary[1] -= 1
+        if 0 < temporary[1]:
+            return
+        del self.temporary_users[host_port]
+
+        def close(future: asyncio.Future):
+            if not future.cancelled() and future.exception() is None:
+                self.core.remove_connection(future.result(), 'finish DHT request')
+        temporary[0].add_done_callback(close)
+
     @staticmethod
     def broadcast_check(user: User, data):
         """return true if spread to all connections"""
         return False  # overwrite
 
+    # overwrite by `fnc(items) -> [bool,..]` to check broadcasts in a batch
+    # items are [((host, port), data),..] and results are returned in the same order
+    # note: the function must be picklable if batch_executor is a process pool
+    broadcast_check_batch = None
+
+
+async def _wait_events(events: List[asyncio.Event], timeout) -> bool:
+    """wait for any of the events until timeout, return True if set"""
+    waits = [asyncio.ensure_future(event.wait()) for event in events]
+    try:
+        done, _ = await asyncio.wait(waits, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        return 0 < len(done)
+    finally:
+        for wait in waits:
+            wait.cancel()
+
+
+async def _wait_stabilize(p2p: Peer2Peer, events: List[asyncio.Event], wait_time) -> bool:
+    """
+    wait for the stabilizer timer, return True if woken up early by the events
+    events are ignored while connections are enough, others' connections come and go
+    """
+    deadline = loop.time() + wait_time
+    f_woken = False
+    while await _wait_events(events, deadline - loop.time()):
+        await asyncio.sleep(STABILIZE_DEBOUNCE)
+        for event in events:
+            event.clear()
+        if len(p2p.core.user) < p2p.core.backlog * 2 // 3:
+            f_woken = True
+            break
+    for event in events:
+        event.clear()
+    return f_woken
+
+
+def _update_my_address(kind, address):
+    """module level addresses follow discovery of the default config nodes"""
+    global LOCAL_IP, GLOBAL_IPV4, GLOBAL_IPV6
+    if kind == 'local_ip':
+        LOCAL_IP = address
+    elif kind == 'global_ipv4':
+        GLOBAL_IPV4 = address
+    elif kind == 'global_ipv6':
+        GLOBAL_IPV6 = address
+
 
 async def auto_stabilize_network(
         p2p: Peer2Peer,
@@ -399,15 +1027,19 @@ async def auto_stabilize_network(
             self disconnection avoid overflow backlog but will make unstable network.
     """
     # update ignore peers
-    ignore_peers.update({
-        # ipv4
-        (GLOBAL_IPV4, V.P2P_PORT),
-        (LOCAL_IP, V.P2P_PORT),
-        ('127.0.0.1', V.P2P_PORT),
-        # ipv6
-        (GLOBAL_IPV6, V.P2P_PORT, 0, 0),
-        ('::1', V.P2P_PORT, 0, 0),
-    })
+    user_score = p2p.user_score
+    sticky_peers = p2p.sticky_peers
+    ignore_peers = p2p.ignore_peers
+    ban_address = p2p.core.ban_address
+    port = p2p.config.P2P_PORT
+    ignore_peers.update({('127.0.0.1', port), ('::1', port, 0, 0)})
+
+    def ignore_my_address(kind, address):
+        if kind == 'global_ipv6':
+            ignore_peers.add((address, port, 0, 0))
+        else:
+            ignore_peers.add((address, port))
+    p2p.discovery.add_callback(ignore_my_address)
 
     # wait for P2P running
     while not p2p.f_running:
@@ -421,6 +1053,21 @@ async def auto_stabilize_network(
     # start stabilize connection
     count = 0
     need_connection = 3
+    score_index = ScoreIndex(scores=user_score)
+    events = [p2p.core.user_event, p2p.peers.new_peer_event]
+    f_dht_joined = False
+
+    def dial_result(host_port, result, f_forget=True):
+        if result:
+            log.debug(f"new connection {host_port}")
+            p2p.peers.record_success(host_port)
+        else:
+            log.debug(f"failed connect try {host_port}")
+            p2p.peers.record_failure(host_port)
+            sticky_peers.add(host_port)
+            if f_forget:
+                p2p.peers.remove_from_memory(host_port)
+
     while p2p.f_running:
         count += 1
 
@@ -430,10 +1077,8 @@ async def auto_stabilize_network(
         else:
             wait_time = 4.0 * (4.5 + random.random())  # wait 18s~20s
 
-        # waiting
-        while p2p.f_running and 0.0 < wait_time:
-            await asyncio.sleep(0.1)
-            wait_time -= 0.1
+        # waiting timer, wake up early by connection lost, new connection or new peer
+        await _wait_stabilize(p2p, events, wait_time)
 
         # clear sticky
         if count % 13 == 0 and len(sticky_peers) > 0:
@@ -444,16 +1089,15 @@ async def auto_stabilize_network(
         try:
             # no connection and try to connect from peer list
             if 0 == len(p2p.core.user):
+                wait_time = 0.0
                 if 0 < len(p2p.peers):
-                    peers = list(p2p.peers.keys())
-                    while 0 < len(peers) and len(p2p.core.user) < need_connection:
-                        host_port = peers.pop()
-                        if host_port in ignore_peers:
-                            p2p.peers.remove_from_memory(host_port)
-                        elif await p2p.core.create_connection(host_port[0], host_port[1]):
-                            pass
-                        else:
-                            sticky_peers.add(host_port)
+                    # best quality peers first, dial in parallel
+                    for host_port in ignore_peers:
+                        p2p.peers.remove_from_memory(host_port)
+                    peers = p2p.peers.ranked(exclude=sticky_peers)
+                    await p2p.dialer.connect(
+                        peers, need_connection, on_result=lambda *args: dial_result(*args, f_forget=False))
+                    p2p.core.user_event.clear()  # my own dials
                     log.info(f"init connection num={len(p2p.core.user)}")
                     # wait when disconnected from network
                     if len(p2p.core.user) == 0:
@@ -463,42 +1107,41 @@ async def auto_stabilize_network(
                     wait_time = 5.0
 
                 # waiting if required
-                while p2p.f_running and 0.0 < wait_time:
-                    await asyncio.sleep(0.1)
-                    wait_time -= 0.1
+                if 0.0 < wait_time:
+                    if await _wait_events(events, wait_time):
+                        await asyncio.sleep(STABILIZE_DEBOUNCE)
 
             # update 1 user's neer info one by one
             if 0 < len(p2p.core.user):
                 update_user = p2p.core.user[count % len(p2p.core.user)]
-                _, item = await p2p.send_command(cmd=Peer2PeerCmd.GET_NEARS, user=update_user)
+                _, item = await p2p.send_command(
+                    cmd=Peer2PeerCmd.GET_NEARS, data=update_user.get_neers_version(), user=update_user)
                 update_user.update_neers(item)
-                # peer list update
+                score_index.set_neers(update_user.get_host_port(), update_user.neers.keys())
+                # DHT routing table
+                p2p.add_dht_contact(update_user.header, update_user.get_host_port())
+                for host_port, header in update_user.neers.items():
+                    p2p.add_dht_contact(header, host_port)
+                if not f_dht_joined and 0 < len(p2p.dht.table):
+                    f_dht_joined = True
+                    p2p.futures.append(asyncio.ensure_future(p2p.dht.join()))
+                # peer list update, found peers are joined below in this cycle
                 p2p.peers.add(update_user)
+                p2p.peers.new_peer_event.clear()
 
             # Calculate score (高ければ優先度が高い)
-            search = set(p2p.peers.keys())
-            for user in p2p.core.user:
-                for host_port in user.neers.keys():
-                    search.add(host_port)
-            search.difference_update(ignore_peers)
-            search.difference_update(sticky_peers)
-            for host_port in search:  # 第一・二層を含む
-                score = 0
-                score += sum(1 for user in p2p.core.user if host_port in user.neers)  # 第二層は加点
-                score -= sum(1 for user in p2p.core.user if host_port == user.get_host_port())  # 第一層は減点
-                user_score[host_port] = max(-20, min(20, score))
-            if len(user_score) == 0:
+            # 第二層は加点、第一層は減点、変更分のみ反映する
+            score_index.sync_known(p2p.peers)
+            score_index.sync_connections(p2p.core.user)
+            if len(score_index) == 0:
                 continue
 
             # Action join or remove or nothing
             if len(p2p.core.user) > p2p.core.backlog * 2 // 3:  # Remove
                 if not self_disconnect:
                     continue
-                # スコアの下位半分を取得
-                sorted_score = sorted(user_score.items(), key=lambda x: x[1])[:len(user_score) // 3]
-                # 既接続のもののみを取得
-                already_connected = tuple(user.get_host_port() for user in p2p.core.user)
-                sorted_score = list(filter(lambda x: x[0] in already_connected, sorted_score))
+                # 既接続のうちスコアの低いものを取得
+                sorted_score = score_index.remove_candidates(REMOVE_CANDIDATES, ignore_peers, sticky_peers)
                 if len(sorted_score) == 0:
                     continue
                 log.debug(f"try to remove score {sorted_score}")
@@ -513,39 +1156,25 @@ async def auto_stabilize_network(
                 else:
                     log.warning("failed remove connection. Already disconnected?")
                     sticky_peers.add(host_port)
-                    if p2p.peers.remove_from_memory(host_port):
-                        del user_score[host_port]
+                    p2p.peers.remove_from_memory(host_port)
 
             elif len(p2p.core.user) < p2p.core.backlog * 2 // 3:  # Join
-                # スコア上位半分を取得
-                sorted_score = sorted(
-                    user_score.items(), key=lambda x: x[1], reverse=True)[:len(user_score) // 3]
-                # 既接続を除く
-                already_connected = tuple(user.get_host_port() for user in p2p.core.user)
-                sorted_score = list(filter(lambda x:
-                                           x[0] not in already_connected and
-                                           x[0] not in sticky_peers,
-                                           sorted_score))
+                # 未接続のうちスコアの高いものを取得
+                need = p2p.core.backlog * 2 // 3 - len(p2p.core.user)
+                sorted_score = score_index.join_candidates(
+                    max(JOIN_CANDIDATES, need * 2), ignore_peers, sticky_peers)
+                sorted_score = [(host_port, score) for host_port, score in sorted_score
+                                if host_port[0] not in ban_address]
                 if len(sorted_score) == 0:
                     continue
                 log.debug(f"join score {sorted_score}")
-                host_port, score = random.choice(sorted_score)
-                if p2p.core.host_port2user(host_port):
-                    continue  # 既に接続済み
-                elif host_port in sticky_peers:
-                    continue  # 接続不能回数大杉
-                elif host_port in ignore_peers:
-                    p2p.peers.remove_from_memory(host_port)
-                    continue
-                elif host_port[0] in ban_address:
-                    continue  # BAN address
-                elif await p2p.core.create_connection(host=host_port[0], port=host_port[1]):
-                    log.debug(f"new connection {host_port}")
-                else:
-                    log.debug(f"failed connect try, remove {host_port}")
-                    sticky_peers.add(host_port)
-                    if p2p.peers.remove_from_memory(host_port):
-                        del user_score[host_port]
+                # random pick of top candidates weighted by score and quality, dial in parallel
+                # not always the best so that nodes do not converge on the same hubs
+                lowest = min(score for _, score in sorted_score)
+                sorted_score = weighted_order(sorted_score, lambda x: x[1] - lowest + 1.0 + p2p.peers.quality(x[0]))
+                await p2p.dialer.connect(
+                    [host_port for host_port, _ in sorted_score], need, on_result=dial_result)
+                p2p.core.user_event.clear()  # my own dials
             else:
                 pass
 
@@ -553,15 +1182,14 @@ async def auto_stabilize_network(
             log.info(f"stabilize {str(e)}")
         except PeerToPeerError as e:
             log.debug(f"Peer2PeerError: {str(e)}")
+        except asyncio.CancelledError:
+            break
         except Exception:
             log.debug("stabilize exception", exc_info=True)
     log.info("auto stabilize closed")
 
 
 __all__ = [
-    "LOCAL_IP",
-    "GLOBAL_IPV4",
-    "GLOBAL_IPV6",
     "T_REQUEST",
     "T_RESPONSE",
     "T_ACK",
@@ -0,0 +1,292 @@
+from p2p_python.transport import Transport
+from typing import Dict, Optional, Callable, Iterable
+from logging import getLogger
+from collections import deque
+import selectors
+import asyncio
+import random
+
+log = getLogger(__name__)
+
+CONNECT_TIMEOUT = 10.0  # connect to partitioned host
+RETRANSMIT_RTT = 3  # lost stream segment is delayed by round trips
+
+
+class _VirtualSelector(object):
+    """advance virtual clock instead of waiting for timeout"""
+
+    def __init__(self, loop: 'VirtualClockLoop'):
+        self._loop = loop
+        self._selector = selectors.DefaultSelector()
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events or timeout == 0:
+            return events
+        elif timeout is None:
+            return self._selector.select(None)  # no timer, wait for real IO
+        self._loop.advance(timeout)
+        return list()
+
+    def __getattr__(self, item):
+        return getattr(self._selector, item)
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """
+    event loop on virtual time, sleep and timeout finish instantly and in order
+    set it before importing p2p_python modules because they bind the loop on import
+        asyncio.set_event_loop(VirtualClockLoop())
+    real IO (executor, socket) works but does not advance virtual time, avoid on simulation.
+    `time.time()` based expiring (ExpiringDict, Bloom filter) still follows real time.
+    """
+
+    def __init__(self, start=0.0):
+        self._virtual_time = start
+        super().__init__(selector=_VirtualSelector(self))
+
+    def time(self):
+        return self._virtual_time
+
+    def advance(self, seconds):
+        self._virtual_time += seconds
+
+
+class SimStreamReader(asyncio.StreamReader):
+    """drop data after eof like closed socket"""
+    f_eof = False
+
+    def feed_data(self, data):
+        if not self.f_eof:
+            super().feed_data(data)
+
+    def feed_eof(self):
+        if not self.f_eof:
+            self.f_eof = True
+            super().feed_eof()
+
+
+class SimStreamWriter(object):
+    """one direction of simulated stream, data reach the peer reader after link delay"""
+
+    def __init__(self, transport: 'SimTransport', local, peer, own_reader, peer_reader):
+        self.transport = self  # User checks `writer.transport.is_closing()`
+        self._sim = transport
+        self._local = local
+        self._peer = peer
+        self._own_reader: SimStreamReader = own_reader
+        self._peer_reader: SimStreamReader = peer_reader
+        self._closing = False
+        self._last_arrival = 0.0  # keep stream order
+        self._pending = deque()  # data in flight, timers of same arrival time may fire in any order
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self._peer
+        elif name == 'sockname':
+            return self._local
+        return default
+
+    def write(self, data):
+        if self._closing or len(data) == 0:
+            return
+        arrival = self._sim.network.arrival(self._sim, self._peer[0], len(data), f_stream=True)
+        if arrival is None:
+            return  # partitioned, data go nowhere
+        arrival = max(arrival, self._last_arrival)
+        self._last_arrival = arrival
+        self._pending.append(bytes(data))
+        asyncio.get_event_loop().call_at(arrival, self._deliver)
+
+    def _deliver(self):
+        data = self._pending.popleft()
+        if data is None:
+            self._peer_reader.feed_eof()
+        else:
+            self._peer_reader.feed_data(data)
+
+    async def drain(self):
+        if self._closing:
+            raise ConnectionResetError('stream is closed')
+        await asyncio.sleep(0.0)
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._own_reader.feed_eof()
+        loop = asyncio.get_event_loop()
+        latency = self._sim.network.link(self._sim.host, self._peer[0])[0]
+        self._pending.append(None)  # eof
+        loop.call_at(max(loop.time() + latency, self._last_arrival), self._deliver)
+
+    def is_closing(self):
+        return self._closing
+
+    async def wait_closed(self):
+        pass
+
+
+class SimTransport(Transport):
+    """transport of a node on SimNetwork, host is the node's own address"""
+
+    def __init__(self, network: 'SimNetwork', host, bandwidth=None):
+        self.network = network
+        self.host = host
+        self.bandwidth = network.bandwidth if bandwidth is None else bandwidth
+        self.port: Optional[int] = None
+        self.busy_until = 0.0  # uplink is sending until
+        self._ephemeral = 49152
+
+    def start(self, core, s_family=None):
+        self.port = core.config.P2P_PORT
+        if core.config.P2P_ACCEPT:
+            self.network.stream_servers[(self.host, self.port)] = core.initial_connection_check
+        if core.config.P2P_UDP_ACCEPT:
+            self.network.datagram_servers[(self.host, self.port)] = core.datagram_received
+        log.debug(f"setup simulated server {self.host}:{self.port}")
+
+    def close(self):
+        self.network.stream_servers.pop((self.host, self.port), None)
+        self.network.datagram_servers.pop((self.host, self.port), None)
+
+    async def open_connection(self, host, port, excludes=(), proxy=None):
+        if host in excludes:
+            raise ConnectionRefusedError(f"baned address {host}")
+        if self.network.is_blocked(self.host, host):
+            await asyncio.sleep(CONNECT_TIMEOUT)
+            raise asyncio.TimeoutError(f"partitioned {host}")
+        await asyncio.sleep(2 * self.network.link(self.host, host)[0])  # SYN and SYN-ACK
+        handler = self.network.stream_servers.get((host, port))
+        if handler is None:
+            raise ConnectionRefusedError(f"no server {host}:{port}")
+        self._ephemeral = self._ephemeral + 1 if self._ephemeral < 65535 else 49152
+        local, remote = (self.host, self._ephemeral), (host, port)
+        client_reader, server_reader = SimStreamReader(), SimStreamReader()
+        client_writer = SimStreamWriter(self, local, remote, client_reader, server_reader)
+        server_writer = SimStreamWriter(self.network.hosts[host], remote, local, server_reader, client_reader)
+        self.network.counter['streams'] += 1
+        asyncio.ensure_future(handler(server_reader, server_writer))
+        return client_reader, client_writer, remote
+
+    def send_datagram(self, data, host_port):
+        self.network.send_datagram(self, bytes(data), tuple(host_port))
+
+    async def is_reachable(self, host, port):
+        if self.network.is_blocked(self.host, host):
+            return False
+        await asyncio.sleep(2 * self.network.link(self.host, host)[0])
+        return (host, port) in self.network.stream_servers
+
+
+class SimNetwork(object):
+    """
+    in-memory network, thousands of nodes run in one process
+    params:
+        latency: (float) one way delay seconds
+        bandwidth: (float) uplink bytes per second of each host, 0 is unlimited
+        loss: (float) datagram loss ratio, lost stream segment is delayed by retransmit
+        seed: (int) random seed of loss
+    usage:
+        network = SimNetwork(latency=0.05, bandwidth=1000000, loss=0.01, seed=1)
+        p2p = Peer2Peer(transport=network.create_transport())
+    """
+
+    def __init__(self, latency=0.02, bandwidth=0, loss=0.0, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.hosts: Dict[str, SimTransport] = dict()
+        self.links: Dict[tuple, tuple] = dict()  # {(host, host): (latency, loss)} overwrite default
+        self.groups: Dict[str, int] = dict()  # {host: partition group}
+        self.stream_servers: Dict[tuple, Callable] = dict()  # {(host, port): handler(reader, writer)}
+        self.datagram_servers: Dict[tuple, Callable] = dict()  # {(host, port): handler(data, addr)}
+        self.counter = {
+            'streams': 0,  # opened
+            'stream_bytes': 0,
+            'datagrams': 0,  # delivered
+            'datagram_bytes': 0,
+            'lost': 0,  # datagram lost
+            'retransmit': 0,  # stream segment delayed
+            'blocked': 0,  # dropped by partition
+        }
+
+    def create_transport(self, host=None, bandwidth=None) -> SimTransport:
+        """transport of a new host, address is 10.x.x.x by default"""
+        if host is None:
+            number = len(self.hosts) + 1
+            host = "10.{}.{}.{}".format(number >> 16 & 0xff, number >> 8 & 0xff, number & 0xff)
+        assert host not in self.hosts, f"already used host {host}"
+        transport = self.hosts[host] = SimTransport(self, host, bandwidth)
+        return transport
+
+    def set_link(self, host_a, host_b, latency=None, loss=None):
+        """overwrite delay and loss between two hosts"""
+        key = (host_a, host_b) if host_a < host_b else (host_b, host_a)
+        self.links[key] = (self.latency if latency is None else latency, self.loss if loss is None else loss)
+
+    def link(self, host_a, host_b) -> tuple:
+        """(latency, loss)"""
+        key = (host_a, host_b) if host_a < host_b else (host_b, host_a)
+        return self.links.get(key) or (self.latency, self.loss)
+
+    def partition(self, *groups: Iterable[str]):
+        """hosts in different groups cannot reach each other, hosts in no group reach all"""
+        self.groups = {host: index for index, hosts in enumerate(groups) for host in hosts}
+
+    def heal(self):
+        self.groups.clear()
+
+    def is_blocked(self, host_a, host_b) -> bool:
+        group_a = self.groups.get(host_a)
+        group_b = self.groups.get(host_b)
+        return group_a is not None and group_b is not None and group_a != group_b
+
+    def arrival(self, sender: SimTransport, host, size, f_stream) -> Optional[float]:
+        """arrival time on loop clock, None if dropped"""
+        if self.is_blocked(sender.host, host):
+            self.counter['blocked'] += 1
+            return None
+        latency, loss = self.link(sender.host, host)
+        now = asyncio.get_event_loop().time()
+        if sender.bandwidth:
+            sender.busy_until = max(now, sender.busy_until) + size / sender.bandwidth
+            now = sender.busy_until
+        if loss and self.random.random() < loss:
+            if not f_stream:
+                self.counter['lost'] += 1
+                return None
+            self.counter['retransmit'] += 1
+            now += RETRANSMIT_RTT * 2 * latency
+        self.counter['stream_bytes' if f_stream else 'datagram_bytes'] += size
+        return now + latency
+
+    def send_datagram(self, sender: SimTransport, data, host_port):
+        arrival = self.arrival(sender, host_port[0], len(data), f_stream=False)
+        if arrival is not None:
+            asyncio.get_event_loop().call_at(arrival, self._deliver_datagram, data, (sender.host, sender.port), host_port)
+
+    def _deliver_datagram(self, data, addr, host_port):
+        handler = self.datagram_servers.get(host_port)
+        if handler is not None:
+            self.counter['datagrams'] += 1
+            handler(data, addr)
+
+    def getinfo(self):
+        return {
+            'hosts': len(self.hosts),
+            'stream_servers': len(self.stream_servers),
+            'datagram_servers': len(self.datagram_servers),
+            'partitions': len(set(self.groups.values())),
+            'counter': self.counter.copy(),
+        }
+
+
+__all__ = [
+    "VirtualClockLoop",
+    "SimStreamReader",
+    "SimStreamWriter",
+    "SimTransport",
+    "SimNetwork",
+]
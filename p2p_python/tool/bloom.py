@@ -0,0 +1,123 @@
+from logging import getLogger
+from hashlib import blake2b
+from collections import deque
+from time import time
+import math
+
+log = getLogger(__name__)
+LN2 = math.log(2)
+
+
+class BloomFilter(object):
+    """fixed size bloom filter"""
+    __slots__ = ("size", "hashes", "bits", "count", "capacity")
+
+    def __init__(self, capacity, error_rate):
+        assert 0 < capacity and 0.0 < error_rate < 1.0
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (LN2 * LN2))))
+        self.hashes = max(1, int(round(self.size / capacity * LN2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __contains__(self, key):
+        bits = self.bits
+        for i in self._indexes(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key):
+        bits = self.bits
+        for i in self._indexes(key):
+            bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def _indexes(self, key):
+        # enhanced double hashing, plain h1+i*h2 collapses when h2 shares a factor with size
+        if not isinstance(key, bytes):
+            key = str(key).encode()
+        digest = blake2b(key, digest_size=16).digest()
+        size = self.size
+        h1 = int.from_bytes(digest[:8], 'big') % size
+        h2 = int.from_bytes(digest[8:], 'big') % size
+        indexes = list()
+        for i in range(self.hashes):
+            indexes.append(h1)
+            h1 = (h1 + h2) % size
+            h2 = (h2 + i + 1) % size
+        return indexes
+
+
+class RotatingBloomFilter(object):
+    """
+    time bucketed bloom filters, a key is remembered at least `max_age` seconds
+    a generation grows by a tighter filter when full (scalable bloom filter),
+    keys are dropped only by time based rotation.
+    params:
+        capacity: (int) number of keys per filter
+        error_rate: (float) total false positive rate of all generations
+        max_age: (float) minimum lifetime of a key
+        generations: (int) number of generations, the oldest is dropped on rotation
+    """
+    TIGHTENING = 0.5  # error rate ratio of a grown filter, sum of a generation < 2x first one
+
+    def __init__(self, capacity=100000, error_rate=1e-6, max_age=90.0, generations=3):
+        assert 2 <= generations
+        self.capacity = capacity
+        self.error_rate = error_rate / generations / 2
+        self.span = max_age / (generations - 1)
+        self.generations = deque([[BloomFilter(capacity, self.error_rate)]], maxlen=generations)
+        self.rotate_time = time()
+        self.overflow = 0
+
+    def __contains__(self, key):
+        self._check_rotation()
+        for filters in self.generations:
+            for bloom in filters:
+                if key in bloom:
+                    return True
+        return False
+
+    def __len__(self):
+        return sum(len(bloom) for filters in self.generations for bloom in filters)
+
+    def add(self, key):
+        self._check_rotation()
+        filters = self.generations[-1]
+        bloom = filters[-1]
+        if bloom.capacity <= bloom.count:
+            # too many keys in span, grow instead of forgetting keys younger than max_age
+            self.overflow += 1
+            log.debug(f"bloom filter grow, capacity={self.capacity} is too small")
+            bloom = BloomFilter(self.capacity, self.error_rate * self.TIGHTENING ** len(filters))
+            filters.append(bloom)
+        bloom.add(key)
+
+    def getinfo(self):
+        return {
+            'keys': len(self),
+            'generations': len(self.generations),
+            'filters': sum(len(filters) for filters in self.generations),
+            'memory': sum(len(bloom.bits) for filters in self.generations for bloom in filters),
+            'overflow': self.overflow,
+        }
+
+    def _check_rotation(self):
+        passed = time() - self.rotate_time
+        if self.span < passed:
+            for _ in range(min(self.generations.maxlen, int(passed // self.span))):
+                self._rotate()
+
+    def _rotate(self):
+        self.generations.append([BloomFilter(self.capacity, self.error_rate)])
+        self.rotate_time = time()
+
+
+__all__ = [
+    "BloomFilter",
+    "RotatingBloomFilter",
+]
@@ -0,0 +1,87 @@
+from logging import getLogger
+from typing import Dict, List, Callable, Awaitable, Iterable, Optional
+import asyncio
+
+log = getLogger(__name__)
+
+
+class Dialer(object):
+    """
+    dial candidates in parallel under concurrency cap,
+    surplus in-flight dials are cancelled when reach required number
+    params:
+        dial: (coroutine function) `dial(host, port) -> bool` ex. Core.create_connection
+        concurrency: (int) max number of in-flight dials
+    """
+
+    def __init__(self, dial: Callable[[str, int], Awaitable[bool]], concurrency=4):
+        assert 0 < concurrency
+        self.dial = dial
+        self.concurrency = concurrency
+        self.running = 0
+        self.success = 0
+        self.failure = 0
+        self.cancelled = 0
+
+    def getinfo(self):
+        return {
+            'concurrency': self.concurrency,
+            'running': self.running,
+            'success': self.success,
+            'failure': self.failure,
+            'cancelled': self.cancelled,
+        }
+
+    async def connect(self, candidates: Iterable[tuple], need: int,
+                      on_result: Optional[Callable[[tuple, bool], None]] = None) -> List[tuple]:
+        """
+        dial candidates in order until `need` connections are created
+        return connected host_port list, on_result is called with (host_port, result) except cancelled
+        """
+        connected = list()
+        if need <= 0:
+            return connected
+        candidates = iter(candidates)
+        pending: Dict[asyncio.Future, tuple] = dict()
+        try:
+            while len(connected) < need:
+                # fill dial slots, surplus is cancelled later
+                while len(pending) < self.concurrency:
+                    host_port = next(candidates, None)
+                    if host_port is None:
+                        break
+                    pending[asyncio.ensure_future(self.dial(host_port[0], host_port[1]))] = host_port
+                    self.running += 1
+                if len(pending) == 0:
+                    break  # no candidates
+                done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    host_port = pending.pop(future)
+                    self.running -= 1
+                    try:
+                        result = bool(future.result())
+                    except Exception:
+                        log.debug(f"dial error {host_port}", exc_info=True)
+                        result = False
+                    if result:
+                        self.success += 1
+                        connected.append(host_port)
+                    else:
+                        self.failure += 1
+                    if on_result:
+                        on_result(host_port, result)
+        finally:
+            # cancel surplus dials
+            for future in pending.keys():
+                future.cancel()
+            if pending:
+                await asyncio.gather(*pending.keys(), return_exceptions=True)
+                log.debug(f"cancel {len(pending)} surplus dials")
+                self.running -= len(pending)
+                self.cancelled += len(pending)
+        return connected
+
+
+__all__ = [
+    "Dialer",
+]
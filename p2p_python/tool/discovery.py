@@ -0,0 +1,176 @@
+from logging import getLogger
+from typing import Dict, List, Optional, Callable
+from time import time
+import asyncio
+import socket
+import random
+import json
+import os
+
+log = getLogger(__name__)
+
+NAME_SERVER = '8.8.8.8'
+IPV4_PROVIDERS = [
+    'http://api.ipify.org/',
+    'http://myip.dnsomatic.com',
+    'http://inet-ip.info/ip',
+    'http://v4.ident.me/',
+]
+IPV6_PROVIDERS = [
+    'http://v6.ipv6-test.com/api/myip.php',
+    'http://v6.ident.me/',
+]
+DISCOVERY_TIMEOUT = 5.0  # for each kind of address
+CACHE_TTL = 6 * 3600.0
+KINDS = ('local_ip', 'global_ipv4', 'global_ipv6')
+
+
+def lookup_localhost_ip(timeout=DISCOVERY_TIMEOUT) -> str:
+    """local ip address of default route, UDP connect sends no packet"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect((NAME_SERVER, 80))
+        return sock.getsockname()[0]
+
+
+def lookup_global_ip(providers: List[str], timeout=DISCOVERY_TIMEOUT) -> str:
+    """ask providers in random order until deadline, "" if not found"""
+    from urllib.request import urlopen
+    import ipaddress
+    deadline = time() + timeout
+    for url in random.sample(providers, len(providers)):
+        remain = deadline - time()
+        if remain <= 0.0:
+            break
+        try:
+            with urlopen(url, timeout=remain) as response:
+                address = response.read(64).decode().strip()
+            ipaddress.ip_address(address)  # reject error page
+            return address
+        except Exception as e:
+            log.debug(f"failed to get address from {url} by {e}")
+    return ""
+
+
+class AddressDiscovery(object):
+    """
+    my addresses found in background with timeout and cached on disk
+    address is None while unknown and "" if not found
+    params:
+        path: (str) cache file, None is no cache
+        ttl: (float) cache is fresh until
+        overrides: (dict) {kind: address} skip discovery (ex. from config)
+    replace `lookups` by stubs to work offline or on simulation
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl=CACHE_TTL, timeout=DISCOVERY_TIMEOUT, overrides=None):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.overrides = {kind: address for kind, address in (overrides or dict()).items() if address is not None}
+        self.addresses: Dict[str, Optional[str]] = dict.fromkeys(KINDS)
+        self.callbacks: List[Callable[[str, str], None]] = list()  # callback(kind, address)
+        self.lookups: Dict[str, Callable[[float], str]] = {  # blocking, run in executor
+            'local_ip': lookup_localhost_ip,
+            'global_ipv4': lambda timeout: lookup_global_ip(IPV4_PROVIDERS, timeout),
+            'global_ipv6': lambda timeout: lookup_global_ip(IPV6_PROVIDERS, timeout),
+        }
+        self.cached = False
+        self.future: Optional[asyncio.Future] = None
+
+    def add_callback(self, callback: Callable[[str, str], None]):
+        """called when an address is found, known addresses are notified now"""
+        self.callbacks.append(callback)
+        for kind, address in self.addresses.items():
+            if address:
+                callback(kind, address)
+
+    def start(self) -> asyncio.Future:
+        """start discovery once in background"""
+        if self.future is None:
+            self.future = asyncio.ensure_future(self.discover())
+        return self.future
+
+    async def discover(self):
+        cache = self._load()
+        self.cached = 0 < len(cache)
+        for kind in KINDS:
+            address = self.overrides.get(kind, cache.get(kind))
+            if address is not None:
+                self._found(kind, address)
+        missing = [kind for kind in KINDS if self.addresses[kind] is None]
+        if len(missing) == 0:
+            return
+        results = await asyncio.gather(*(self._lookup(kind) for kind in missing))
+        for kind, address in zip(missing, results):
+            self._found(kind, address)
+        log.info(f"discover my addresses {self.addresses}")
+        self._save()
+
+    async def _lookup(self, kind) -> str:
+        loop = asyncio.get_event_loop()
+        try:
+            future = loop.run_in_executor(None, self.lookups[kind], self.timeout)
+            return await asyncio.wait_for(future, self.timeout + 1.0)
+        except asyncio.TimeoutError:
+            log.debug(f"timeout on {kind} discovery")
+        except Exception as e:
+            log.debug(f"failed {kind} discovery by {e}")
+        return ""
+
+    def _found(self, kind, address):
+        self.addresses[kind] = address
+        if address:
+            for callback in self.callbacks:
+                try:
+                    callback(kind, address)
+                except Exception:
+                    log.error("address callback exception", exc_info=True)
+
+    def _load(self) -> dict:
+        """fresh cache, discovered addresses only"""
+        if self.path is None or not os.path.exists(self.path):
+            return dict()
+        try:
+            with open(self.path, mode='r') as fp:
+                cache = json.load(fp)
+            if time() - cache.pop('time') < self.ttl:
+                return {kind: cache[kind] for kind in KINDS if cache.get(kind)}
+        except Exception as e:
+            log.debug(f"ignore broken address cache by {e}")
+        return dict()
+
+    def _save(self):
+        """not found "" is not cached to retry on next start"""
+        if self.path is None:
+            return
+        cache = {kind: address for kind, address in self.addresses.items()
+                 if address and kind not in self.overrides}
+        if len(cache) == 0:
+            return
+        cache['time'] = time()
+        try:
+            with open(self.path, mode='w') as fp:
+                json.dump(cache, fp)
+        except OSError as e:
+            log.debug(f"failed to save address cache by {e}")
+
+    def getinfo(self):
+        return {
+            'addresses': self.addresses.copy(),
+            'overrides': list(self.overrides),
+            'cached': self.cached,
+            'finished': self.future is not None and self.future.done(),
+        }
+
+
+__all__ = [
+    "NAME_SERVER",
+    "IPV4_PROVIDERS",
+    "IPV6_PROVIDERS",
+    "DISCOVERY_TIMEOUT",
+    "CACHE_TTL",
+    "lookup_localhost_ip",
+    "lookup_global_ip",
+    "AddressDiscovery",
+]
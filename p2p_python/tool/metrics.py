@@ -0,0 +1,369 @@
+from logging import getLogger
+from typing import Dict, List, Tuple, Callable, Optional
+from bisect import bisect_left
+from abc import ABC, abstractmethod
+import asyncio
+
+loop = asyncio.get_event_loop()
+log = getLogger(__name__)
+
+# latency buckets (seconds)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, '_Metric'] = dict()
+
+    def labels(self, *values):
+        """child metric of the label values"""
+        assert len(values) == len(self.labelnames), 'wrong label values'
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        return self.__class__(self.name, self.documentation)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """[(suffix, labels, value),..]"""
+        if not self.labelnames:
+            return self._samples('')
+        result = list()
+        for values, child in list(self._children.items()):
+            result.extend(child._samples(_format_labels(self.labelnames, values)))
+        return result
+
+    @abstractmethod
+    def _samples(self, labels) -> List[Tuple[str, str, float]]:
+        """samples of this metric without children"""
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _samples(self, labels):
+        return [('', labels, self.value)]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def _samples(self, labels):
+        return [('', labels, self.value)]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _samples(self, labels):
+        result = list()
+        cumulative = 0
+        inner = labels[1:-1] + ',' if labels else ''
+        for le, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            result.append(('_bucket', '{' + inner + 'le="{}"'.format(_format_value(le)) + '}', cumulative))
+        result.append(('_sum', labels, self.sum))
+        result.append(('_count', labels, self.count))
+        return result
+
+
+class _NullMetric(object):
+    """do nothing, used when metrics disabled"""
+    __slots__ = ()
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NULL_METRIC = _NullMetric()
+
+
+class NullRegistry(object):
+    """disabled registry, every metric is no-op"""
+    enabled = False
+
+    def counter(self, name, documentation, labelnames=()):
+        return NULL_METRIC
+
+    def gauge(self, name, documentation, labelnames=()):
+        return NULL_METRIC
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return NULL_METRIC
+
+    def collector(self, name, documentation, kind, fnc, labels=None):
+        pass
+
+    def remove_collectors(self, labels):
+        pass
+
+    def remove_instance(self, labels):
+        pass
+
+    def render(self) -> str:
+        return ''
+
+
+class Registry(object):
+    """metrics and collectors rendered in Prometheus text format"""
+    enabled = True
+
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = dict()
+        # {name: (documentation, kind, [(labels dict, fnc),..])} fnc() -> value or [(labels dict, value),..]
+        self.collectors: Dict[str, tuple] = dict()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Histogram(name, documentation, labelnames, buckets)
+        return metric
+
+    def collector(self, name, documentation, kind, fnc: Callable, labels: Optional[dict] = None):
+        """
+        value collected on scrape, no cost on hot path
+        labels: (dict) identify the instance, ex. {'node': name} for many nodes in a process
+        """
+        assert kind in ('counter', 'gauge')
+        labels = labels or dict()
+        if name not in self.collectors:
+            self.collectors[name] = (documentation, kind, list())
+        fncs = self.collectors[name][2]
+        fncs[:] = [(others, other) for others, other in fncs if others != labels]
+        fncs.append((labels, fnc))
+
+    def remove_collectors(self, labels: dict):
+        """remove collectors of the instance"""
+        for name, (_, _, fncs) in list(self.collectors.items()):
+            fncs[:] = [(others, fnc) for others, fnc in fncs if others != labels]
+            if len(fncs) == 0:
+                del self.collectors[name]
+
+    def remove_instance(self, labels: dict):
+        """remove collectors and metric series of the instance"""
+        self.remove_collectors(labels)
+        for metric in self.metrics.values():
+            if not labels or not all(name in metric.labelnames for name in labels):
+                continue
+            index = [(metric.labelnames.index(name), value) for name, value in labels.items()]
+            for values in list(metric._children):
+                if all(values[position] == value for position, value in index):
+                    del metric._children[values]
+
+    def render(self) -> str:
+        lines = list()
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{name}{suffix}{labels} {_format_value(value)}")
+        for name, (documentation, kind, fncs) in self.collectors.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for instance, fnc in list(fncs):
+                try:
+                    value = fnc()
+                except Exception:
+                    log.debug(f"metrics collector {name} failed", exc_info=True)
+                    continue
+                if not isinstance(value, list):
+                    value = [(dict(), value)]
+                for labels, item in value:
+                    labels = dict(instance, **labels)
+                    labels = _format_labels(tuple(labels.keys()), tuple(labels.values()))
+                    lines.append(f"{name}{labels} {_format_value(item)}")
+        return '\n'.join(lines) + '\n'
+
+    async def start(self, host='127.0.0.1', port=9100):
+        """start local HTTP endpoint `/metrics`, event loop lag is read from watchdog"""
+        from p2p_python.tool.watchdog import enable_watchdog
+        watchdog = enable_watchdog()
+        self.collector('p2p_event_loop_lag_seconds', 'event loop scheduling lag', 'gauge', lambda: watchdog.lag)
+        self.collector('p2p_event_loop_lag_max_seconds', 'max event loop lag', 'gauge', lambda: watchdog.lag_max)
+        self._server = await asyncio.start_server(self._handle, host, port)
+        log.info(f"metrics endpoint http://{host}:{port}/metrics")
+
+    def close(self):
+        if self._server:
+            self._server.close()
+
+    def _register(self, cls, name, documentation, labelnames):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, documentation, labelnames)
+        assert isinstance(metric, cls), f"{name} is registered as {metric.kind}"
+        return metric
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5.0)
+            path = request.split(b' ')[1] if request.count(b' ') >= 2 else b''
+            if path.split(b'?')[0] == b'/metrics':
+                status, body = b'200 OK', self.render().encode()
+            else:
+                status, body = b'404 Not Found', b'not found\n'
+            writer.write(b'HTTP/1.1 ' + status + b'\r\n'
+                         b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except Exception:
+            log.debug("metrics request failed", exc_info=True)
+        finally:
+            writer.close()
+
+
+class BoundMetric(object):
+    """
+    metric of an instance, resolved from the current registry on use and labeled by the instance
+    ex. BoundMetric('counter', name, documentation, ('cmd',), {'node': name}).labels(cmd).inc()
+    """
+    __slots__ = ('kind', 'name', 'documentation', 'labelnames', 'instance', 'kwargs', '_registry', '_metric')
+
+    def __init__(self, kind, name, documentation, labelnames=(), instance: Optional[dict] = None, **kwargs):
+        assert kind in ('counter', 'gauge', 'histogram')
+        instance = instance or dict()
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(instance.keys()) + tuple(labelnames)
+        self.instance = tuple(instance.values())
+        self.kwargs = kwargs
+        self._registry = None
+        self._metric = NULL_METRIC
+
+    def labels(self, *values):
+        if self._registry is not registry:
+            self._registry = registry
+            self._metric = getattr(registry, self.kind)(
+                self.name, self.documentation, self.labelnames, **self.kwargs)
+        return self._metric.labels(*self.instance, *values)
+
+
+# disabled by default, replaced by enable_metrics()
+registry = NullRegistry()
+# {instance labels: setup(registry)} collectors of living instances, set again when enabled
+_instances: Dict[tuple, Callable] = dict()
+
+
+def get_registry():
+    return registry
+
+
+def register_instance(labels: dict, setup: Callable[[Registry], None]):
+    """setup collectors of the instance now if enabled, or when enable_metrics() later"""
+    _instances[tuple(sorted(labels.items()))] = setup
+    if registry.enabled:
+        setup(registry)
+
+
+def unregister_instance(labels: dict):
+    """remove the instance on close"""
+    _instances.pop(tuple(sorted(labels.items())), None)
+    registry.remove_instance(labels)
+
+
+def enable_metrics(host='127.0.0.1', port=9100) -> Registry:
+    """enable metrics, endpoint starts with event loop and failure is logged"""
+    global registry
+    if not registry.enabled:
+        registry = Registry()
+        for setup in list(_instances.values()):
+            setup(registry)
+        future = asyncio.ensure_future(registry.start(host, port))
+        future.add_done_callback(_log_start_error)
+    return registry
+
+
+def _log_start_error(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error(f"failed to start metrics endpoint by {future.exception()!r}")
+
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "NullRegistry",
+    "Registry",
+    "BoundMetric",
+    "get_registry",
+    "register_instance",
+    "unregister_instance",
+    "enable_metrics",
+]
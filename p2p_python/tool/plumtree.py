@@ -0,0 +1,102 @@
+from p2p_python.user import User
+from expiringdict import ExpiringDict
+from logging import getLogger
+from typing import Dict, List, Set, Iterable, Tuple
+import asyncio
+
+loop = asyncio.get_event_loop()
+log = getLogger(__name__)
+
+
+class PlumTree(object):
+    """
+    epidemic broadcast tree (Plumtree)
+    full message is pushed along the spanning tree (eager peers),
+    others (lazy peers) receive only IHAVE announcement and pull by GRAFT on demand.
+    """
+
+    def __init__(self, ihave_timeout=1.0, cache_len=5000, cache_age=90, min_eager=2):
+        self.lazy: Set[User] = set()  # peers which receive only IHAVE
+        self.missing: Dict[int, List[User]] = dict()  # {uuid: [announcer,..]} announced but not received
+        self.timers: Dict[int, asyncio.TimerHandle] = dict()  # {uuid: IHAVE timeout handle}
+        self.cache: Dict[int, object] = ExpiringDict(max_len=cache_len, max_age_seconds=cache_age)
+        self.ihave_timeout = ihave_timeout
+        self.min_eager = min_eager  # tree keeps covering the mesh after a link lost
+        self.counter = {
+            'receive': 0,  # new broadcast received
+            'duplicate': 0,  # duplicate broadcast received
+            'eager': 0,  # full message pushed
+            'lazy': 0,  # IHAVE announced
+            'graft': 0,  # GRAFT sent for missing message
+            'prune': 0,  # PRUNE sent for duplicate link
+        }
+
+    def getinfo(self):
+        return {
+            'lazy': len(self.lazy),
+            'missing': len(self.missing),
+            'cache': len(self.cache),
+            'counter': self.counter.copy(),
+        }
+
+    def split(self, users: Iterable[User]) -> Tuple[List[User], List[User]]:
+        """split connections to eager and lazy, repair tree if eager links are less than min_eager"""
+        users = [user for user in users if not user.closed]
+        # forget disconnected peers
+        self.lazy.intersection_update(users)
+        eager = [user for user in users if user not in self.lazy]
+        lazy = [user for user in users if user in self.lazy]
+        while len(eager) < self.min_eager and 0 < len(lazy):
+            # eager links are lost, promote a lazy link
+            user = lazy.pop(0)
+            self.lazy.discard(user)
+            eager.append(user)
+            log.debug(f"plumtree repair by promoting {user}")
+        return eager, lazy
+
+    def graft(self, user: User):
+        """link become a part of tree"""
+        self.lazy.discard(user)
+
+    def prune(self, user: User):
+        """link is removed from tree"""
+        self.lazy.add(user)
+
+    def receive(self, uuid, data):
+        """cache for GRAFT and stop waiting"""
+        self.cache[uuid] = data
+        self.missing.pop(uuid, None)
+        handle = self.timers.pop(uuid, None)
+        if handle:
+            handle.cancel()
+
+    def announce(self, uuid, user: User, callback):
+        """IHAVE received, call `callback(uuid)` when message still missing after timeout"""
+        if uuid in self.cache:
+            return
+        announcers = self.missing.setdefault(uuid, list())
+        if user not in announcers:
+            announcers.append(user)
+        if uuid not in self.timers:
+            self.timers[uuid] = loop.call_later(self.ihave_timeout, callback, uuid)
+
+    def next_announcer(self, uuid, callback):
+        """pop a announcer of missing message and reschedule for next announcer"""
+        handle = self.timers.pop(uuid, None)
+        if handle:
+            handle.cancel()
+        announcers = self.missing.get(uuid)
+        if not announcers:
+            self.missing.pop(uuid, None)
+            return None
+        user = announcers.pop(0)
+        if 0 < len(announcers):
+            self.timers[uuid] = loop.call_later(self.ihave_timeout, callback, uuid)
+        else:
+            del self.missing[uuid]
+        return user
+
+
+__all__ = [
+    "PlumTree",
+]
@@ -0,0 +1,151 @@
+from logging import getLogger
+from typing import Dict, List, Set, Optional, Iterable, Callable
+import heapq
+import random
+
+log = getLogger(__name__)
+
+
+class ScoreIndex(object):
+    """
+    incremental peer score used by stabilizer
+    score = number of connections which know the peer (second layer) - connected (first layer)
+    scores are updated only when connections or neers change,
+    join/remove candidates are taken from heaps with lazy deletion.
+    """
+
+    def __init__(self, scores: Optional[Dict[tuple, int]] = None, limit=20):
+        self.scores: Dict[tuple, int] = scores if scores is not None else dict()
+        self.limit = limit
+        self.second: Dict[tuple, int] = dict()  # {host_port: number of connections know it}
+        self.connected: Dict[tuple, object] = dict()  # {host_port: user}
+        self.neers: Dict[tuple, Set[tuple]] = dict()  # {connection: {host_port,..}}
+        self.known: Set[tuple] = set()  # peer list
+        self.known_epoch = 0
+        self.known_version = 0
+        self._join_heap: List[tuple] = list()  # [(-score, host_port),..] not connected
+        self._remove_heap: List[tuple] = list()  # [(score, host_port),..] connected
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add_known(self, host_port):
+        host_port = tuple(host_port)
+        if host_port not in self.known:
+            self.known.add(host_port)
+            self._update(host_port)
+
+    def discard_known(self, host_port):
+        host_port = tuple(host_port)
+        if host_port in self.known:
+            self.known.discard(host_port)
+            self._update(host_port)
+
+    def sync_known(self, peers):
+        """reflect peer list changes by its change log"""
+        changed = peers.changes.since(self.known_epoch, self.known_version)
+        if changed is None:
+            changed = self.known.union(peers.keys())  # full resync
+        for host_port in changed:
+            if host_port in peers:
+                self.add_known(host_port)
+            else:
+                self.discard_known(host_port)
+        self.known_epoch = peers.changes.epoch
+        self.known_version = peers.changes.version
+
+    def sync_connections(self, users):
+        """reflect opened and closed connections, cost is number of connections"""
+        current = {user.get_host_port(): user for user in users}
+        for host_port in self.connected.keys() - current.keys():
+            del self.connected[host_port]
+            self.set_neers(host_port, ())
+            self._update(host_port)
+        for host_port, user in current.items():
+            if self.connected.get(host_port) is not user:
+                # new connection or reconnected
+                self.connected[host_port] = user
+                self.set_neers(host_port, user.neers.keys())
+                self._update(host_port)
+
+    def set_neers(self, connection, neers: Iterable[tuple]):
+        """reflect changed neers of a connection"""
+        old = self.neers.get(connection, set())
+        new = set(neers) if connection in self.connected else set()
+        for host_port in old - new:
+            self.second[host_port] -= 1
+            if self.second[host_port] == 0:
+                del self.second[host_port]
+            self._update(host_port)
+        for host_port in new - old:
+            self.second[host_port] = self.second.get(host_port, 0) + 1
+            self._update(host_port)
+        if new:
+            self.neers[connection] = new
+        else:
+            self.neers.pop(connection, None)
+
+    def join_candidates(self, num, *excludes) -> List[tuple]:
+        """[(host_port, score),..] not connected peers of high score"""
+        return self._candidates(self._join_heap, -1, False, num, excludes)
+
+    def remove_candidates(self, num, *excludes) -> List[tuple]:
+        """[(host_port, score),..] connected peers of low score"""
+        return self._candidates(self._remove_heap, 1, True, num, excludes)
+
+    def _candidates(self, heap, sign, f_connected, num, excludes):
+        result = list()
+        popped = list()
+        seen = set()
+        while 0 < len(heap) and len(result) < num:
+            entry = heapq.heappop(heap)
+            key, host_port = entry
+            if host_port in seen \
+                    or (host_port in self.connected) is not f_connected \
+                    or self.scores.get(host_port) != key * sign:
+                continue  # outdated entry
+            seen.add(host_port)
+            popped.append(entry)
+            if any(host_port in exclude for exclude in excludes):
+                continue
+            result.append((host_port, key * sign))
+        for entry in popped:
+            heapq.heappush(heap, entry)
+        return result
+
+    def _update(self, host_port):
+        f_connected = host_port in self.connected
+        if f_connected or host_port in self.known or host_port in self.second:
+            score = self.second.get(host_port, 0) - (1 if f_connected else 0)
+            score = max(-self.limit, min(self.limit, score))
+            self.scores[host_port] = score
+            if f_connected:
+                heapq.heappush(self._remove_heap, (score, host_port))
+            else:
+                heapq.heappush(self._join_heap, (-score, host_port))
+        else:
+            self.scores.pop(host_port, None)
+        # drop outdated entries
+        if 4 * len(self.scores) + 64 < len(self._join_heap) + len(self._remove_heap):
+            self._rebuild()
+
+    def _rebuild(self):
+        self._join_heap = [(-score, host_port) for host_port, score in self.scores.items()
+                           if host_port not in self.connected]
+        self._remove_heap = [(score, host_port) for host_port, score in self.scores.items()
+                             if host_port in self.connected]
+        heapq.heapify(self._join_heap)
+        heapq.heapify(self._remove_heap)
+
+
+def weighted_order(items: Iterable, weight: Callable[[object], float]) -> list:
+    """random order, an item of large weight comes first more likely (weighted sampling without replacement)"""
+    keys = [(random.random() ** (1.0 / max(1e-6, weight(item))), index, item) for index, item in enumerate(items)]
+    keys.sort(reverse=True)
+    return [item for _key, _index, item in keys]
+
+
+__all__ = [
+    "ScoreIndex",
+    "weighted_order",
+]
@@ -0,0 +1,216 @@
+from logging import getLogger
+from typing import Dict, Optional, List, Tuple
+from collections import OrderedDict
+from time import time
+import asyncio
+import os
+
+log = getLogger(__name__)
+loop = asyncio.get_event_loop()
+
+
+class TTLCache(object):
+    """LRU cache with time-to-live for each item"""
+
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self._data: OrderedDict = OrderedDict()  # {key: (expire, value)}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def put(self, key, value, ttl):
+        self._data[key] = (time() + ttl, value)
+        self._data.move_to_end(key)
+        while self.maxlen < len(self._data):
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expire, value = item
+        if expire < time():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def ttl(self, key) -> float:
+        """remaining time, 0.0 if not found"""
+        item = self._data.get(key)
+        return max(0.0, item[0] - time()) if item else 0.0
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+
+class DiskStore(object):
+    """
+    bounded files in a directory, file name is `{name}-{expire}-{origin}`
+    index is built from file names, so start up does not read contents.
+    soonest expiring items are evicted when full, origin items are evicted last.
+    put_async() writes file in executor, index is updated after written.
+    params:
+        path: (str) directory
+        max_items: (int) max number of files
+        max_bytes: (int) max total size of files
+    """
+
+    def __init__(self, path, max_items=10000, max_bytes=32 * 1024 * 1024):
+        self.path = path
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.index: Dict[str, list] = dict()  # {name: [expire, size, f_origin, file name]}
+        self.total_bytes = 0
+        self._lock = asyncio.Lock()  # one put_async writes at once
+        os.makedirs(path, exist_ok=True)
+        self._load_index()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        item = self.index.get(name)
+        return item is not None and time() < item[0]
+
+    def getinfo(self):
+        return {
+            'items': len(self.index),
+            'bytes': self.total_bytes,
+            'origin': sum(1 for item in self.index.values() if item[2]),
+        }
+
+    def put(self, name: str, data: bytes, expire: float, f_origin=False) -> bool:
+        """write data, return False if no room"""
+        item = self._reserve(name, len(data), expire, f_origin)
+        if item is None:
+            return False
+        self._write_file(self.path, item[3], data)
+        self._commit(name, item)
+        return True
+
+    async def put_async(self, name: str, data: bytes, expire: float, f_origin=False) -> bool:
+        """put() writing file in executor, old data is read until written"""
+        async with self._lock:
+            item = self._reserve(name, len(data), expire, f_origin)
+            if item is None:
+                return False
+            await loop.run_in_executor(None, self._write_file, self.path, item[3], data)
+            self._commit(name, item)
+            return True
+
+    def get(self, name: str) -> Optional[Tuple[bytes, float, bool]]:
+        """(data, expire, f_origin) or None"""
+        item = self.index.get(name)
+        if item is None:
+            return None
+        elif item[0] < time():
+            self.remove(name)
+            return None
+        try:
+            with open(os.path.join(self.path, item[3]), mode='br') as fp:
+                return fp.read(), item[0], item[2]
+        except OSError:
+            log.debug(f"failed to read {item[3]}", exc_info=True)
+            self.remove(name)
+            return None
+
+    def remove(self, name: str):
+        item = self.index.pop(name, None)
+        if item:
+            self._remove_file(item)
+
+    def origin_names(self) -> List[str]:
+        return [name for name, item in self.index.items() if item[2]]
+
+    def cleanup(self) -> int:
+        """remove expired items"""
+        now = time()
+        expired = [name for name, item in self.index.items() if item[0] < now]
+        for name in expired:
+            self.remove(name)
+        return len(expired)
+
+    def _reserve(self, name, size, expire, f_origin) -> Optional[list]:
+        """make room and return new index item, None if no room"""
+        assert '-' not in name
+        old = self.index.get(name)
+        need_bytes = size - (old[1] if old else 0)
+        need_items = 0 if old else 1
+        if not self._make_room(need_items, need_bytes, f_origin, name):
+            return None
+        file_name = "{}-{}-{}".format(name, int(expire), int(f_origin))
+        return [int(expire), size, f_origin, file_name]
+
+    def _commit(self, name, item):
+        """replace index item after the file written"""
+        old = self.index.get(name)
+        if old and old[3] == item[3]:
+            self.total_bytes -= old[1]  # overwritten
+        elif old:
+            self._remove_file(old)
+        self.index[name] = item
+        self.total_bytes += item[1]
+
+    @staticmethod
+    def _write_file(path, file_name, data):
+        with open(os.path.join(path, file_name + '.tmp'), mode='bw') as fp:
+            fp.write(data)
+        os.replace(os.path.join(path, file_name + '.tmp'), os.path.join(path, file_name))
+
+    def _make_room(self, need_items, need_bytes, f_origin, name) -> bool:
+        if self.max_bytes < need_bytes:
+            return False
+        if len(self.index) + need_items <= self.max_items \
+                and self.total_bytes + need_bytes <= self.max_bytes:
+            return True
+        self.cleanup()
+        # evict others by expire order, origin items only for new origin item
+        victims = sorted((item[2], item[0], key) for key, item in self.index.items()
+                         if key != name and (f_origin or not item[2]))
+        for _, _, key in victims:
+            if len(self.index) + need_items <= self.max_items \
+                    and self.total_bytes + need_bytes <= self.max_bytes:
+                break
+            self.remove(key)
+        return len(self.index) + need_items <= self.max_items \
+            and self.total_bytes + need_bytes <= self.max_bytes
+
+    def _remove_file(self, item):
+        self.total_bytes -= item[1]
+        try:
+            os.remove(os.path.join(self.path, item[3]))
+        except OSError:
+            pass
+
+    def _load_index(self):
+        now = time()
+        for file_name in os.listdir(self.path):
+            full_path = os.path.join(self.path, file_name)
+            try:
+                name, expire, f_origin = file_name.split('-')
+                expire, f_origin = int(expire), bool(int(f_origin))
+            except ValueError:
+                os.remove(full_path)  # temporary or broken file
+                continue
+            old = self.index.get(name)
+            if expire < now or (old and expire < old[0]):
+                os.remove(full_path)
+                continue
+            elif old:
+                self._remove_file(old)
+            size = os.path.getsize(full_path)
+            self.index[name] = [expire, size, f_origin, file_name]
+            self.total_bytes += size
+        log.debug(f"load disk store {len(self.index)} items {self.total_bytes} bytes")
+
+
+__all__ = [
+    "TTLCache",
+    "DiskStore",
+]
@@ -0,0 +1,90 @@
+from p2p_python.tool.metrics import BoundMetric
+from logging import getLogger
+from typing import Dict, List, Callable, Optional
+from time import perf_counter
+from random import random
+
+log = getLogger(__name__)
+
+# pipeline stages are fast, finer buckets than default (seconds)
+STAGE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class StageTimer(object):
+    """
+    sampled duration of message pipeline stages
+    disabled by default, the hot path only checks `enabled` then.
+
+    stages:
+        receive: recv_framing, recv_decrypt, recv_decompress
+        inner loop: queue_wait, decode, dispatch
+        request: handler
+        send: send_compress, send_encrypt, send_write
+
+    usage:
+        p2p.core.timing.enable(sample_rate=0.05, callback=lambda stage, sec: print(stage, sec))
+    """
+
+    def __init__(self, instance: Optional[dict] = None):
+        self.enabled = False
+        self.sample_rate = 0.01
+        self.callbacks: List[Callable[[str, float], None]] = list()
+        self.histogram = BoundMetric('histogram', 'p2p_stage_seconds', 'sampled duration of message pipeline stage',
+                                     ('stage',), instance, buckets=STAGE_BUCKETS)
+        self.stats: Dict[str, list] = dict()  # {stage: [count, sum, max]}
+
+    def enable(self, sample_rate=0.01, callback: Optional[Callable[[str, float], None]] = None):
+        """start sampling, histogram is recorded if metrics enabled"""
+        assert 0.0 < sample_rate <= 1.0
+        self.sample_rate = sample_rate
+        if callback is not None and callback not in self.callbacks:
+            self.callbacks.append(callback)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def sample(self) -> bool:
+        """call only if enabled"""
+        return random() < self.sample_rate
+
+    def lap(self, stage: str, start: float) -> float:
+        """record from `start` (perf_counter) and return now as the next start"""
+        now = perf_counter()
+        self.record(stage, now - start)
+        return now
+
+    def record(self, stage: str, duration: float):
+        self.histogram.labels(stage).observe(duration)
+        stat = self.stats.get(stage)
+        if stat is None:
+            stat = self.stats[stage] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += duration
+        if stat[2] < duration:
+            stat[2] = duration
+        for callback in self.callbacks:
+            try:
+                callback(stage, duration)
+            except Exception:
+                log.debug(f"stage timing callback failed", exc_info=True)
+
+    def getinfo(self):
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'stages': {
+                stage: {
+                    'count': count,
+                    'mean': total / count,
+                    'max': maximum,
+                } for stage, (count, total, maximum) in self.stats.items()
+            },
+        }
+
+
+__all__ = [
+    "STAGE_BUCKETS",
+    "StageTimer",
+]
@@ -0,0 +1,157 @@
+from logging import getLogger
+from typing import Dict, List, Optional, Iterable
+from collections import OrderedDict
+from random import random
+from time import time
+import math
+
+log = getLogger(__name__)
+
+MAX_TRACE_HOPS = 32  # stop extending trace over this
+
+
+def _percentile(values: List[float], ratio: float) -> float:
+    """nearest-rank percentile of sorted values"""
+    return values[max(0, math.ceil(ratio * len(values)) - 1)]
+
+
+class BroadcastTracer(object):
+    """
+    sampled broadcast trace, `trace` of the message is hops [[name, time],..] from the origin
+    each relay node appends itself with the receive time, old nodes just drop it.
+    timestamps are wall clock of each node, so hop latency includes clock skew.
+    disabled if sample_rate is 0.0
+    """
+
+    def __init__(self, sample_rate=0.0, maxlen=1000):
+        self.sample_rate = sample_rate
+        self.maxlen = maxlen
+        self.traces: OrderedDict = OrderedDict()  # {uuid: [[name, time],..]} originated or received
+
+    def sample(self) -> bool:
+        return 0.0 < self.sample_rate and random() < self.sample_rate
+
+    def start(self, uuid, name) -> list:
+        """trace of a new broadcast"""
+        trace = [[name, time()]]
+        self._record(uuid, trace)
+        return trace
+
+    def relay(self, uuid, trace, name, received) -> Optional[list]:
+        """extended trace to relay, None if malformed"""
+        try:
+            trace = [[str(hop_name), float(hop_time)] for hop_name, hop_time in trace]
+        except (TypeError, ValueError):
+            log.debug(f"ignore malformed trace of {uuid}")
+            return None
+        if len(trace) == 0 or MAX_TRACE_HOPS <= len(trace):
+            return None
+        trace.append([name, received])
+        self._record(uuid, trace)
+        return trace
+
+    def getinfo(self):
+        hops = [len(trace) - 1 for trace in self.traces.values()]
+        delays = [trace[-1][1] - trace[0][1] for trace in self.traces.values()]
+        return {
+            'sample_rate': self.sample_rate,
+            'traces': len(self.traces),
+            'hops_mean': round(sum(hops) / len(hops), 2) if hops else None,
+            'hops_max': max(hops) if hops else None,
+            'delay_mean': round(sum(delays) / len(delays), 6) if delays else None,
+        }
+
+    def _record(self, uuid, trace):
+        self.traces[uuid] = trace
+        self.traces.move_to_end(uuid)
+        while self.maxlen < len(self.traces):
+            self.traces.popitem(last=False)
+
+
+class TraceCollector(object):
+    """
+    reconstruct propagation trees from traces gathered from many nodes
+    (ex. `tracer.traces` of each node collected by bench or by operator)
+    """
+
+    def __init__(self):
+        self.broadcasts: Dict[int, Dict[str, tuple]] = dict()  # {uuid: {name: (parent, time, hops)}}
+
+    def add(self, uuid, trace: list):
+        """merge a trace, the earliest arrival of each node is kept"""
+        nodes = self.broadcasts.setdefault(uuid, dict())
+        parent = None
+        for hops, (name, arrival) in enumerate(trace):
+            old = nodes.get(name)
+            if old is None or arrival < old[1]:
+                nodes[name] = (parent, arrival, hops)
+            parent = name
+
+    def add_traces(self, traces: Dict[int, list]):
+        for uuid, trace in traces.items():
+            self.add(uuid, trace)
+
+    def tree(self, uuid) -> Dict[Optional[str], List[str]]:
+        """{parent: [child,..]}, root is child of None"""
+        tree = dict()
+        for name, (parent, _, _) in self.broadcasts.get(uuid, dict()).items():
+            tree.setdefault(parent, list()).append(name)
+        return tree
+
+    def coverage(self, uuid, nodes: Optional[int] = None) -> List[float]:
+        """sorted seconds from the origin until each node received"""
+        items = self.broadcasts.get(uuid, dict()).values()
+        origin = min((arrival for parent, arrival, hops in items if hops == 0), default=None)
+        if origin is None:
+            return list()  # origin trace is not collected
+        delays = sorted(arrival - origin for _, arrival, _ in items)
+        if nodes is not None and len(delays) < nodes:
+            delays.extend([float('inf')] * (nodes - len(delays)))  # never reached
+        return delays
+
+    def report(self, nodes: Optional[int] = None, uuids: Optional[Iterable[int]] = None, slow=5) -> dict:
+        """
+        p50/p99 coverage time (seconds to reach 50%/99% of nodes) over broadcasts
+        params:
+            nodes: (int) network size, unreached nodes count as infinite
+        """
+        from statistics import median
+        p50 = list()
+        p99 = list()
+        hops = list()
+        edges: Dict[tuple, list] = dict()  # {(parent, child): [count, total latency]}
+        for uuid in (self.broadcasts if uuids is None else uuids):
+            delays = self.coverage(uuid, nodes)
+            if len(delays) == 0:
+                continue
+            p50.append(_percentile(delays, 0.5))
+            p99.append(_percentile(delays, 0.99))
+            items = self.broadcasts[uuid]
+            for name, (parent, arrival, hop) in items.items():
+                hops.append(hop)
+                if parent is not None and parent in items:
+                    edge = edges.setdefault((parent, name), [0, 0.0])
+                    edge[0] += 1
+                    edge[1] += arrival - items[parent][1]
+        slow_hops = sorted(edges.items(), key=lambda x: x[1][1] / x[1][0], reverse=True)[:slow]
+        return {
+            'broadcasts': len(p50),
+            'coverage_p50': round(median(p50), 6) if p50 else None,
+            'coverage_p99': round(median(p99), 6) if p99 else None,
+            'coverage_p99_max': round(max(p99), 6) if p99 else None,
+            'hops_mean': round(sum(hops) / len(hops), 2) if hops else None,
+            'hops_max': max(hops) if hops else None,
+            'slow_hops': [{
+                'parent': parent,
+                'child': child,
+                'count': count,
+                'latency': round(total / count, 6),
+            } for (parent, child), (count, total) in slow_hops],
+        }
+
+
+__all__ = [
+    "MAX_TRACE_HOPS",
+    "BroadcastTracer",
+    "TraceCollector",
+]
@@ -1,4 +1,6 @@
 from logging import getLogger
+from typing import Dict
+from array import array
 import collections
 import os.path
 import asyncio
@@ -7,17 +9,35 @@ import time
 loop = asyncio.get_event_loop()
 log = getLogger(__name__)
 
+# direction
+UP = 'up'
+DOWN = 'down'
+
+RING_SECONDS = 300  # longest rate window
+RATE_WINDOWS = (('1s', 1), ('1m', 60), ('5m', 300))
+
 
 class Traffic(object):
+    """
+    traffic counters by direction, peer and command
+    peer counters are wire size (compressed and encrypted), command counters are message size.
+    each counter is [up bytes, up messages, down bytes, down messages]
+    """
     f_stop = False
     f_finish = False
 
-    def __init__(self, recode_dir=None, span=300, max_hours=24):
-        self.data = collections.deque(maxlen=int(3600 * max_hours // span))
+    def __init__(self, recode_dir=None, span=300, max_hours=24, max_keys=1000):
+        self.data = collections.deque(maxlen=int(3600 * max_hours // span))  # [(time, up, down),..]
         self.recode_dir = recode_dir if recode_dir and os.path.exists(recode_dir) else None
         self.span = span  # 5min
-        self.traffic_up = list()
-        self.traffic_down = list()
+        self.max_keys = max_keys  # peers and commands kept
+        self.total = [0, 0, 0, 0]
+        self.peers: Dict[tuple, list] = dict()  # {host_port: counter}
+        self.commands: Dict[str, list] = dict()  # {cmd: counter}
+        self._span_total = [0, 0]  # [up bytes, down bytes] since last rollup
+        # bytes and messages per second, [up bytes, up messages, down bytes, down messages]
+        self._ring = [array('Q', bytes(8 * RING_SECONDS)) for _ in range(4)]
+        self._ring_time = int(time.time())
         self._future = asyncio.ensure_future(self.loop())
 
     def close(self):
@@ -27,18 +47,15 @@ class Traffic(object):
 
     async def loop(self):
         count = 0
-        while True:
+        while not self.f_stop:
             try:
-                wait_time = self.span
-                while not self.f_stop and 0.0 < wait_time:
-                    await asyncio.sleep(0.5)
-                    wait_time -= 0.5
-
+                await asyncio.sleep(self.span)  # cancelled by close
                 count += 1
-                ntime, up, down = int(time.time()), sum(self.traffic_up), sum(self.traffic_down)
+                ntime, (up, down) = int(time.time()), self._span_total
                 self.data.append((ntime, up, down))
-                self.traffic_up.clear()
-                self.traffic_down.clear()
+                self._span_total = [0, 0]
+                self._prune(self.peers)
+                self._prune(self.commands)
                 # recode
                 if self.recode_dir is None:
                     continue
@@ -57,13 +74,113 @@ class Traffic(object):
                 log.debug(e)
         self.f_finish = True
 
-    def put_traffic_up(self, b):
-        self.traffic_up.append(len(b))
+    def put_traffic_up(self, b, user=None):
+        """count sent bytes, `b` is bytes or size"""
+        self._put(0, b if isinstance(b, int) else len(b), user)
+
+    def put_traffic_down(self, b, user=None):
+        """count received bytes, `b` is bytes or size"""
+        self._put(2, b if isinstance(b, int) else len(b), user)
+
+    def put_command(self, cmd, direction, size):
+        """count a message by command"""
+        index = 0 if direction == UP else 2
+        counter = self.commands.get(cmd)
+        if counter is None:
+            counter = self.commands[cmd] = [0, 0, 0, 0]
+        counter[index] += size
+        counter[index + 1] += 1
+
+    def rates(self) -> dict:
+        """bytes and messages per second of the windows, the current second is not included"""
+        self._advance(int(time.time()))
+        now = self._ring_time
+        result = dict()
+        for name, seconds in RATE_WINDOWS:
+            slots = [(now - i) % RING_SECONDS for i in range(1, seconds + 1)]
+            up_bytes, up_msgs, down_bytes, down_msgs = (sum(ring[i] for i in slots) / seconds for ring in self._ring)
+            result[name] = {
+                'up': round(up_bytes, 1),
+                'down': round(down_bytes, 1),
+                'up_msgs': round(up_msgs, 2),
+                'down_msgs': round(down_msgs, 2),
+            }
+        return result
+
+    def top_talkers(self, num=10, by='peer', direction=None) -> list:
+        """
+        largest peers or commands by bytes
+        params:
+            by: (str) 'peer' or 'command'
+            direction: (str) UP, DOWN or None for both
+        """
+        items = self.peers if by == 'peer' else self.commands
+        if direction == UP:
+            key = lambda x: x[1][0]
+        elif direction == DOWN:
+            key = lambda x: x[1][2]
+        else:
+            key = lambda x: x[1][0] + x[1][2]
+        return [{
+            by: name,
+            'up': counter[0],
+            'up_msgs': counter[1],
+            'down': counter[2],
+            'down_msgs': counter[3],
+        } for name, counter in sorted(items.items(), key=key, reverse=True)[:num]]
+
+    def getinfo(self):
+        return {
+            'up': self.total[0],
+            'up_msgs': self.total[1],
+            'down': self.total[2],
+            'down_msgs': self.total[3],
+            'peers': len(self.peers),
+            'commands': len(self.commands),
+            'rates': self.rates(),
+        }
+
+    def _put(self, index, size, user):
+        self.total[index] += size
+        self.total[index + 1] += 1
+        self._span_total[index // 2] += size
+        # per second ring
+        now = int(time.time())
+        if now != self._ring_time:
+            self._advance(now)
+        slot = now % RING_SECONDS
+        self._ring[index][slot] += size
+        self._ring[index + 1][slot] += 1
+        # per peer
+        if user is not None:
+            host_port = user.get_host_port()
+            counter = self.peers.get(host_port)
+            if counter is None:
+                counter = self.peers[host_port] = [0, 0, 0, 0]
+            counter[index] += size
+            counter[index + 1] += 1
+
+    def _advance(self, now):
+        """clear slots passed since last put"""
+        passed = now - self._ring_time
+        if passed <= 0:
+            return
+        for i in range(1, min(passed, RING_SECONDS) + 1):
+            slot = (self._ring_time + i) % RING_SECONDS
+            for ring in self._ring:
+                ring[slot] = 0
+        self._ring_time = now
 
-    def put_traffic_down(self, b):
-        self.traffic_down.append(len(b))
+    def _prune(self, items: dict):
+        """keep largest `max_keys` counters"""
+        if self.max_keys < len(items):
+            removes = sorted(items, key=lambda x: items[x][0] + items[x][2])[:len(items) - self.max_keys]
+            for name in removes:
+                del items[name]
 
 
 __all__ = [
+    "UP",
+    "DOWN",
     "Traffic",
 ]
@@ -1,3 +1,5 @@
+from p2p_python.tool.discovery import NAME_SERVER, IPV4_PROVIDERS, IPV6_PROVIDERS, \
+    lookup_localhost_ip, lookup_global_ip
 from urllib.request import Request, urlopen
 from urllib.parse import urlparse
 from xml.etree import ElementTree
@@ -7,11 +9,9 @@ from typing import Optional, List
 import xmltodict
 import requests
 import socket
-import random
 
 
 log = getLogger(__name__)
-NAME_SERVER = '8.8.8.8'
 Mapping = namedtuple('Mapping', [
     'enabled',  # int: 1
     'external_port',  # int: 38008
@@ -239,48 +239,25 @@ def get_external_ip(soap_url) -> str:
 def get_localhost_ip():
     """get local ip address"""
     try:
-        return [
-            (s.connect((NAME_SERVER, 80)), s.getsockname()[0], s.close())
-            for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]
-        ][0][1]
+        return lookup_localhost_ip()
     except Exception:
         return '127.0.0.1'
 
 
 def get_global_ip():
-    """get global ip address"""
-    network_info_providers = [
-        'http://api.ipify.org/',
-        'http://myip.dnsomatic.com',
-        'http://inet-ip.info/ip',
-        'http://v4.ident.me/',
-    ]
-    random.shuffle(network_info_providers)
-    for url in network_info_providers:
-        try:
-            return requests.get(url).text.lstrip().rstrip()
-        except Exception:
-            continue
-    else:
+    """get global ip address, blocking, use `AddressDiscovery` on event loop"""
+    address = lookup_global_ip(IPV4_PROVIDERS)
+    if not address:
         log.info('cannot find global ip')
-        return ""
+    return address
 
 
 def get_global_ip_ipv6():
-    """get global ipv6 address"""
-    network_info_providers = [
-        'http://v6.ipv6-test.com/api/myip.php',
-        'http://v6.ident.me/',
-    ]
-    random.shuffle(network_info_providers)
-    for url in network_info_providers:
-        try:
-            return requests.get(url).text.lstrip().rstrip()
-        except Exception:
-            continue
-    else:
+    """get global ipv6 address, blocking, use `AddressDiscovery` on event loop"""
+    address = lookup_global_ip(IPV6_PROVIDERS)
+    if not address:
         log.info('cannot find global ipv6 ip')
-        return ""
+    return address
 
 
 __all__ = [
@@ -1,9 +1,14 @@
-from p2p_python.serializer import stream_unpacker, dump
+from p2p_python.serializer import stream_unpacker, dump, loads
 from p2p_python.user import UserHeader, User
+from p2p_python.config import PeerToPeerError
+from concurrent.futures import Executor, ThreadPoolExecutor, Future
+from collections import deque
 from logging import getLogger
-from typing import Dict, Optional
-from time import time
+from typing import Dict, Optional, List
+from time import time, perf_counter
 import asyncio
+import heapq
+import random
 import os
 
 # For AES
@@ -16,43 +21,176 @@ loop = asyncio.get_event_loop()
 log = getLogger(__name__)
 
 
+# DirectCmd execution mode
+E_INLINE = 'inline'  # run on event loop
+E_THREAD = 'thread'  # run sync handler in thread pool
+E_PROCESS = 'process'  # run sync handler in process pool, handler get (host, port) instead of user
+
+
 class EventIgnition(object):
 
-    def __init__(self):
-        self.event = dict()
+    def __init__(self, thread_workers=None, process_workers=None):
+        self.event = dict()  # {cmd: fnc}
+        self.mode: Dict[str, str] = dict()  # {cmd: execution mode}
+        self.limit: Dict[str, asyncio.Semaphore] = dict()  # {cmd: concurrency limit}
+        self.max_queue: Dict[str, int] = dict()  # {cmd: number of waiting calls}
+        self.stats: Dict[str, dict] = dict()  # {cmd: stats}
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self._executors: Dict[str, Executor] = dict()
 
-    def setup_events_from_class(self, klass):
+    def close(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
+        self._executors.clear()
+
+    def setup_events_from_class(self, klass, mode=E_INLINE, limit=None, max_queue=None):
         for cmd, fnc in klass.__dict__.items():
             if cmd.startswith('_'):
                 continue
             if isinstance(fnc, staticmethod):
                 fnc = fnc.__func__
-            self.add_event(cmd, fnc)
+            self.add_event(cmd, fnc, mode, limit, max_queue)
 
-    def add_event(self, cmd, fnc):
+    def add_event(self, cmd, fnc, mode=E_INLINE, limit=None, max_queue=None):
+        """
+        register DirectCmd
+        params:
+            mode: (str) E_INLINE, E_THREAD or E_PROCESS, coroutine function always run on event loop
+            limit: (int) number of concurrent calls, others wait in queue
+            max_queue: (int) reject calls when too many calls are waiting
+        """
         assert fnc.__code__.co_argcount == 2
+        assert mode in (E_INLINE, E_THREAD, E_PROCESS)
+        assert mode == E_INLINE or not asyncio.iscoroutinefunction(fnc), 'coroutine run only inline'
         if cmd in self.event:
             raise Exception('already registered cmd')
         self.event[cmd] = fnc
-        log.info(f"add DirectCmd event '{cmd}'")
+        self.mode[cmd] = mode
+        if limit:
+            self.limit[cmd] = asyncio.Semaphore(limit)
+        if max_queue:
+            self.max_queue[cmd] = max_queue
+        self.stats[cmd] = {
+            'call': 0,
+            'error': 0,
+            'reject': 0,
+            'running': 0,
+            'waiting': 0,
+            'wait_time': 0.0,
+            'process_time': 0.0,
+            'max_wait_time': 0.0,
+            'max_process_time': 0.0,
+        }
+        log.info(f"add DirectCmd event '{cmd}' mode={mode} limit={limit}")
 
     def remove_event(self, cmd):
         if cmd in self.event:
             del self.event[cmd]
+            self.mode.pop(cmd, None)
+            self.limit.pop(cmd, None)
+            self.max_queue.pop(cmd, None)
+            self.stats.pop(cmd, None)
 
     def have_event(self, cmd):
         return cmd in self.event
 
+    def getinfo(self):
+        """latency and queue wait of each cmd"""
+        info = dict()
+        for cmd, stats in self.stats.items():
+            call = max(1, stats['call'])
+            info[cmd] = {
+                'mode': self.mode[cmd],
+                'call': stats['call'],
+                'error': stats['error'],
+                'reject': stats['reject'],
+                'running': stats['running'],
+                'waiting': stats['waiting'],
+                'average_wait_time': stats['wait_time'] / call,
+                'average_process_time': stats['process_time'] / call,
+                'max_wait_time': stats['max_wait_time'],
+                'max_process_time': stats['max_process_time'],
+            }
+        return info
+
     async def ignition(self, user, cmd, data):
         if cmd in self.event:
             fnc = self.event[cmd]
-            if asyncio.iscoroutinefunction(fnc):
-                return await fnc(user, data)
-            else:
-                return fnc(user, data)
+            mode = self.mode[cmd]
+            stats = self.stats[cmd]
+            semaphore = self.limit.get(cmd)
+            # wait in queue
+            start = perf_counter()
+            if semaphore is not None:
+                max_queue = self.max_queue.get(cmd)
+                if semaphore.locked() and max_queue is not None and max_queue <= stats['waiting']:
+                    stats['reject'] += 1
+                    raise PeerToPeerError(f"too many calls of cmd '{cmd}' waiting={stats['waiting']}")
+                stats['waiting'] += 1
+                try:
+                    await semaphore.acquire()
+                finally:
+                    stats['waiting'] -= 1
+            wait_time = perf_counter() - start
+            # execute
+            stats['running'] += 1
+            job: Optional[Future] = None
+            try:
+                if asyncio.iscoroutinefunction(fnc):
+                    return await fnc(user, data)
+                elif mode == E_INLINE:
+                    return fnc(user, data)
+                elif mode == E_THREAD:
+                    job = self._get_executor(E_THREAD).submit(fnc, user, data)
+                else:
+                    host_port = user.get_host_port() if user else None
+                    job = self._get_executor(E_PROCESS).submit(fnc, host_port, data)
+                # a job keeps running after this call is cancelled, the limit is released when it ends
+                job.add_done_callback(
+                    lambda _job: loop.call_soon_threadsafe(self._finish, stats, semaphore, start, wait_time))
+                return await asyncio.wrap_future(job)
+            except Exception:
+                stats['error'] += 1
+                raise
+            finally:
+                if job is None:
+                    self._finish(stats, semaphore, start, wait_time)
         else:
             raise KeyError('Not found cmd "{}"'.format(cmd))
 
+    @staticmethod
+    def _finish(stats, semaphore: Optional[asyncio.Semaphore], start, wait_time):
+        stats['running'] -= 1
+        if semaphore is not None:
+            semaphore.release()
+        process_time = perf_counter() - start - wait_time
+        stats['call'] += 1
+        stats['wait_time'] += wait_time
+        stats['process_time'] += process_time
+        stats['max_wait_time'] = max(stats['max_wait_time'], wait_time)
+        stats['max_process_time'] = max(stats['max_process_time'], process_time)
+
+    async def ignition_many(self, user, items, timeout=None):
+        """
+        run cmds concurrently and return [(True, result) or (False, error message),..]
+        timeout is for each cmd, a slow cmd becomes (False, "TimeoutError") and others are returned
+        """
+        results = await asyncio.gather(
+            *(asyncio.wait_for(self.ignition(user, cmd, data), timeout) for cmd, data in items),
+            return_exceptions=True)
+        return [(False, f"{type(result).__name__}: {result}" if str(result) else type(result).__name__)
+                if isinstance(result, Exception) else (True, result) for result in results]
+
+    def _get_executor(self, mode) -> Executor:
+        if mode not in self._executors:
+            if mode == E_THREAD:
+                self._executors[mode] = ThreadPoolExecutor(self.thread_workers)
+            else:
+                from concurrent.futures.process import ProcessPoolExecutor  # multiprocessing is heavy
+                self._executors[mode] = ProcessPoolExecutor(self.process_workers)
+        return self._executors[mode]
+
 
 class AESCipher:
 
@@ -91,27 +229,147 @@ class AESCipher:
         return raw
 
 
+class ChangeLog(object):
+    """version counter with recent changed keys for delta sync"""
+
+    def __init__(self, maxlen=1000):
+        self.epoch = random.randint(1, 0xffffffff)  # differ after restart
+        self.version = 0
+        self._log = deque(maxlen=maxlen)  # [(version, key),..]
+
+    def bump(self, key):
+        self.version += 1
+        self._log.append((self.version, key))
+
+    def since(self, epoch, version) -> Optional[set]:
+        """keys changed after the version, None if full resync required"""
+        if epoch != self.epoch or not isinstance(version, int) or self.version < version:
+            return None
+        elif version == self.version:
+            return set()
+        elif len(self._log) == 0 or version + 1 < self._log[0][0]:
+            return None  # too old
+        else:
+            return {key for ver, key in self._log if version < ver}
+
+
+class PeerStats(object):
+    """connection quality of a peer, old stats decay by half-life"""
+    __slots__ = (
+        "last_success",  # (float) last time we connect or get response
+        "last_failure",  # (float) last time we failed to connect
+        "failures",  # (float) number of failures since last success
+        "rtt",  # (float) average response time
+    )
+    half_life = 3600.0 * 24
+
+    def __init__(self, last_success=0.0, last_failure=0.0, failures=0.0, rtt=None):
+        self.last_success = last_success
+        self.last_failure = last_failure
+        self.failures = failures
+        self.rtt = rtt
+
+    def to_list(self):
+        return [self.last_success, self.last_failure, self.failures, self.rtt]
+
+    def success(self, rtt=None):
+        self.last_success = time()
+        self.failures = 0.0
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else self.rtt * 0.7 + rtt * 0.3
+
+    def failure(self):
+        self.last_failure = time()
+        self.failures += 1.0
+
+    def score(self, header: UserHeader, now: float) -> float:
+        """higher is better"""
+        score = 0.0
+        if self.last_success:
+            score += 2.0 * 0.5 ** ((now - self.last_success) / self.half_life)
+        if self.failures:
+            score -= self.failures * 0.5 ** ((now - self.last_failure) / self.half_life)
+        if self.rtt is not None:
+            score -= min(1.0, self.rtt)
+        # long running node is stable
+        score += min(1.0, max(0, header.last_seen - header.start_time) / self.half_life)
+        score += 0.5 ** ((now - header.last_seen) / self.half_life)
+        return score
+
+
 class PeerData(object):
+    """
+    indexed peer store
+    file: `path` is a snapshot {'ver': 1, 'fields': [..], 'peers': [[(host,port), header values, stats],..]}
+        and `path`.log is a journal of [(host,port), header, stats] records appended after the snapshot
+    write: add() only updates index, dirty records are written by background flush in executor (start())
+    compaction: snapshot is rewritten when the journal becomes large
+    """
+    snapshot_ver = 1
+    last_seen_span = 3600  # write last_seen alone to file at most once in span
 
-    def __init__(self, path):
-        """recode all node, don't remove"""
+    def __init__(self, path, flush_span=10.0, compact_ratio=0.5, expire=3600*24*30):
+        """recode all node, removed node is kept on file until expired"""
         self._peer: Dict[(str, int), UserHeader] = dict()  # {(host, port): header,..}
+        self._forgotten: Dict[(str, int), UserHeader] = dict()  # removed from memory but kept on file
+        self._dirty: Dict[(str, int), UserHeader] = dict()  # not written yet
+        self._stats: Dict[(str, int), PeerStats] = dict()  # connection quality
+        self._known: Dict[(str, int), list] = dict()  # header values at last change, header is shared with User
         self.path = path
+        self.journal_path = path + '.log'
+        self.changes = ChangeLog()
+        self.new_peer_event = asyncio.Event()  # set when unknown peer added
+        self.flush_span = flush_span
+        self.compact_ratio = compact_ratio
+        self.expire = expire
+        self.journal_len = 0
+        self.f_need_compact = False
+        self.f_stop = False
+        self.broken_rows = 0  # skipped on load
+        self._lock = asyncio.Lock()
+        self._future: Optional[asyncio.Future] = None
         self.init_cleanup()
 
+    def start(self) -> asyncio.Future:
+        """start background flush, owner cancels it by close()"""
+        assert self._future is None
+        self._future = asyncio.ensure_future(self._flush_loop())
+        return self._future
+
+    def close(self):
+        """stop background flush and write dirty records after the flush in progress"""
+        self.f_stop = True
+        if self._future is not None:
+            self._future.cancel()
+        if loop.is_running():
+            return asyncio.ensure_future(self._final_flush())
+        else:
+            loop.run_until_complete(self._final_flush())
+
+    async def _final_flush(self):
+        async with self._lock:
+            rows = self._pop_dirty_rows()
+            if 0 < len(rows):
+                self._write_journal(self.journal_path, rows)
+
     def get(self, host_port) -> Optional[UserHeader]:
         return self._peer.get(tuple(host_port))
 
     def remove_from_memory(self, host_port):
         host_port = tuple(host_port)
         if host_port in self._peer:
-            del self._peer[tuple(host_port)]
+            self._forgotten[host_port] = self._peer.pop(host_port)
+            self.changes.bump(host_port)
             return True
         return False
 
     def __contains__(self, item):
         return tuple(item) in self._peer
 
+    @property
+    def version(self):
+        return self.changes.version
+
     def __len__(self):
         return len(self._peer)
 
@@ -125,30 +383,220 @@ class PeerData(object):
         return self._peer.copy()
 
     def add(self, user: User):
+        """version is bumped only if new or header changed, not by last_seen"""
         host_port = user.get_host_port()
-        self._peer[host_port] = user.header
-        with open(self.path, mode='ba') as fp:
-            header = user.header.getinfo()
-            dump((host_port, header), fp)
+        header = user.header
+        values = header.to_list()
+        known = self._known.get(host_port)
+        f_new = host_port not in self._peer
+        self._peer[host_port] = header
+        self.get_stats(host_port).success(user.average_process_time())
+        if f_new or known is None or known[:-1] != values[:-1]:
+            self._forgotten.pop(host_port, None)
+            self._dirty[host_port] = header
+            self._known[host_port] = values
+            self.changes.bump(host_port)
+            if f_new:
+                self.new_peer_event.set()
+        elif self.last_seen_span < values[-1] - known[-1]:
+            self._dirty[host_port] = header
+            self._known[host_port] = values
+
+    def get_stats(self, host_port) -> PeerStats:
+        host_port = tuple(host_port)
+        stats = self._stats.get(host_port)
+        if stats is None:
+            stats = self._stats[host_port] = PeerStats()
+        return stats
+
+    def record_success(self, host_port, rtt=None):
+        """connection success"""
+        self.get_stats(host_port).success(rtt)
+        self._mark_dirty(host_port)
+
+    def record_failure(self, host_port):
+        """connection failed"""
+        self.get_stats(host_port).failure()
+        self._mark_dirty(host_port)
+
+    def ranked(self, exclude=(), limit=None) -> List[tuple]:
+        """known peers sorted by connection quality, best first"""
+        now = time()
+        stats = self._stats
+        empty = PeerStats()
+        candidates = ((stats.get(host_port, empty).score(header, now), host_port)
+                      for host_port, header in self._peer.items() if host_port not in exclude)
+        if limit is None:
+            return [host_port for _score, host_port in sorted(candidates, reverse=True)]
+        return [host_port for _score, host_port in heapq.nlargest(limit, candidates)]
+
+    def quality(self, host_port) -> float:
+        """connection quality score of a peer"""
+        host_port = tuple(host_port)
+        header = self._peer.get(host_port)
+        if header is None:
+            return 0.0
+        return self._stats.get(host_port, PeerStats()).score(header, time())
+
+    def _mark_dirty(self, host_port):
+        host_port = tuple(host_port)
+        header = self._peer.get(host_port) or self._forgotten.get(host_port)
+        if header is not None:
+            self._dirty[host_port] = header
+
+    async def flush(self):
+        """write dirty records to journal, or compact if journal is too large"""
+        async with self._lock:
+            rows = self._pop_dirty_rows()
+            compact_size = max(1000, int(len(self._peer) * self.compact_ratio))
+            if self.f_need_compact or compact_size < self.journal_len + len(rows):
+                self._expire_forgotten()
+                snapshot = self._snapshot_rows()
+                self.f_need_compact = False
+                self.journal_len = 0
+                await loop.run_in_executor(
+                    None, self._write_snapshot, self.path, self.journal_path, snapshot)
+                log.debug(f"compact peer store {len(snapshot)} peers")
+            elif 0 < len(rows):
+                self.journal_len += len(rows)
+                await loop.run_in_executor(None, self._write_journal, self.journal_path, rows)
+
+    async def _flush_loop(self):
+        while not self.f_stop:
+            try:
+                await asyncio.sleep(self.flush_span)
+                # close() cancels the loop, not a writing flush holding the lock
+                await asyncio.shield(self.flush())
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                log.warning("peer store flush exception", exc_info=True)
+
+    def _stats_list(self, host_port):
+        stats = self._stats.get(host_port)
+        return stats.to_list() if stats else None
+
+    def _pop_dirty_rows(self):
+        rows = [(host_port, header.getinfo(), self._stats_list(host_port))
+                for host_port, header in self._dirty.items()]
+        self._dirty.clear()
+        return rows
+
+    def _expire_forgotten(self):
+        """removed peers are dropped from file on compaction after expired"""
+        time_limit = int(time() - self.expire)
+        for host_port, header in list(self._forgotten.items()):
+            if header.last_seen < time_limit:
+                del self._forgotten[host_port]
+                self._stats.pop(host_port, None)
+                self._known.pop(host_port, None)
+
+    def _snapshot_rows(self):
+        rows = [(host_port, header.to_list(), self._stats_list(host_port))
+                for host_port, header in self._forgotten.items()]
+        rows.extend((host_port, header.to_list(), self._stats_list(host_port))
+                    for host_port, header in self._peer.items())
+        return rows
+
+    @staticmethod
+    def _write_journal(journal_path, rows):
+        with open(journal_path, mode='ba') as fp:
+            for row in rows:
+                dump(row, fp)
+
+    @staticmethod
+    def _write_snapshot(path, journal_path, rows):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, mode='bw') as fp:
+            dump({'ver': PeerData.snapshot_ver, 'fields': UserHeader.__slots__, 'peers': rows}, fp)
+        os.replace(tmp_path, path)
+        # journal is included in snapshot
+        with open(journal_path, mode='bw'):
+            pass
+
+    def _read_rows(self):
+        """snapshot and journal records, legacy append-only file is also readable"""
+        rows = list()
+        if os.path.exists(self.path):
+            with open(self.path, mode='br') as fp:
+                raw = fp.read()
+            try:
+                obj = loads(raw)
+            except Exception:
+                obj = None  # legacy file has many records
+            if isinstance(obj, dict) and obj.get('ver') == self.snapshot_ver:
+                if tuple(obj['fields']) == UserHeader.__slots__:
+                    rows.extend(obj['peers'])
+                else:
+                    rows.extend((row[0], dict(zip(obj['fields'], row[1]))) + tuple(row[2:]) for row in obj['peers'])
+                    self.f_need_compact = True
+            else:
+                rows.extend(self._read_stream(self.path)[0])
+                self.f_need_compact = True
+        if os.path.exists(self.journal_path):
+            journal, good_size = self._read_stream(self.journal_path)
+            rows.extend(journal)
+            self.journal_len += len(journal)
+            if good_size < os.path.getsize(self.journal_path):
+                # records appended after a broken tail could not be read
+                log.warning(f"truncate broken peer store journal at {good_size} bytes")
+                with open(self.journal_path, mode='ba') as fp:
+                    fp.truncate(good_size)
+                self.broken_rows += 1
+        return rows
+
+    @staticmethod
+    def _read_stream(path):
+        """records until the end or a broken record, and size of good records"""
+        rows = list()
+        good_size = 0
+        with open(path, mode='br') as fp:
+            unpacker = stream_unpacker(fp)
+            try:
+                for row in unpacker:
+                    rows.append(row)
+                    good_size = unpacker.tell()
+            except Exception as e:
+                log.debug(f"broken record after {good_size} bytes of {path} by {str(e)}")
+        return rows, good_size
 
     def init_cleanup(self):
-        time_limit = int(time() - 3600*24*30)
+        time_limit = int(time() - self.expire)
         try:
-            with open(self.path, mode='br') as fp:
-                for host_port, header_dict in stream_unpacker(fp):
-                    header = UserHeader(**header_dict)
-                    if time_limit < header.last_seen:
-                        self._peer[tuple(host_port)] = header
-            # re recode
-            with open(self.path, mode='bw') as fp:
-                for host_port, header in self._peer.items():
-                    dump((host_port, header.getinfo()), fp)
+            rows = self._read_rows()
         except Exception:
-            pass
+            log.warning("failed to load peer store", exc_info=True)
+            return
+        for row in rows:
+            try:
+                # [(host,port), header, stats] or [(host,port), header] of old format
+                host_port, header = tuple(row[0]), row[1]
+                if isinstance(header, dict):
+                    header = UserHeader(**header)
+                else:
+                    header = UserHeader.from_list(header)
+                if time_limit < header.last_seen:
+                    self._peer[host_port] = header
+                    self._known[host_port] = header.to_list()
+                    if 2 < len(row) and row[2]:
+                        self._stats[host_port] = PeerStats(*row[2])
+                else:
+                    self._stats.pop(host_port, None)
+                    self.f_need_compact = True
+            except Exception:
+                self.broken_rows += 1
+        if 0 < self.broken_rows:
+            log.warning(f"skip {self.broken_rows} broken records of peer store")
+            self.f_need_compact = True
 
 
 __all__ = [
+    "E_INLINE",
+    "E_THREAD",
+    "E_PROCESS",
     "EventIgnition",
     "AESCipher",
+    "ChangeLog",
+    "PeerStats",
     "PeerData",
 ]
@@ -0,0 +1,179 @@
+from p2p_python.tool.metrics import get_registry
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+from collections import Counter
+from time import perf_counter, sleep
+import traceback
+import threading
+import asyncio
+import os.path
+import sys
+
+log = getLogger(__name__)
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAX_SAMPLES = 50  # stack samples kept per stall
+STACK_DEPTH = 8  # frames shown in report
+
+
+class LoopWatchdog(object):
+    """
+    event loop lag monitor
+    a heartbeat task measures scheduling lag continuously, and a watcher thread
+    samples the loop thread stack while the heartbeat is late. stalls longer than
+    `threshold` are reported by logging and `getinfo()`, attributed to the
+    innermost p2p-python frame of the samples.
+    params:
+        threshold: (float) stall seconds to report
+        interval: (float) heartbeat interval
+        max_offenders: (int) code locations kept
+    """
+
+    def __init__(self, threshold=0.1, interval=0.05, max_offenders=100):
+        self.f_stop = False
+        self.threshold = threshold
+        self.interval = interval
+        self.max_offenders = max_offenders
+        self.lag = 0.0
+        self.lag_max = 0.0
+        self.lag_sum = 0.0
+        self.beats = 0
+        self.stalls = 0
+        self.offenders: Dict[str, list] = dict()  # {location: [stalls, total sec, max sec, stack]}
+        registry = get_registry()
+        self.stall_time = registry.histogram('p2p_loop_stall_seconds', 'event loop stall over threshold')
+        self._beat = perf_counter()
+        self._samples: List[Tuple[str, list]] = list()  # [(location, stack),..] of current stall
+        self._lock = threading.Lock()
+        self._loop_thread_id: Optional[int] = None
+        self._future: Optional[asyncio.Future] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """call in the event loop thread"""
+        self._loop_thread_id = threading.get_ident()
+        self._future = asyncio.ensure_future(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+        log.info(f"start loop watchdog threshold={self.threshold}s")
+
+    def close(self):
+        self.f_stop = True
+        if self._future:
+            self._future.cancel()
+
+    def getinfo(self, num=10):
+        offenders = sorted(self.offenders.items(), key=lambda x: x[1][1], reverse=True)[:num]
+        return {
+            'threshold': self.threshold,
+            'lag': round(self.lag, 6),
+            'lag_max': round(self.lag_max, 6),
+            'lag_mean': round(self.lag_sum / self.beats, 6) if self.beats else 0.0,
+            'stalls': self.stalls,
+            'offenders': [{
+                'location': location,
+                'stalls': stalls,
+                'total': round(total, 6),
+                'max': round(maximum, 6),
+                'stack': stack,
+            } for location, (stalls, total, maximum, stack) in offenders],
+        }
+
+    async def _heartbeat(self):
+        while not self.f_stop:
+            start = perf_counter()
+            self._beat = start
+            try:
+                await asyncio.sleep(self.interval)
+            except asyncio.CancelledError:
+                break
+            lag = max(0.0, perf_counter() - start - self.interval)
+            self.lag = lag
+            self.lag_sum += lag
+            self.beats += 1
+            if self.lag_max < lag:
+                self.lag_max = lag
+            if self.threshold < lag:
+                self._finish_stall(lag)
+            elif self._samples:
+                with self._lock:
+                    self._samples = list()
+
+    def _watch(self):
+        """watcher thread, sample loop thread stack while heartbeat is late"""
+        while not self.f_stop:
+            sleep(self.threshold / 2)
+            if perf_counter() - self._beat < self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            with self._lock:
+                if len(self._samples) < MAX_SAMPLES:
+                    self._samples.append((_attribute(stack), stack))
+
+    def _finish_stall(self, lag):
+        with self._lock:
+            samples, self._samples = self._samples, list()
+        self.stalls += 1
+        self.stall_time.observe(lag)
+        if samples:
+            location, _ = Counter(location for location, _ in samples).most_common(1)[0]
+            stack = next(stack for name, stack in samples if name == location)
+            stack = [f"{_short_path(f.filename)}:{f.lineno} {f.name}" for f in stack[-STACK_DEPTH:]]
+        else:
+            location, stack = 'unknown', list()  # blocked between samples
+        offender = self.offenders.get(location)
+        if offender is None:
+            offender = self.offenders[location] = [0, 0.0, 0.0, stack]
+        offender[0] += 1
+        offender[1] += lag
+        offender[2] = max(offender[2], lag)
+        if stack:
+            offender[3] = stack
+        if self.max_offenders < len(self.offenders):
+            del self.offenders[min(self.offenders, key=lambda x: self.offenders[x][1])]
+        log.warning(f"event loop blocked {round(lag, 3)}s at {location}")
+        log.debug("blocking stack\n" + '\n'.join(stack))
+
+
+def _short_path(filename):
+    if filename.startswith(PACKAGE_DIR):
+        return os.path.relpath(filename, os.path.dirname(PACKAGE_DIR))
+    return filename
+
+
+def _attribute(stack: list) -> str:
+    """innermost p2p-python frame, or innermost frame if not found"""
+    for frame in reversed(stack):
+        if frame.filename.startswith(PACKAGE_DIR) and frame.filename != os.path.abspath(__file__):
+            break
+    else:
+        frame = stack[-1]
+    return f"{_short_path(frame.filename)}:{frame.lineno} {frame.name}"
+
+
+# disabled by default, started by enable_watchdog()
+watchdog: Optional[LoopWatchdog] = None
+
+
+def get_watchdog() -> Optional[LoopWatchdog]:
+    return watchdog
+
+
+def enable_watchdog(threshold=0.1, interval=0.05) -> LoopWatchdog:
+    """start loop watchdog, call in the event loop thread"""
+    global watchdog
+    if watchdog is None:
+        watchdog = LoopWatchdog(threshold, interval)
+        watchdog.start()
+    return watchdog
+
+
+__all__ = [
+    "LoopWatchdog",
+    "get_watchdog",
+    "enable_watchdog",
+]
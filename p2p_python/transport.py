@@ -0,0 +1,196 @@
+from asyncio.streams import StreamWriter, StreamReader
+from typing import List, Tuple
+from logging import getLogger
+from abc import ABC, abstractmethod
+import asyncio
+import socket
+
+log = getLogger(__name__)
+BUFFER_SIZE = 8192
+socket2name = {
+    socket.AF_INET: "ipv4",
+    socket.AF_INET6: "ipv6",
+    socket.AF_UNSPEC: "ipv4/6",
+}
+
+# note: event loop is taken on use, not on import, so that simulation can replace it
+
+
+class Transport(ABC):
+    """
+    socket layer under Core, TcpTransport for real network and SimTransport for simulation
+    stream is (reader, writer) pair like asyncio streams, writer needs
+    `write`, `drain`, `close`, `get_extra_info` and `transport.is_closing`
+    """
+
+    @abstractmethod
+    def start(self, core, s_family=socket.AF_UNSPEC):
+        """start stream server to `core.initial_connection_check` and datagram server to `core.datagram_received`"""
+
+    @abstractmethod
+    def close(self):
+        """stop servers"""
+
+    @abstractmethod
+    async def open_connection(self, host, port, excludes=(), proxy=None) -> Tuple[StreamReader, StreamWriter, tuple]:
+        """
+        (reader, writer, host_port) raise OSError or TimeoutError if failed
+        params:
+            excludes: addresses not to connect
+            proxy: (host, port) of SOCKS5 proxy (Tor)
+        """
+
+    @abstractmethod
+    def send_datagram(self, data: bytes, host_port: tuple):
+        """send without blocking, lost without error"""
+
+    @abstractmethod
+    async def is_reachable(self, host, port) -> bool:
+        """check stream port is opened"""
+
+
+class TcpTransport(Transport):
+    """TCP stream and UDP datagram by sockets"""
+
+    def __init__(self):
+        self.tcp_servers: List[asyncio.AbstractServer] = list()
+        self.udp_servers: List[socket.socket] = list()
+
+    def start(self, core, s_family=socket.AF_UNSPEC):
+        config = core.config
+        # create new TCP socket server
+        log.info(f"try to setup server socket {core.host}:{config.P2P_PORT}")
+        if config.P2P_ACCEPT:
+            config.P2P_ACCEPT = False
+            for res in socket.getaddrinfo(
+                    core.host, config.P2P_PORT, s_family, socket.SOCK_STREAM, 0, socket.AI_PASSIVE):
+                af, sock_type, proto, canon_name, sa = res
+                try:
+                    sock = self.create_tcp_server(core, af, sa)
+                    log.debug(f"success tcp server creation af={socket2name.get(af)}")
+                    self.tcp_servers.append(sock)
+                    config.P2P_ACCEPT = True
+                except Exception:
+                    log.debug("create tcp server exception", exc_info=True)
+        # create new UDP socket server
+        if config.P2P_UDP_ACCEPT:
+            config.P2P_UDP_ACCEPT = False
+            for res in socket.getaddrinfo(
+                    core.host, config.P2P_PORT, s_family, socket.SOCK_DGRAM, 0, socket.AI_PASSIVE):
+                af, sock_type, proto, canon_name, sa = res
+                try:
+                    sock = self.create_udp_server(core, af, sa)
+                    log.debug(f"success udp server creation af={socket2name.get(af)}")
+                    self.udp_servers.append(sock)
+                    config.P2P_UDP_ACCEPT = True
+                except Exception:
+                    log.debug("create udp server exception", exc_info=True)
+        # listen socket ipv4/ipv6
+        log.info(f"setup socket server "
+                 f"tcp{len(self.tcp_servers)}={config.P2P_ACCEPT} udp{len(self.udp_servers)}={config.P2P_UDP_ACCEPT}")
+
+    def close(self):
+        loop = asyncio.get_event_loop()
+        for sock in self.tcp_servers:
+            sock.close()
+            asyncio.ensure_future(sock.wait_closed())
+        for sock in self.udp_servers:
+            loop.remove_reader(sock.fileno())
+            sock.close()
+
+    async def open_connection(self, host, port, excludes=(), proxy=None):
+        loop = asyncio.get_event_loop()
+        # get connection list
+        future: asyncio.Future = loop.run_in_executor(
+            None, socket.getaddrinfo, host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        try:
+            await asyncio.wait_for(future, 10.0)
+            address_infos = future.result()
+        except socket.gaierror as e:
+            raise ConnectionError(f"address resolve failed {host} {e}")
+        # try to connect one by one
+        for af, socktype, proto, canonname, host_port in address_infos:
+            if host_port[0] in excludes:
+                raise ConnectionRefusedError(f"baned address {host_port[0]}")
+            try:
+                if proxy:
+                    if af != socket.AF_INET:
+                        continue
+                    import socks  # only for Tor
+                    sock = socks.socksocket()
+                    sock.setproxy(socks.PROXY_TYPE_SOCKS5, proxy[0], proxy[1])
+                else:
+                    sock = socket.socket(af, socktype, proto)
+                future: asyncio.Future = loop.run_in_executor(
+                    None, sock.connect, host_port)
+                await asyncio.wait_for(future, 10.0)
+                future.result()  # raised exception of socket
+                sock.setblocking(False)
+                reader, writer = await asyncio.open_connection(sock=sock, loop=loop)
+                return reader, writer, host_port
+            except asyncio.CancelledError:
+                sock.close()  # cancelled by dialer
+                raise
+            except asyncio.TimeoutError:
+                continue  # try to connect but do not reach
+            except ConnectionRefusedError:
+                continue  # try to connect closed socket
+            except OSError as e:
+                log.debug(f"socket creation error by {str(e)}")
+                continue
+        # create no connection
+        raise ConnectionError(f"no connection created to {host}:{port}")
+
+    def send_datagram(self, data, host_port):
+        asyncio.get_event_loop().run_in_executor(None, self._send_udp, data, host_port)
+
+    async def is_reachable(self, host, port):
+        from p2p_python.utils import is_reachable
+        return await is_reachable(host, port)
+
+    @staticmethod
+    def _send_udp(data, host_port):
+        sock_family = socket.AF_INET if len(host_port) == 2 else socket.AF_INET6
+        # warning: may block this closure, use run_in_executor
+        with socket.socket(sock_family, socket.SOCK_DGRAM) as sock:
+            sock.sendto(data, host_port)
+
+    @staticmethod
+    def create_tcp_server(core, family, host_port):
+        assert family == socket.AF_INET or family == socket.AF_INET6
+        loop = asyncio.get_event_loop()
+        coroutine = asyncio.start_server(
+            core.initial_connection_check, host_port[0], host_port[1],
+            family=family, backlog=core.backlog, loop=loop)
+        abstract_server = loop.run_until_complete(coroutine)
+        for sock in abstract_server.sockets:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return abstract_server
+
+    @staticmethod
+    def create_udp_server(core, family, host_port):
+        assert family == socket.AF_INET or family == socket.AF_INET6
+        sock = socket.socket(family, socket.SOCK_DGRAM, 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(False)
+        sock.bind(host_port)
+        fd = sock.fileno()
+
+        def listen():
+            try:
+                data, addr = sock.recvfrom(BUFFER_SIZE)
+                core.datagram_received(data, addr)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except Exception:
+                log.warning("UDP server exception", exc_info=True)
+        # UDP server is not stream
+        asyncio.get_event_loop().add_reader(fd, listen)
+        return sock
+
+
+__all__ = [
+    "BUFFER_SIZE",
+    "Transport",
+    "TcpTransport",
+]
@@ -7,6 +7,8 @@ import asyncio
 
 
 log = getLogger(__name__)
+# delta of neers carries joins, leaves and header changes but not last_seen, refresh by full list
+NEERS_FULL_SYNC = 600.0
 
 
 class UserHeader(object):
@@ -50,6 +52,29 @@ class UserHeader(object):
             'last_seen': self.last_seen,
         }
 
+    def to_list(self):
+        """values in __slots__ order, compact format for storage"""
+        return [self.name, self.client_ver, self.network_ver, self.my_host_name, self.p2p_accept,
+                self.p2p_udp_accept, self.p2p_port, self.start_time, self.last_seen]
+
+    @classmethod
+    def from_list(cls, values):
+        header = cls.__new__(cls)
+        (header.name, header.client_ver, header.network_ver, header.my_host_name, header.p2p_accept,
+         header.p2p_udp_accept, header.p2p_port, header.start_time, header.last_seen) = values
+        return header
+
+    def update(self, info: dict):
+        """update by getinfo() format dict in place"""
+        self.client_ver = info['client_ver']
+        self.network_ver = info['network_ver']
+        self.my_host_name = info.get('my_host_name')
+        self.p2p_accept = info['p2p_accept']
+        self.p2p_udp_accept = info['p2p_udp_accept']
+        self.p2p_port = info['p2p_port']
+        self.start_time = info['start_time']
+        self.last_seen = info.get('last_seen', self.last_seen)
+
     def update_last_seen(self):
         self.last_seen = int(time())
 
@@ -64,6 +89,9 @@ class User(object):
         "aeskey",  # (str) Common key
         "direction",  # (str) We are as server or client side
         "neers",  # ({host_port: header})  Neer clients info
+        "neers_epoch",  # (int) epoch of neers for delta sync
+        "neers_version",  # (int) version of neers for delta sync
+        "neers_full_time",  # (float) last time we got full neers
         "score",  # (int )User score
         "warn",  # (int) User warning score
         "create_time",  # (int) User object creation time
@@ -79,6 +107,9 @@ class User(object):
         self.aeskey = aeskey
         self.direction = direction
         self.neers: Dict[(str, int), UserHeader] = dict()
+        self.neers_epoch = 0
+        self.neers_version = 0
+        self.neers_full_time = 0.0
         # user experience
         self.score = 0
         self.warn = 0
@@ -134,10 +165,39 @@ class User(object):
         host_port[1] = self.header.p2p_port
         return tuple(host_port)
 
+    def get_neers_version(self):
+        """request data for delta sync of neers, unknown epoch requests full list periodically"""
+        if self.neers_full_time + NEERS_FULL_SYNC < time():
+            return {'epoch': None, 'version': None}
+        return {'epoch': self.neers_epoch, 'version': self.neers_version}
+
     def update_neers(self, items):
-        # [[(host,port), header],..]
+        if isinstance(items, dict):
+            # delta {'epoch': int, 'version': int, 'full': bool, 'items': [[(host,port), header],..],
+            #   'removed': [(host,port),..]}
+            if items['full']:
+                self.neers_full_time = time()
+                alive = set(tuple(host_port) for host_port, _header in items['items'])
+                for host_port in list(self.neers.keys()):
+                    if host_port not in alive:
+                        del self.neers[host_port]
+            for host_port in items['removed']:
+                self.neers.pop(tuple(host_port), None)
+            self._apply_neers(items['items'])
+            self.neers_epoch = items['epoch']
+            self.neers_version = items['version']
+        else:
+            # [[(host,port), header],..]
+            self._apply_neers(items)
+
+    def _apply_neers(self, items):
         for host_port, header in items:
-            self.neers[tuple(host_port)] = UserHeader(**header)
+            host_port = tuple(host_port)
+            neer = self.neers.get(host_port)
+            if neer is not None and neer.name == header['name']:
+                neer.update(header)
+            else:
+                self.neers[host_port] = UserHeader(**header)
 
     def average_process_time(self):
         if len(self.process_time) == 0:
@@ -1,4 +1,4 @@
-from p2p_python.config import V, Debug
+from p2p_python.config import V, Config, Debug
 import logging
 import socket
 import random
@@ -54,53 +54,61 @@ def get_name():
     return "{}:{}".format(random.choice(NAMES), random.randint(10000, 99999))
 
 
-def setup_p2p_params(network_ver, p2p_port, p2p_accept=False, p2p_udp_accept=False, sub_dir=None):
-    """ setup general connection setting """
+def create_p2p_params(network_ver, p2p_port, p2p_accept=False, p2p_udp_accept=False, sub_dir=None,
+                      root_dir=None) -> Config:
+    """ connection setting of a node, pass to `Peer2Peer(config=)` to run many nodes in a process """
     # directory params
-    if V.DATA_PATH is not None:
-        raise Exception('Already setup params.')
-    root_data_dir = os.path.join(os.path.expanduser('~'), 'p2p-python')
-    if not os.path.exists(root_data_dir):
-        os.makedirs(root_data_dir)
-    V.DATA_PATH = os.path.join(root_data_dir, str(p2p_port))
-    if not os.path.exists(V.DATA_PATH):
-        os.makedirs(V.DATA_PATH)
+    root_data_dir = root_dir or os.path.join(os.path.expanduser('~'), 'p2p-python')
+    data_path = os.path.join(root_data_dir, str(p2p_port))
     if sub_dir:
-        V.DATA_PATH = os.path.join(V.DATA_PATH, sub_dir)
-        if not os.path.exists(V.DATA_PATH):
-            os.makedirs(V.DATA_PATH)
+        data_path = os.path.join(data_path, sub_dir)
+    os.makedirs(data_path, exist_ok=True)
     # network params
-    V.CLIENT_VER = get_version()
-    V.SERVER_NAME = get_name()
-    V.NETWORK_VER = network_ver
-    V.P2P_PORT = p2p_port
-    V.P2P_ACCEPT = p2p_accept
-    V.P2P_UDP_ACCEPT = p2p_udp_accept
+    return Config(
+        DATA_PATH=data_path,
+        CLIENT_VER=get_version(),
+        SERVER_NAME=get_name(),
+        NETWORK_VER=network_ver,
+        P2P_PORT=p2p_port,
+        P2P_ACCEPT=p2p_accept,
+        P2P_UDP_ACCEPT=p2p_udp_accept,
+    )
+
+
+def setup_p2p_params(network_ver, p2p_port, p2p_accept=False, p2p_udp_accept=False, sub_dir=None):
+    """ setup general connection setting, default of nodes without own config """
+    if V.DATA_PATH is not None:
+        raise Exception('Already setup params.')
+    config = create_p2p_params(network_ver, p2p_port, p2p_accept, p2p_udp_accept, sub_dir)
+    for name in Config.__slots__:
+        value = getattr(config, name)
+        if value is not None:
+            setattr(V, name, value)
 
 
-def setup_tor_connection(proxy_host='127.0.0.1', port=9150, f_raise_error=True):
+def setup_tor_connection(proxy_host='127.0.0.1', port=9150, f_raise_error=True, config=V):
     """ client connection to onion router """
     # Typically, Tor listens for SOCKS connections on port 9050.
     # Tor-browser listens on port 9150.
     host_port = (proxy_host, port)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    if V.P2P_ACCEPT or V.P2P_UDP_ACCEPT:
+    if config.P2P_ACCEPT or config.P2P_UDP_ACCEPT:
         raise ConnectionError('P2P socket accept enable? tcp={} udp={}'.format(
-            V.P2P_ACCEPT, V.P2P_UDP_ACCEPT))
+            config.P2P_ACCEPT, config.P2P_UDP_ACCEPT))
     if 0 != sock.connect_ex(host_port):
         if f_raise_error:
             raise ConnectionError('Cannot connect proxy by test.')
     else:
-        V.TOR_CONNECTION = host_port
+        config.TOR_CONNECTION = host_port
     sock.close()
 
 
-def setup_server_hostname(hostname: str = None):
+def setup_server_hostname(hostname: str = None, config=V):
     """
     hostname displayed for others
     This is useful when proxy provide different ip address
     """
-    V.MY_HOST_NAME = hostname
+    config.MY_HOST_NAME = hostname
 
 
 async def is_reachable(host, port):
@@ -161,6 +169,7 @@ __all__ = [
     "is_reachable",
     "is_unbind_port",
     "setup_tor_connection",
+    "create_p2p_params",
     "setup_p2p_params",
     "setup_logger",
 ]
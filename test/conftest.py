@@ -0,0 +1,49 @@
+"""
+nodes on SimNetwork with virtual clock, many nodes run in this process
+the loop is set before p2p_python modules bind it on import
+"""
+import asyncio
+from p2p_python.sim import VirtualClockLoop, SimNetwork
+asyncio.set_event_loop(VirtualClockLoop())
+
+from p2p_python.utils import create_p2p_params
+from p2p_python.server import Peer2Peer
+import pytest
+
+NETWORK_VER = 12345
+P2P_PORT = 2000
+
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+
+@pytest.fixture
+def sim_nodes(tmp_path, loop):
+    """make_nodes(number, **Peer2Peer kwargs) -> (network, [p2p,..]), closed after test"""
+    nodes = list()
+
+    def make_nodes(number, latency=0.02, **kwargs):
+        network = SimNetwork(latency=latency, seed=1)
+        for _ in range(number):
+            transport = network.create_transport()
+            config = create_p2p_params(NETWORK_VER, P2P_PORT, p2p_accept=True, p2p_udp_accept=True,
+                                       sub_dir=transport.host, root_dir=str(tmp_path))
+            config.LOCAL_IP, config.GLOBAL_IPV4, config.GLOBAL_IPV6 = transport.host, '', ''
+            p2p = Peer2Peer(config=config, transport=transport, **kwargs)
+            p2p.broadcast_check = lambda user, data: True
+            p2p.setup(f_stabilize=False)
+            nodes.append(p2p)
+        return network, nodes[-number:]
+
+    yield make_nodes
+    for p2p in nodes:
+        p2p.close()
+    loop.run_until_complete(asyncio.sleep(1.0))
+
+
+async def connect(p2p: Peer2Peer, other: Peer2Peer):
+    assert await p2p.core.create_connection(other.core.transport.host, P2P_PORT)
+    while len(p2p.core.user) == 0 or len(other.core.user) == 0:
+        await asyncio.sleep(0.01)
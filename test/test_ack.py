@@ -0,0 +1,72 @@
+from p2p_python.server import Peer2PeerCmd, T_ACK
+from conftest import connect
+from collections import Counter
+import asyncio
+
+
+def record_ack_frames(p2p, frames: Counter):
+    """count ACK frames by (sender, receiver) link"""
+    send_many_users = p2p._send_many_users
+
+    async def wrapper(item, allows, denys, **kwargs):
+        if item['type'] == T_ACK:
+            for user in allows:
+                frames[(p2p.config.SERVER_NAME, user.header.name)] += 1
+        return await send_many_users(item, allows, denys, **kwargs)
+    p2p._send_many_users = wrapper
+
+
+def test_aggregated_ack_over_chain(sim_nodes, loop):
+    """k-ACK counts nodes several hops away, each link of the chain carries one ACK frame"""
+    network, nodes = sim_nodes(5, f_ack_aggregate=True)
+    frames = Counter()
+
+    async def run():
+        for p2p, other in zip(nodes, nodes[1:]):
+            await connect(p2p, other)
+        for p2p in nodes:
+            record_ack_frames(p2p, frames)
+        origin = nodes[0]
+        await origin.send_command(Peer2PeerCmd.BROADCAST, data='hello', ack_num=4)
+        await asyncio.sleep(1.0)
+        return [p2p.plumtree.counter['receive'] for p2p in nodes[1:]]
+
+    assert loop.run_until_complete(run()) == [1, 1, 1, 1]
+    assert sorted(frames.values()) == [1, 1, 1, 1]
+
+
+def test_aggregated_ack_not_enough(sim_nodes, loop):
+    """more ACKs than accepted nodes time out"""
+    network, nodes = sim_nodes(3, f_ack_aggregate=True)
+
+    async def run():
+        for p2p, other in zip(nodes, nodes[1:]):
+            await connect(p2p, other)
+        try:
+            await nodes[0].send_command(Peer2PeerCmd.BROADCAST, data='hello', timeout=2.0, ack_num=3)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+    assert loop.run_until_complete(run())
+
+
+def test_one_ack_per_link(sim_nodes, loop):
+    """flooding over a full mesh, every link carries one ACK frame and counts reach the origin"""
+    network, nodes = sim_nodes(5, f_ack_aggregate=True)
+    frames = Counter()
+
+    async def inner():
+        for index, p2p in enumerate(nodes):
+            for other in nodes[index + 1:]:
+                await connect(p2p, other)
+        for p2p in nodes:
+            record_ack_frames(p2p, frames)
+        await nodes[0].send_command(Peer2PeerCmd.BROADCAST, data='hello', ack_num=4)
+        await asyncio.sleep(5.0)
+
+    loop.run_until_complete(inner())
+    assert max(frames.values()) == 1
+    origin = nodes[0].config.SERVER_NAME
+    assert sorted(sender for sender, receiver in frames if receiver == origin) == \
+        sorted(p2p.config.SERVER_NAME for p2p in nodes[1:])
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+
+class Sender(object):
+    def __init__(self, index):
+        self.host_port = (f'10.0.0.{index}', 2000)
+
+    def get_host_port(self):
+        return self.host_port
+
+
+def even_only(items):
+    return [data % 2 == 0 for _host_port, data in items]
+
+
+def check_all(p2p, loop, number):
+    async def inner():
+        return await asyncio.gather(*(p2p.check_broadcast(Sender(index), index) for index in range(number)))
+    return loop.run_until_complete(inner())
+
+
+def test_results_in_collected_order(sim_nodes, loop):
+    network, (p2p,) = sim_nodes(1)
+    batches = list()
+
+    def broadcast_check_batch(items):
+        batches.append([host_port for host_port, _data in items])
+        return even_only(items)
+
+    p2p.broadcast_check_batch = broadcast_check_batch
+    p2p.batch_max = 4
+    assert check_all(p2p, loop, 10) == [index % 2 == 0 for index in range(10)]
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert batches[0][0] == ('10.0.0.0', 2000)
+
+
+def test_check_in_executor(sim_nodes, loop):
+    network, (p2p,) = sim_nodes(1)
+    p2p.broadcast_check_batch = even_only
+    p2p.batch_executor = ThreadPoolExecutor(1)
+    try:
+        assert check_all(p2p, loop, 3) == [True, False, True]
+    finally:
+        p2p.batch_executor.shutdown()
+
+
+def test_broken_batch_rejects_all(sim_nodes, loop):
+    network, (p2p,) = sim_nodes(1)
+    p2p.broadcast_check_batch = lambda items: [True]  # wrong number of results
+    assert check_all(p2p, loop, 3) == [False, False, False]
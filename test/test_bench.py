@@ -0,0 +1,94 @@
+from conftest import connect
+from argparse import Namespace
+import importlib.util
+import asyncio
+import json
+import os
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench')
+
+
+def load(name):
+    """bench scripts are not a package, bench_sim sets own loop on import"""
+    event_loop = asyncio.get_event_loop()
+    spec = importlib.util.spec_from_file_location(name, os.path.join(BENCH_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if asyncio.get_event_loop() is not event_loop:
+        asyncio.get_event_loop().close()
+        asyncio.set_event_loop(event_loop)
+    return module
+
+
+bench_network = load('bench_network')
+bench_sim = load('bench_sim')
+
+
+class FakeCluster(object):
+    """answers of node processes, each node traces one broadcast"""
+
+    def __init__(self, num):
+        self.num = num
+        self.up = 0
+        self.calls = list()
+
+    def call(self, index, cmd, *args):
+        self.calls.append((index, cmd, args))
+        if cmd == 'ping':
+            return [0.001 * n for n in range(1, args[0] + 1)]
+        elif cmd == 'direct':
+            return {'single_sec': 1.0, 'many_sec': 0.1}
+        elif cmd == 'broadcast':
+            self.up += 1000 * args[0]
+            return [0.01] * args[0]
+        elif cmd == 'connect':
+            return {'success': len(args[0]), 'sec': 0.1, 'rss_before': 0}
+        elif cmd == 'wait_users':
+            return args[0]
+        elif cmd == 'status':
+            return {'users': 2, 'rss': 1024 * 1024, 'up': self.up if index == 0 else 0, 'down': 0}
+        elif cmd == 'traces':
+            return {1: [['n0', 0.0]] if index == 0 else [['n0', 0.0], [f'n{index}', 0.01 * index]]}
+
+    def call_all(self, cmd, *args_list):
+        assert len(args_list) == self.num
+        return [self.call(index, cmd, *args) for index, args in enumerate(args_list)]
+
+
+def test_network_report():
+    args = Namespace(nodes=4, degree=2, pings=10, calls=100, batch=10, broadcasts=2, size=8, settle=0.0)
+    cluster = FakeCluster(args.nodes)
+    result = json.loads(json.dumps(bench_network.bench(args, cluster)))
+    assert result['connections'] == 0 + 1 + 2 + 2
+    assert result['handshake_per_sec'] > 0
+    assert result['memory_per_connection_kb'] == round(4 * 1024 / 10, 1)
+    assert result['ping'] == {'count': 10, 'p50': 5.0, 'p90': 9.0, 'p99': 10.0}
+    assert result['direct_cmd']['single_calls_per_sec'] == 100.0
+    assert result['direct_cmd']['many_calls_per_sec'] == 1000.0
+    broadcast = result['broadcast']
+    assert broadcast['bytes_per_broadcast'] == 1000
+    assert broadcast['coverage_p50_ms'] == 10.0 and broadcast['coverage_p99_ms'] == 30.0
+    assert broadcast['hops_max'] == 1
+    workloads = [cmd for index, cmd, _ in cluster.calls if cmd in ('ping', 'direct', 'broadcast')]
+    assert workloads == ['ping', 'direct', 'broadcast']  # driven from node 0 only
+    assert all(index == 0 for index, cmd, _ in cluster.calls if cmd in workloads)
+
+
+def test_percentiles_in_ms():
+    assert bench_network.percentiles([]) == {}
+    assert bench_network.percentiles([0.003, 0.001, 0.002], ratios=(0.5, 1.0)) == {'p50': 2.0, 'p100': 3.0}
+    assert bench_network.to_ms(None) is None and bench_network.to_ms(float('inf')) is None
+    assert bench_network.to_ms(0.0015) == 1.5
+    assert 0 < bench_network.memory_rss()
+
+
+def test_sim_coverage_and_components(sim_nodes, loop):
+    assert bench_sim.coverage(1.0, [1.5, 1.25], 3) == [0.25, 0.5, float('inf')]
+    assert bench_sim.percentile([1, 2, 3, 4], 0.5) == 2
+    network, nodes = sim_nodes(4)
+    assert bench_sim.components(nodes) == 4
+    loop.run_until_complete(connect(nodes[0], nodes[1]))
+    loop.run_until_complete(connect(nodes[2], nodes[3]))
+    assert bench_sim.components(nodes) == 2
+    loop.run_until_complete(connect(nodes[1], nodes[2]))
+    assert bench_sim.components(nodes) == 1
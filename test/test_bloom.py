@@ -0,0 +1,48 @@
+from p2p_python.tool import bloom
+from p2p_python.tool.bloom import BloomFilter, RotatingBloomFilter
+from p2p_python.server import Peer2PeerCmd
+from conftest import connect
+
+
+def test_false_positive_rate():
+    bloom_filter = BloomFilter(capacity=10000, error_rate=0.001)
+    for key in range(10000):
+        bloom_filter.add(key)
+    assert all(key in bloom_filter for key in range(10000))
+    false_positive = sum(1 for key in range(10000, 110000) if key in bloom_filter)
+    assert false_positive / 100000 < 0.002
+
+
+def test_rotation_keeps_max_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bloom, 'time', lambda: now[0])
+    seen = RotatingBloomFilter(capacity=10, error_rate=1e-6, max_age=90.0, generations=3)
+    for key in range(25):
+        seen.add(key)  # over capacity grows instead of dropping
+    assert seen.getinfo()['filters'] == 3 and seen.overflow == 2
+    now[0] += 89.0
+    assert all(key in seen for key in range(25))
+    now[0] += 111.0  # oldest generation dropped after generations spans
+    assert not any(key in seen for key in range(25))
+
+
+class AlwaysSeen(object):
+    """worst case filter, every key is a false positive"""
+
+    def __contains__(self, key):
+        return True
+
+    def add(self, key):
+        pass
+
+
+def test_false_positive_not_nack(sim_nodes, loop):
+    network, (p2p, other) = sim_nodes(2)
+    other.broadcast_seen = AlwaysSeen()
+
+    async def inner():
+        await connect(p2p, other)
+        return await p2p.send_command(Peer2PeerCmd.BROADCAST, data='hello', timeout=2.0)
+
+    _, ack = loop.run_until_complete(inner())
+    assert ack is True
@@ -0,0 +1,48 @@
+from p2p_python.server import Peer2PeerCmd, T_REQUEST
+from p2p_python.serializer import dumps
+from p2p_python.tool.utils import AESCipher
+from conftest import connect
+import asyncio
+import zlib
+
+
+def frame(user, item) -> bytes:
+    """message on stream like Core.send_msg_body"""
+    msg_body = AESCipher.encrypt(key=user.aeskey, raw=zlib.compress(dumps(item)))
+    return len(msg_body).to_bytes(4, 'big') + msg_body
+
+
+def test_coalesced_messages_in_one_read(sim_nodes, loop):
+    """every message of a read is processed without waiting for next data"""
+    network, (p2p, other) = sim_nodes(2)
+    calls = list()
+    other.event.add_event('count', lambda user, data: calls.append(data))
+
+    async def inner():
+        await connect(p2p, other)
+        user = p2p.core.user[0]
+        await user.send(b''.join(frame(user, {
+            'type': T_REQUEST,
+            'cmd': Peer2PeerCmd.DIRECT_CMD,
+            'data': {'cmd': 'count', 'data': index},
+            'time': 0,
+            'uuid': index + 10,
+        }) for index in range(3)))
+        await asyncio.sleep(0.5)
+
+    loop.run_until_complete(inner())
+    assert calls == [0, 1, 2]
+
+
+def test_message_right_after_accept(sim_nodes, loop):
+    """the first message may arrive together with the accept signal"""
+    network, (p2p, other) = sim_nodes(2)
+    other.event.add_event('echo', lambda user, data: data)
+
+    async def inner():
+        assert await p2p.core.create_connection(other.core.transport.host, other.config.P2P_PORT)
+        await asyncio.sleep(0)  # receive_loop started, not waiting for the other side
+        return await p2p.send_direct_cmd('echo', 'hello')
+
+    _, data = loop.run_until_complete(inner())
+    assert data == 'hello'
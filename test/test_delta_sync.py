@@ -0,0 +1,34 @@
+from p2p_python.server import Peer2PeerCmd
+from p2p_python.user import NEERS_FULL_SYNC
+from conftest import connect
+import asyncio
+
+
+def test_neers_delta_and_full_refresh(sim_nodes, loop):
+    network, (p2p, hub, other) = sim_nodes(3)
+
+    async def get_nears(user):
+        data = user.get_neers_version()
+        _, item = await p2p.send_command(Peer2PeerCmd.GET_NEARS, data=data, user=user)
+        user.update_neers(item)
+        return item
+
+    async def inner():
+        await connect(p2p, hub)
+        user = p2p.core.user[0]
+        assert (await get_nears(user))['full']
+        await connect(other, hub)
+        item = await get_nears(user)
+        assert not item['full'] and len(item['items']) == 1
+        assert len(user.neers) == 2
+        other.core.remove_connection(other.core.user[0], 'test')
+        await asyncio.sleep(1.0)
+        item = await get_nears(user)
+        assert not item['full'] and len(item['removed']) == 1
+        assert len(user.neers) == 1
+        # no change but stale last_seen, full list after the span
+        assert (await get_nears(user))['items'] == []
+        user.neers_full_time -= NEERS_FULL_SYNC + 1.0
+        assert (await get_nears(user))['full']
+
+    loop.run_until_complete(inner())
@@ -0,0 +1,90 @@
+from p2p_python.dht import DHT, node_id
+from p2p_python.server import Peer2PeerCmd
+from p2p_python.tool.store import DiskStore
+from conftest import connect, P2P_PORT
+import asyncio
+import math
+import random
+
+
+async def build_network(nodes):
+    """routing tables know users and their neers like stabilizer feeds"""
+    for index, p2p in enumerate(nodes[1:], 1):
+        for other in random.sample(nodes[:index], min(index, 2)):
+            await connect(p2p, other)
+    by_host = {p2p.core.transport.host: p2p for p2p in nodes}
+    for p2p in nodes:
+        for user in p2p.core.user:
+            p2p.add_dht_contact(user.header, user.get_host_port())
+            for neer in by_host[user.get_host_port()[0]].core.user:
+                if neer.header.name != p2p.config.SERVER_NAME:
+                    p2p.add_dht_contact(neer.header, neer.get_host_port())
+    for p2p in nodes:
+        await p2p.dht.join()  # stabilizer does after first update
+
+
+def test_find_node_in_log_hops(sim_nodes, loop):
+    """others not in the routing table are asked by temporary connections"""
+    random.seed(1)
+    network, nodes = sim_nodes(64)
+
+    async def inner():
+        await build_network(nodes)
+        # parallel lookups from one node share temporary connections
+        p2p = nodes[0]
+        targets = nodes[1:]
+        results = await asyncio.gather(*(p2p.dht.lookup(node_id(other.config.SERVER_NAME)) for other in targets))
+        for other, (contacts, hops) in zip(targets, results):
+            my_id = node_id(other.config.SERVER_NAME)
+            assert my_id in dict(contacts)
+            assert hops <= math.ceil(math.log2(len(nodes)))
+        assert len(p2p.temporary_users) == 0
+        assert await p2p.find_node(nodes[-1].config.SERVER_NAME) is not None
+
+    loop.run_until_complete(inner())
+
+
+def test_lookup_keeps_users(sim_nodes, loop):
+    """temporary connections are not users, no change of users and broadcast fan-out"""
+    random.seed(2)
+    network, nodes = sim_nodes(16)
+
+    async def inner():
+        await build_network(nodes)
+        p2p = nodes[0]
+        users = [list(other.core.user) for other in nodes]
+        versions = [other.core.user_changes.version for other in nodes]
+        # hold a temporary connection to a far node, lookups share it
+        far = next(other for other in reversed(nodes) if p2p.core.host_port2user((other.core.transport.host, P2P_PORT)) is None)
+        far_host_port = (far.core.transport.host, P2P_PORT)
+        await p2p._connect_temporary(far_host_port)
+        await asyncio.sleep(0.5)
+        assert len(p2p.core.temporary) == 1 and len(far.core.temporary) == 1
+        await asyncio.gather(*(p2p.dht.lookup(node_id(other.config.SERVER_NAME)) for other in nodes[1:]))
+        eager = [other.plumtree.counter['eager'] for other in nodes]
+        await p2p.send_command(Peer2PeerCmd.BROADCAST, data='hello')
+        await asyncio.sleep(1.0)
+        fanout = [other.plumtree.counter['eager'] - count for other, count in zip(nodes, eager)]
+        p2p._release_temporary(far_host_port)
+        await asyncio.sleep(1.0)  # closed by the requester
+        return users, versions, fanout
+
+    users, versions, fanout = loop.run_until_complete(inner())
+    assert [list(other.core.user) for other in nodes] == users
+    assert [other.core.user_changes.version for other in nodes] == versions
+    assert fanout == [len(users[0])] + [len(other_users) - 1 for other_users in users[1:]]
+    assert all(len(other.core.temporary) == 0 for other in nodes)
+
+
+def test_store_keeps_my_value(tmp_path, loop):
+    async def no_contact(*args):
+        return list()
+
+    dht = DHT(node_id('me'), no_contact, no_contact, no_contact, store=DiskStore(str(tmp_path)))
+    target = node_id('key')
+    loop.run_until_complete(dht.put('key', 'mine'))
+    assert not loop.run_until_complete(dht.handle_store(target, 'yours', 60))
+    dht.cache.pop(target)
+    assert dht.get_local(target)[0] == 'mine'
+    assert loop.run_until_complete(dht.handle_store(node_id('other'), 'yours', 60))
+    assert dht.get_local(node_id('other'))[0] == 'yours'
@@ -0,0 +1,26 @@
+from p2p_python.tool.dialer import Dialer
+import asyncio
+
+
+def test_surplus_dials_cancelled(loop):
+    delays = {'fail': 0.1, 'fast': 0.2, 'slow': 5.0, 'late': 0.3, 'extra': 1.0, 'unused': 0.1}
+    started, cancelled, results = list(), list(), list()
+
+    async def dial(host, port):
+        started.append(host)
+        try:
+            await asyncio.sleep(delays[host])
+        except asyncio.CancelledError:
+            cancelled.append(host)
+            raise
+        return host != 'fail'
+
+    dialer = Dialer(dial, concurrency=3)
+    candidates = [(host, 2000) for host in delays]
+    connected = loop.run_until_complete(
+        dialer.connect(candidates, 2, on_result=lambda host_port, result: results.append((host_port[0], result))))
+    assert connected == [('fast', 2000), ('late', 2000)]
+    assert started == ['fail', 'fast', 'slow', 'late', 'extra']  # finished slots are refilled
+    assert sorted(cancelled) == ['extra', 'slow']
+    assert results == [('fail', False), ('fast', True), ('late', True)]
+    assert dialer.getinfo() == {'concurrency': 3, 'running': 0, 'success': 2, 'failure': 1, 'cancelled': 2}
@@ -0,0 +1,50 @@
+from p2p_python.config import PeerToPeerError
+from conftest import connect
+import asyncio
+
+
+def test_direct_cmd_many_timeout_each(sim_nodes, loop):
+    """a slow cmd times out alone, others are returned and nothing runs twice"""
+    network, (p2p, other) = sim_nodes(2)
+    calls = list()
+
+    async def slow(user, data):
+        calls.append('slow')
+        await asyncio.sleep(60.0)
+
+    def echo(user, data):
+        calls.append('echo')
+        return data
+
+    other.event.add_event('slow', slow)
+    other.event.add_event('echo', echo)
+
+    async def run():
+        await connect(p2p, other)
+        return await p2p.send_direct_cmd_many([('slow', None), ('echo', 2)], timeout=3.0)
+
+    _, results = loop.run_until_complete(run())
+    assert isinstance(results[0], PeerToPeerError) and str(results[0]) == 'TimeoutError'
+    assert results[1] == 2
+    assert sorted(calls) == ['echo', 'slow']
+
+
+def test_direct_cmd_many_order_and_errors(sim_nodes, loop):
+    """results keep request order, a failed cmd does not fail others"""
+    network, (p2p, other) = sim_nodes(2)
+
+    def double(user, data):
+        return data * 2
+
+    def broken(user, data):
+        raise ValueError('broken')
+
+    other.event.add_event('double', double)
+    other.event.add_event('broken', broken)
+    loop.run_until_complete(connect(p2p, other))
+    user, results = loop.run_until_complete(p2p.send_direct_cmd_many(
+        [(double, 1), ('broken', None), ('unknown', None), ('double', 'a')]))
+    assert user is p2p.core.user[0]
+    assert results[0] == 2 and results[3] == 'aa'
+    assert str(results[1]) == 'ValueError: broken'
+    assert isinstance(results[2], PeerToPeerError) and 'KeyError' in str(results[2])
@@ -0,0 +1,45 @@
+from p2p_python.tool.utils import EventIgnition, E_THREAD
+import threading
+import asyncio
+
+
+def test_limit_held_until_job_ends(loop):
+    """a timed out call of thread mode keeps the limit while its job is running"""
+    event = EventIgnition()
+    started, finish = threading.Event(), threading.Event()
+
+    def slow(user, data):
+        started.set()
+        finish.wait(10.0)
+        return data
+
+    event.add_event('slow', slow, mode=E_THREAD, limit=1)
+    semaphore = event.limit['slow']
+
+    async def inner():
+        many = asyncio.ensure_future(event.ignition_many(None, [('slow', 1)], timeout=1.0))
+        while not started.is_set():
+            await asyncio.sleep(0)  # virtual time stops while spinning
+        assert await many == [(False, 'TimeoutError')]
+        assert semaphore.locked() and event.stats['slow']['running'] == 1
+        finish.set()
+        while semaphore.locked():
+            await asyncio.sleep(0)
+        return await event.ignition(None, 'slow', 2)
+
+    try:
+        assert loop.run_until_complete(inner()) == 2
+        assert event.stats['slow']['call'] == 2 and event.stats['slow']['running'] == 0
+    finally:
+        finish.set()
+        event.close()
+
+
+def test_full_backlog_drops_new_request(sim_nodes):
+    network, (p2p,) = sim_nodes(1)
+    p2p.request_limit = 0
+    p2p.config.REQUEST_BACKLOG = 2
+    for index in range(3):
+        p2p._start_request(None, {'cmd': 'ping-pong', 'uuid': index}, 0.0)
+    assert [item['uuid'] for _user, item, _push_time in p2p.request_backlog] == [0, 1]
+    assert p2p.request_dropped == 1
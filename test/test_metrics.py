@@ -0,0 +1,62 @@
+from p2p_python.server import Peer2PeerCmd
+from p2p_python.tool import metrics
+from p2p_python.tool.metrics import Registry
+from conftest import connect
+import asyncio
+import pytest
+
+
+def test_collectors_of_many_nodes(sim_nodes, monkeypatch):
+    registry = Registry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    network, nodes = sim_nodes(2)
+    text = registry.render()
+    for p2p in nodes:
+        assert f'p2p_known_peers{{node="{p2p.config.SERVER_NAME}"}} 0' in text
+        assert f'p2p_connections{{node="{p2p.config.SERVER_NAME}",direction="inbound"}} 0' in text
+    nodes[0].close()
+    text = registry.render()
+    assert nodes[0].config.SERVER_NAME not in text
+    assert nodes[1].config.SERVER_NAME in text
+
+
+def test_enable_after_start(sim_nodes, loop, monkeypatch, caplog):
+    """nodes started before enable_metrics() record labeled by node, endpoint failure is logged"""
+    async def start(self, host='127.0.0.1', port=9100):
+        raise OSError('address already in use')
+
+    monkeypatch.setattr(metrics, 'registry', metrics.NullRegistry())
+    monkeypatch.setattr(metrics, '_instances', dict())
+    monkeypatch.setattr(Registry, 'start', start)
+    network, (p2p, other) = sim_nodes(2)
+
+    async def inner():
+        registry = metrics.enable_metrics()
+        await connect(p2p, other)
+        await p2p.send_command(Peer2PeerCmd.PING_PONG)
+        await asyncio.sleep(0.1)
+        return registry
+
+    text = loop.run_until_complete(inner()).render()
+    name, other_name = p2p.config.SERVER_NAME, other.config.SERVER_NAME
+    assert f'p2p_command_seconds_count{{node="{name}",cmd="ping-pong"}} 1' in text
+    assert f'p2p_command_seconds_count{{node="{other_name}"' not in text
+    assert f'p2p_handshake_seconds_count{{node="{name}",direction="outbound"}} 1' in text
+    assert f'p2p_handshake_seconds_count{{node="{other_name}",direction="inbound"}} 1' in text
+    assert f'p2p_known_peers{{node="{other_name}"}}' in text
+    assert 'failed to start metrics endpoint' in caplog.text
+
+
+def test_remove_instance_series():
+    registry = Registry()
+    counter = registry.counter('requests', 'requests', ('node', 'cmd'))
+    counter.labels('a', 'ping').inc()
+    counter.labels('b', 'ping').inc()
+    registry.remove_instance({'node': 'a'})
+    assert 'node="a"' not in registry.render()
+    assert 'requests{node="b",cmd="ping"} 1' in registry.render()
+
+
+def test_metric_is_abstract():
+    with pytest.raises(TypeError):
+        metrics._Metric('name', 'documentation')
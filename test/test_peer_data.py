@@ -0,0 +1,102 @@
+from p2p_python.tool.utils import PeerData
+from p2p_python.user import UserHeader
+from p2p_python.serializer import dump
+from conftest import connect
+from time import time
+import asyncio
+
+
+def test_add_same_header_keeps_version(sim_nodes, loop):
+    """stabilizer adds connected users every cycle, peer list cache must survive it"""
+    network, (p2p, other) = sim_nodes(2)
+    loop.run_until_complete(connect(p2p, other))
+    user = p2p.core.user[0]
+    p2p.peers.add(user)
+    version = p2p.peers.version
+    user.header.update_last_seen()
+    p2p.peers.add(user)
+    assert p2p.peers.version == version
+    user.header.p2p_accept = not user.header.p2p_accept
+    p2p.peers.add(user)
+    assert p2p.peers.version == version + 1
+
+
+def make_header(name, last_seen):
+    return UserHeader(name=name, client_ver='test', network_ver=1, p2p_accept=True, p2p_udp_accept=True,
+                      p2p_port=2000, start_time=last_seen, last_seen=last_seen)
+
+
+def test_close_waits_flush(tmp_path, loop):
+    """records marked dirty while a flush is writing are not lost"""
+    path = str(tmp_path.joinpath('peer.dat'))
+    peers = PeerData(path)
+    now = int(time())
+
+    async def inner():
+        for index in range(100):
+            host_port = (f'10.0.0.{index}', 2000)
+            peers._peer[host_port] = make_header(str(index), now)
+            peers._mark_dirty(host_port)
+        flushing = asyncio.ensure_future(peers.flush())
+        await asyncio.sleep(0)
+        peers._peer[('10.0.1.0', 2000)] = make_header('late', now)
+        peers._mark_dirty(('10.0.1.0', 2000))
+        await peers.close()
+        assert flushing.done()
+
+    loop.run_until_complete(inner())
+    assert len(PeerData(path)) == 101
+
+
+def test_forgotten_expired_on_compaction(tmp_path, loop):
+    path = str(tmp_path.joinpath('peer.dat'))
+    peers = PeerData(path, expire=3600)
+    now = int(time())
+    for name, last_seen in (('old', now - 7200), ('new', now)):
+        host_port = (name, 2000)
+        peers._peer[host_port] = make_header(name, last_seen)
+        peers.record_success(host_port)
+        peers.remove_from_memory(host_port)
+    peers.f_need_compact = True
+    loop.run_until_complete(peers.flush())
+    assert list(peers._forgotten) == [('new', 2000)]
+    assert ('old', 2000) not in peers._stats
+    peers.close()
+
+
+def test_broken_journal_rows_skipped(tmp_path, loop):
+    """a bad record is skipped alone and a broken tail is cut, so later appends stay readable"""
+    path = str(tmp_path.joinpath('peer.dat'))
+    now = int(time())
+    with open(path + '.log', mode='bw') as fp:
+        dump((('10.0.0.1', 2000), make_header('a', now).getinfo(), None), fp)
+        dump((('10.0.0.2', 2000), {'name': 'no fields'}, None), fp)
+        dump((('10.0.0.3', 2000), make_header('c', now).getinfo(), None), fp)
+        fp.write(b'\xc1\xc1')  # never used msgpack byte
+    peers = PeerData(path)
+    assert sorted(peers.keys()) == [('10.0.0.1', 2000), ('10.0.0.3', 2000)]
+    assert peers.broken_rows == 2
+    peers._peer[('10.0.0.4', 2000)] = make_header('d', now)
+    peers._mark_dirty(('10.0.0.4', 2000))
+    peers.close()
+    assert len(PeerData(path)) == 3
+
+
+def test_ranked_by_quality(tmp_path, loop):
+    path = str(tmp_path.joinpath('peer.dat'))
+    peers = PeerData(path)
+    now = int(time())
+    good, unknown, bad = ('good', 2000), ('unknown', 2000), ('bad', 2000)
+    for host_port in (bad, unknown, good):
+        peers._peer[host_port] = make_header(host_port[0], now)
+    peers.record_success(good, rtt=0.1)
+    for _ in range(3):
+        peers.record_failure(bad)
+    assert peers.ranked() == [good, unknown, bad]
+    assert peers.ranked(exclude={good}, limit=1) == [unknown]
+    assert peers.quality(good) > peers.quality(unknown) > peers.quality(bad)
+    # stats survive restart
+    peers.f_need_compact = True
+    loop.run_until_complete(peers.flush())
+    peers.close()
+    assert PeerData(path).ranked() == [good, unknown, bad]
@@ -0,0 +1,82 @@
+from p2p_python.server import Peer2PeerCmd
+from p2p_python.tool.plumtree import PlumTree
+from conftest import connect
+import asyncio
+
+
+class Link(object):
+    closed = False
+
+
+def test_split_keeps_min_eager():
+    tree = PlumTree(min_eager=2)
+    links = [Link() for _ in range(4)]
+    for link in links:
+        tree.prune(link)
+    eager, lazy = tree.split(links)
+    assert len(eager) == 2 and len(lazy) == 2
+    assert tree.lazy == set(lazy)
+
+
+def test_tree_repair_after_link_lost(sim_nodes, loop):
+    """duplicates prune the mesh to a tree, lost links are repaired by IHAVE and GRAFT"""
+    network, nodes = sim_nodes(4, f_plumtree=True)
+
+    async def broadcast(data):
+        await nodes[0].send_command(Peer2PeerCmd.BROADCAST, data=data)
+        await asyncio.sleep(3.0)
+
+    async def inner():
+        for index, p2p in enumerate(nodes):
+            for other in nodes[index + 1:]:
+                await connect(p2p, other)
+        for index in range(3):
+            await broadcast(f'warm{index}')
+        assert 0 < sum(p2p.plumtree.counter['prune'] for p2p in nodes)
+        # lose every link of the origin but one
+        origin = nodes[0]
+        for user in origin.core.user[1:]:
+            origin.core.remove_connection(user, 'test')
+        await asyncio.sleep(1.0)
+        await broadcast('after')
+
+    loop.run_until_complete(inner())
+    assert [p2p.plumtree.counter['receive'] for p2p in nodes[1:]] == [4, 4, 4]
+
+
+def test_graft_skips_disconnected_announcer(sim_nodes, loop):
+    network, (p2p, gone, alive) = sim_nodes(3, f_plumtree=True)
+    grafted = list()
+
+    async def send_control(cmd, data, users, uuid=None, trace=None):
+        if cmd == Peer2PeerCmd.GRAFT:
+            grafted.extend(users)
+        return len(users)
+
+    async def inner():
+        await connect(p2p, gone)
+        await connect(p2p, alive)
+        gone_user, alive_user = p2p.core.user
+        p2p._send_control = send_control
+        p2p.plumtree.announce(123, gone_user, p2p._missing_broadcast_timeout)
+        p2p.plumtree.announce(123, alive_user, p2p._missing_broadcast_timeout)
+        p2p.core.remove_connection(gone_user, 'test')
+        await asyncio.sleep(p2p.plumtree.ihave_timeout * 1.5)  # no wait for the next announcer
+        return alive_user
+
+    alive_user = loop.run_until_complete(inner())
+    assert grafted == [alive_user]
+    assert 123 not in p2p.plumtree.timers
+
+
+def test_no_cache_if_disabled(sim_nodes, loop):
+    network, (p2p, other) = sim_nodes(2)
+
+    async def inner():
+        await connect(p2p, other)
+        await p2p.send_command(Peer2PeerCmd.BROADCAST, data='hello')
+        await asyncio.sleep(1.0)
+
+    loop.run_until_complete(inner())
+    assert other.plumtree.counter['receive'] == 1
+    assert len(p2p.plumtree.cache) == 0 and len(other.plumtree.cache) == 0
@@ -0,0 +1,35 @@
+from p2p_python.tool.score import ScoreIndex, weighted_order
+from collections import Counter
+import random
+
+
+class Connection(object):
+    def __init__(self, host_port, neers):
+        self.host_port = host_port
+        self.neers = dict.fromkeys(neers)
+
+    def get_host_port(self):
+        return self.host_port
+
+
+def test_candidates_follow_changes():
+    """peers known by more connections rank higher, connected ones are remove candidates"""
+    index = ScoreIndex()
+    a, b = Connection(('a', 1), [('x', 1), ('y', 1)]), Connection(('b', 1), [('x', 1), ('a', 1)])
+    index.sync_connections([a, b])
+    assert index.join_candidates(10) == [(('x', 1), 2), (('y', 1), 1)]
+    assert index.join_candidates(10, {('x', 1)}) == [(('y', 1), 1)]
+    assert index.remove_candidates(10) == [(('b', 1), -1), (('a', 1), 0)]
+    # b closed, x is known only by a
+    index.sync_connections([a])
+    assert index.join_candidates(10) == [(('x', 1), 1), (('y', 1), 1)]
+    index.set_neers(('a', 1), [('y', 1)])
+    assert index.join_candidates(10) == [(('y', 1), 1)]
+
+
+def test_weighted_order_prefers_heavy_but_varies():
+    random.seed(1)
+    items = [('best', 4.0), ('good', 2.0), ('weak', 1.0)]
+    firsts = Counter(weighted_order(items, lambda x: x[1])[0][0] for _ in range(2000))
+    assert firsts['best'] > firsts['good'] > firsts['weak'] > 0
+    assert sorted(weighted_order(items, lambda x: x[1])) == sorted(items)
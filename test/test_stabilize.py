@@ -0,0 +1,28 @@
+from p2p_python.server import _wait_stabilize
+from conftest import connect
+import asyncio
+
+
+def wait_with_event(p2p, loop):
+    """virtual seconds of 20s stabilizer wait when a connection event comes at 5s"""
+    async def inner():
+        start = loop.time()
+        loop.call_later(5.0, p2p.core.user_event.set)
+        woken = await _wait_stabilize(p2p, [p2p.core.user_event], 20.0)
+        return woken, loop.time() - start
+    return loop.run_until_complete(inner())
+
+
+def test_woken_up_if_connections_not_enough(sim_nodes, loop):
+    network, (p2p,) = sim_nodes(1, listen=3)
+    woken, passed = wait_with_event(p2p, loop)
+    assert woken and passed < 7.0
+    assert not p2p.core.user_event.is_set()
+
+
+def test_event_ignored_if_connections_enough(sim_nodes, loop):
+    network, (p2p, *others) = sim_nodes(3, listen=3)
+    for other in others:
+        loop.run_until_complete(connect(p2p, other))
+    woken, passed = wait_with_event(p2p, loop)
+    assert not woken and 20.0 <= passed
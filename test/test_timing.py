@@ -0,0 +1,58 @@
+from p2p_python.server import Peer2PeerCmd
+from p2p_python.tool import metrics
+from p2p_python.tool.metrics import Registry
+from p2p_python.tool.timing import StageTimer
+from conftest import connect
+from collections import defaultdict
+import pytest
+
+REQUEST_STAGES = {'recv_framing', 'recv_decrypt', 'recv_decompress', 'queue_wait', 'decode', 'dispatch', 'handler'}
+SEND_STAGES = {'send_compress', 'send_encrypt', 'send_write'}
+
+
+def ping(p2p, other, loop):
+    async def inner():
+        await connect(p2p, other)
+        for timing in (p2p.core.timing, other.core.timing):
+            timing.enable(sample_rate=1.0, callback=lambda stage, sec, timing=timing: stages[timing].add(stage))
+        await p2p.send_command(Peer2PeerCmd.PING_PONG)
+
+    stages = defaultdict(set)
+    loop.run_until_complete(inner())
+    return stages[p2p.core.timing], stages[other.core.timing]
+
+
+def test_pipeline_stages(sim_nodes, loop, monkeypatch):
+    registry = Registry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    network, (p2p, other) = sim_nodes(2)
+    sender, receiver = ping(p2p, other, loop)
+    assert receiver == REQUEST_STAGES | SEND_STAGES
+    assert sender == REQUEST_STAGES - {'handler'} | SEND_STAGES
+    text = registry.render()
+    assert f'p2p_stage_seconds_count{{node="{other.config.SERVER_NAME}",stage="handler"}} 1' in text
+    assert f'p2p_stage_seconds_count{{node="{p2p.config.SERVER_NAME}",stage="handler"}}' not in text
+
+
+def test_disabled_records_nothing(sim_nodes, loop):
+    network, (p2p, other) = sim_nodes(2)
+    p2p.core.timing.enable = other.core.timing.enable = lambda **kwargs: None
+    assert ping(p2p, other, loop) == (set(), set())
+    assert p2p.core.timing.getinfo()['stages'] == {} and other.core.timing.getinfo()['stages'] == {}
+
+
+def test_stats_and_broken_callback():
+    def broken(stage, sec):
+        raise ValueError('broken')
+
+    timing = StageTimer()
+    timing.enable(sample_rate=1.0, callback=broken)
+    timing.enable(sample_rate=1.0, callback=broken)
+    assert timing.callbacks == [broken]
+    timing.record('decode', 0.1)
+    timing.record('decode', 0.3)
+    info = timing.getinfo()['stages']['decode']
+    assert info['count'] == 2 and info['max'] == 0.3
+    assert info['mean'] == pytest.approx(0.2)
+    with pytest.raises(AssertionError):
+        timing.enable(sample_rate=0.0)
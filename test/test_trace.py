@@ -0,0 +1,64 @@
+from p2p_python.server import Peer2PeerCmd
+from p2p_python.tool.trace import MAX_TRACE_HOPS, BroadcastTracer, TraceCollector
+from conftest import connect
+import asyncio
+import pytest
+
+
+def test_relay_extends_trace():
+    tracer = BroadcastTracer(sample_rate=1.0, maxlen=2)
+    trace = tracer.start(1, 'origin')
+    assert tracer.relay(1, trace, 'relay', trace[0][1] + 0.5) == trace + [['relay', trace[0][1] + 0.5]]
+    assert tracer.relay(2, [['origin', 'broken']], 'relay', 0.0) is None
+    assert tracer.relay(2, [], 'relay', 0.0) is None
+    assert tracer.relay(2, [['hop', 0.0]] * MAX_TRACE_HOPS, 'relay', 0.0) is None
+    tracer.start(2, 'origin')
+    tracer.start(3, 'origin')
+    assert list(tracer.traces) == [2, 3]  # oldest is removed over maxlen
+    assert not BroadcastTracer().sample()
+
+
+def test_collector_keeps_earliest_arrival():
+    collector = TraceCollector()
+    collector.add(1, [['a', 0.0], ['b', 0.1], ['c', 0.3]])
+    collector.add(1, [['a', 0.0], ['d', 0.1], ['c', 0.2]])  # c reached earlier via d
+    assert collector.tree(1) == {None: ['a'], 'a': ['b', 'd'], 'd': ['c']}
+    assert collector.coverage(1) == [0.0, 0.1, 0.1, 0.2]
+    assert collector.coverage(1, nodes=5)[-1] == float('inf')
+    report = collector.report(nodes=4)
+    assert report['broadcasts'] == 1 and report['hops_max'] == 2
+    assert report['coverage_p50'] == pytest.approx(0.1)
+    assert report['coverage_p99'] == pytest.approx(0.2)
+    assert {(hop['parent'], hop['child']) for hop in report['slow_hops']} == {('a', 'b'), ('a', 'd'), ('d', 'c')}
+    assert all(hop['latency'] == pytest.approx(0.1) for hop in report['slow_hops'])
+
+
+def test_collector_without_origin():
+    collector = TraceCollector()
+    collector.add(1, [['a', 0.0], ['b', 0.1]])
+    collector.broadcasts[1].pop('a')
+    assert collector.coverage(1) == []
+    assert collector.report()['broadcasts'] == 0
+
+
+def test_trace_on_line(sim_nodes, loop):
+    """traces of relays are merged to the line a-b-c-d"""
+    network, nodes = sim_nodes(4)
+    for p2p in nodes:
+        p2p.tracer.sample_rate = 1.0
+
+    async def inner():
+        for p2p, other in zip(nodes, nodes[1:]):
+            await connect(p2p, other)
+        await nodes[0].send_command(Peer2PeerCmd.BROADCAST, data='hello')
+        await asyncio.sleep(1.0)
+
+    loop.run_until_complete(inner())
+    collector = TraceCollector()
+    for p2p in nodes:
+        collector.add_traces(p2p.tracer.traces)
+    uuid, = collector.broadcasts
+    names = [p2p.config.SERVER_NAME for p2p in nodes]
+    assert collector.tree(uuid) == {None: names[:1], names[0]: names[1:2], names[1]: names[2:3], names[2]: names[3:]}
+    assert len(collector.coverage(uuid, len(nodes))) == 4
+    assert collector.report(len(nodes))['hops_max'] == 3